@@ -1,15 +1,17 @@
+import atexit
 import json
 import logging
 import os
+import threading
 from dataclasses import dataclass
 from http import HTTPMethod
 from pathlib import Path
 from typing import Any
 
 import click
-import jsonlines
 import requests
 import yaml
+from loculus_client import LoculusClient, iter_json_lines
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -40,64 +42,51 @@ def organism_url(config: Config, organism: str) -> str:
     return f"{backend_url(config)}/{organism.strip('/')}"
 
 
-def get_jwt(config: Config) -> str:
-    """Get a JWT token for the given username and password"""
+# Per Keycloak user, like the tokens they cache
+_clients: dict[tuple[str, str], LoculusClient] = {}
+_clients_lock = threading.Lock()
 
-    external_metadata_updater_password = os.getenv("EXTERNAL_METADATA_UPDATER_PASSWORD")
-    if not external_metadata_updater_password:
-        external_metadata_updater_password = config.password
 
-    data = {
-        "username": config.username,
-        "password": external_metadata_updater_password,
-        "grant_type": "password",
-        "client_id": config.keycloak_client_id,
-    }
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-
-    keycloak_token_url = config.keycloak_token_url
-
-    response = requests.post(keycloak_token_url, data=data, headers=headers, timeout=60)
-    response.raise_for_status()
-
-    jwt_keycloak = response.json()
-    return jwt_keycloak["access_token"]
+def get_client(config: Config) -> LoculusClient:
+    """Client shared by all requests, so that connections and the Keycloak token are reused"""
+    key = (config.keycloak_token_url, config.username)
+    with _clients_lock:
+        if key not in _clients:
+            external_metadata_updater_password = os.getenv("EXTERNAL_METADATA_UPDATER_PASSWORD")
+            if not external_metadata_updater_password:
+                external_metadata_updater_password = config.password
+            client = LoculusClient(
+                keycloak_token_url=config.keycloak_token_url,
+                keycloak_client_id=config.keycloak_client_id,
+                username=config.username,
+                password=external_metadata_updater_password,
+                timeout=60,
+            )
+            atexit.register(client.log_metrics)
+            _clients[key] = client
+        return _clients[key]
 
 
 def make_request(  # noqa: PLR0913, PLR0917
     method: HTTPMethod,
     url: str,
     config: Config,
-    headers: dict[str, str] = {},
+    headers: dict[str, str] | None = None,
     params: dict[str, Any] | None = None,
     files: dict[str, Any] | None = None,
     json_body: dict[str, Any] | None = None,
     data: str | None = None,
 ) -> requests.Response:
     """Generic request function to handle repetitive tasks like fetching JWT and setting headers."""
-    jwt = get_jwt(config)
-    headers["Authorization"] = f"Bearer {jwt}"
-
-    match method:
-        case HTTPMethod.GET:
-            response = requests.get(url, headers=headers, params=params, timeout=60)
-        case HTTPMethod.POST:
-            if files:
-                headers.pop("Content-Type")  # Remove content-type for multipart/form-data
-                response = requests.post(url, headers=headers, files=files, data=params, timeout=60)
-            else:
-                response = requests.post(
-                    url, headers=headers, json=json_body, params=params, data=data, timeout=60
-                )
-        case _:
-            msg = f"Unsupported HTTP method: {method}"
-            raise ValueError(msg)
-
-    if not response.ok:
-        msg = f"Error: {response.status_code} - {response.text}"
-        raise requests.exceptions.HTTPError(msg)
-
-    return response
+    return get_client(config).request(
+        method,
+        url,
+        headers=headers,
+        params=params,
+        files=files,
+        json_body=json_body,
+        data=data,
+    )
 
 
 def submit_external_metadata(
@@ -139,17 +128,7 @@ def get_group_info(config: Config, group_id: int) -> dict[str, Any]:
 
     response = make_request(HTTPMethod.GET, url, config, headers=headers)
 
-    entries: list[dict[str, Any]] = []
-    try:
-        entries = list(jsonlines.Reader(response.iter_lines()).iter())
-    except jsonlines.Error as err:
-        response_summary = response.text
-        if len(response_summary) > 100:
-            response_summary = response_summary[:50] + "\n[..]\n" + response_summary[-50:]
-        logger.error(f"Error decoding JSON from /groups/{group_id}: {response_summary}")
-        raise ValueError from err
-
-    return entries
+    return list(iter_json_lines(response, f"/groups/{group_id}"))
 
 
 # TODO: Better return type, Any is too broad
@@ -163,23 +142,13 @@ def fetch_released_entries(config: Config, organism: str) -> dict[str, Any]:
 
     response = make_request(HTTPMethod.GET, url, config, headers=headers)
 
-    entries: list[dict[str, Any]] = []
-    try:
-        entries = list(jsonlines.Reader(response.iter_lines()).iter())
-    except jsonlines.Error as err:
-        response_summary = response.text
-        if len(response_summary) > 100:
-            response_summary = response_summary[:50] + "\n[..]\n" + response_summary[-50:]
-        logger.error(f"Error decoding JSON from /get-released-data: {response_summary}")
-        raise ValueError() from err
-
     # Only keep unalignedNucleotideSequences and metadata
     data_dict: dict[str, Any] = {
         rec["metadata"]["accessionVersion"]: {
             "metadata": rec["metadata"],
             "unalignedNucleotideSequences": rec["unalignedNucleotideSequences"],
         }
-        for rec in entries
+        for rec in iter_json_lines(response, "/get-released-data")
     }
 
     return data_dict
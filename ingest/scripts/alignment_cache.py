@@ -0,0 +1,331 @@
+"""
+Cache of nextclade alignment results between ingest runs, keyed by sequence md5 and dataset.
+
+`--mode select` writes the sequences of one segment that aren't cached yet to a FASTA file for
+nextclade (one sequence per distinct hash) and a plan with the hash and, if cached, the
+alignmentScore of every sequence. `--mode merge` combines the plan with the fresh nextclade results
+into `seqName`/`alignmentScore` rows like the TSV of a nextclade run over all sequences, and adds
+the fresh results to the cache.
+
+With `--classification` (see classify_segments.py), sequences assigned to another segment aren't
+aligned against this one and get an empty alignmentScore, which isn't cached. Once all segments are
+merged, `--mode select --fallback` selects the sequences that didn't align to the segment they were
+assigned to, so that they are aligned against this segment after all, and `--mode merge --fallback`
+merges the results of only those sequences.
+
+The dataset is identified by a digest of the downloaded dataset files, so all results are aligned
+again whenever the dataset changes. Each segment has its own SQLite file in the cache directory,
+so the rules of different segments don't contend for it.
+"""
+
+import csv
+import hashlib
+import logging
+import sqlite3
+from collections.abc import Iterator
+from itertools import repeat
+from pathlib import Path
+
+import click
+import orjson
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from run_report import record_counts
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+    encoding="utf-8",
+    level=logging.DEBUG,
+    format="%(asctime)s %(levelname)8s (%(filename)20s:%(lineno)4d) - %(message)s ",
+    datefmt="%H:%M:%S",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS alignments (
+    hash TEXT NOT NULL,
+    dataset TEXT NOT NULL,
+    -- Empty if the sequence doesn't align to the segment, like in the nextclade TSV
+    alignment_score TEXT NOT NULL,
+    PRIMARY KEY (hash, dataset)
+) WITHOUT ROWID;
+"""
+
+
+def dataset_digest(dataset_dir: str) -> str:
+    """md5 of the names and contents of all files of a nextclade dataset"""
+    digest = hashlib.md5(usedforsecurity=False)
+    root = Path(dataset_dir)
+    for path in sorted(p for p in root.rglob("*") if p.is_file()):
+        digest.update(str(path.relative_to(root)).encode() + b"\0")
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def open_cache(cache_dir: str | None, segment: str) -> sqlite3.Connection | None:
+    if not cache_dir:
+        return None
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(Path(cache_dir) / f"{segment}.sqlite")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def cached_scores(connection: sqlite3.Connection | None, dataset: str) -> dict[str, str]:
+    if connection is None:
+        return {}
+    return dict(
+        connection.execute(
+            "SELECT hash, alignment_score FROM alignments WHERE dataset = ?", (dataset,)
+        )
+    )
+
+
+def nextclade_scores(path: str) -> Iterator[tuple[str, str]]:
+    """(seqName, alignmentScore) of a nextclade TSV, which is empty if there was nothing to align"""
+    with open(path, encoding="utf-8", newline="") as file:
+        for row in csv.DictReader(file, delimiter="\t"):
+            yield row["seqName"], row["alignmentScore"]
+
+
+def classified_segments(classification: str) -> Iterator[tuple[str, str | None]]:
+    """(id, segment) of each sequence, in the order of the FASTA they were classified from"""
+    with open(classification, "rb") as file:
+        for entry in map(orjson.loads, file):
+            yield entry["id"], entry["segment"]
+
+
+def misaligned(classification: str, segment_results: dict[str, str], segment: str) -> set[str]:
+    """Ids of sequences that were assigned to another segment but don't align to it"""
+    assigned = dict(classified_segments(classification))
+    return {
+        id
+        for other, path in segment_results.items()
+        if other != segment
+        for id, score in nextclade_scores(path)
+        if not score and assigned.get(id) == other
+    }
+
+
+def select_fallback(  # noqa: PLR0913, PLR0917
+    sequences: str,
+    segment: str,
+    dataset: str,
+    connection: sqlite3.Connection | None,
+    misaligned_ids: set[str],
+    to_align: str,
+    plan: str,
+) -> None:
+    cached = cached_scores(connection, dataset)
+    queued: set[str] = set()
+    total = 0
+    hits = 0
+    with (
+        open(sequences, encoding="utf-8") as f_in,
+        open(to_align, "w", encoding="utf-8") as f_align,
+        open(plan, "wb") as f_plan,
+    ):
+        for title, sequence in SimpleFastaParser(f_in):
+            # Sequences without header have no id, like in calculate_sequence_hashes.py
+            id = title.split(None, 1)[0] if title.strip() else ""
+            if id not in misaligned_ids:
+                continue
+            hash = hashlib.md5(sequence.encode(), usedforsecurity=False).hexdigest()
+            score = cached.get(hash)
+            hits += score is not None
+            if score is None and hash not in queued:
+                queued.add(hash)
+                f_align.write(f">{id}\n{sequence}\n")
+            f_plan.write(orjson.dumps({"id": id, "hash": hash, "alignmentScore": score}) + b"\n")
+            total += 1
+    if total:
+        logger.warning(
+            f"{total} sequences didn't align to the segment they were assigned to, aligning them "
+            f"against {segment} ({hits} cached)"
+        )
+    record_counts(
+        f"select_fallback_alignments_{segment}", misaligned=total, cached=hits, to_align=len(queued)
+    )
+
+
+def select(  # noqa: PLR0913, PLR0917
+    sequences: str,
+    segment: str,
+    dataset: str,
+    connection: sqlite3.Connection | None,
+    classification: str | None,
+    to_align: str,
+    plan: str,
+) -> None:
+    cached = cached_scores(connection, dataset)
+    queued: set[str] = set()
+    total = 0
+    hits = 0
+    skipped = 0
+    with (
+        open(sequences, encoding="utf-8") as f_in,
+        open(to_align, "w", encoding="utf-8") as f_align,
+        open(plan, "wb") as f_plan,
+    ):
+        # Sequences without header are skipped like in calculate_sequence_hashes.py
+        fasta = ((title, sequence) for title, sequence in SimpleFastaParser(f_in) if title.strip())
+        records = (
+            zip(fasta, classified_segments(classification), strict=True)
+            if classification
+            else zip(fasta, repeat(None))
+        )
+        for (title, sequence), classified in records:
+            # Same ids and hashes as calculate_sequence_hashes.py
+            id = title.split(None, 1)[0]
+            hash = hashlib.md5(sequence.encode(), usedforsecurity=False).hexdigest()
+            score = cached.get(hash)
+            hits += score is not None
+            if classified is not None:
+                if classified[0] != id:
+                    msg = f"Classification of {classified[0]} doesn't match sequence {id}"
+                    raise ValueError(msg)
+                if score is None and classified[1] not in {None, segment}:
+                    score = ""
+                    skipped += 1
+            if score is None and hash not in queued:
+                queued.add(hash)
+                f_align.write(f">{id}\n{sequence}\n")
+            f_plan.write(orjson.dumps({"id": id, "hash": hash, "alignmentScore": score}) + b"\n")
+            total += 1
+    logger.info(
+        f"Results of {hits} of {total} sequences are cached, {skipped} belong to other segments, "
+        f"{len(queued)} distinct sequences to align"
+    )
+    record_counts(
+        f"select_sequences_to_align_{segment}",
+        sequences=total,
+        cached=hits,
+        other_segment=skipped,
+        to_align=len(queued),
+    )
+
+
+def merge(  # noqa: PLR0913, PLR0917
+    plan: str,
+    segment: str,
+    aligned: str,
+    dataset: str,
+    connection: sqlite3.Connection | None,
+    output: str,
+    step: str = "merge_alignments",
+) -> None:
+    # Only the first sequence of each hash was aligned, map its results to the hash
+    fresh_by_id = dict(nextclade_scores(aligned))
+    fresh: dict[str, str] = {}
+    total = 0
+    with (
+        open(plan, "rb") as f_plan,
+        open(output, "w", encoding="utf-8", newline="") as f_out,
+    ):
+        writer = csv.writer(f_out, delimiter="\t", lineterminator="\n")
+        writer.writerow(["seqName", "alignmentScore"])
+        for entry in map(orjson.loads, f_plan):
+            score = entry["alignmentScore"]
+            if score is None:
+                if entry["id"] in fresh_by_id:
+                    fresh[entry["hash"]] = fresh_by_id[entry["id"]]
+                # Sequences without nextclade result are dropped by process_alignments as before
+                score = fresh.get(entry["hash"], "")
+            writer.writerow([entry["id"], score])
+            total += 1
+    record_counts(f"{step}_{segment}", sequences=total, aligned=len(fresh_by_id))
+
+    if connection is None:
+        return
+    # Results of other dataset versions can't be used anymore
+    connection.execute("DELETE FROM alignments WHERE dataset != ?", (dataset,))
+    connection.executemany(
+        "INSERT OR REPLACE INTO alignments VALUES (?, ?, ?)",
+        ((hash, dataset, score) for hash, score in fresh.items()),
+    )
+    connection.commit()
+    logger.info(f"Added {len(fresh)} alignment results to the cache")
+
+
+@click.command()
+@click.option("--mode", required=True, type=click.Choice(["select", "merge"]))
+@click.option("--segment", required=True)
+@click.option("--dataset", required=True, type=click.Path(exists=True, file_okay=False))
+@click.option(
+    "--cache-dir",
+    required=False,
+    type=click.Path(file_okay=False),
+    help="Directory with the cached results, on a persistent volume. Without it nothing is cached",
+)
+@click.option(
+    "--classification",
+    required=False,
+    type=click.Path(exists=True),
+    help="Segment of each sequence from classify_segments.py, for --mode select",
+)
+@click.option(
+    "--fallback",
+    is_flag=True,
+    help="Only sequences that didn't align to the segment they were assigned to",
+)
+@click.option(
+    "--segment-results",
+    multiple=True,
+    help="Merged nextclade TSV of each segment as segment=path, for --mode select --fallback",
+)
+@click.option("--plan", required=True, type=click.Path())
+@click.option("--sequences", required=False, type=click.Path(exists=True))
+@click.option(
+    "--to-align",
+    required=True,
+    type=click.Path(),
+    help="FASTA of sequences to align with nextclade (select) or the nextclade TSV of them (merge)",
+)
+@click.option("--output", required=False, type=click.Path(), help="Merged nextclade TSV")
+@click.option(
+    "--log-level",
+    default="INFO",
+    type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]),
+)
+def main(  # noqa: PLR0913, PLR0917
+    mode: str,
+    segment: str,
+    dataset: str,
+    cache_dir: str | None,
+    classification: str | None,
+    fallback: bool,
+    segment_results: tuple[str, ...],
+    plan: str,
+    sequences: str | None,
+    to_align: str,
+    output: str | None,
+    log_level: str,
+) -> None:
+    logger.setLevel(log_level)
+    if fallback and mode == "select" and not classification:
+        msg = "--classification is required with --mode select --fallback"
+        raise click.UsageError(msg)
+
+    digest = dataset_digest(dataset)
+    logger.info(f"Segment {segment}: dataset digest {digest}")
+    connection = open_cache(cache_dir, segment)
+    if mode == "select":
+        if not sequences:
+            msg = "--sequences is required with --mode select"
+            raise click.UsageError(msg)
+        if fallback and classification:
+            results = dict(result.split("=", 1) for result in segment_results)
+            ids = misaligned(classification, results, segment)
+            select_fallback(sequences, segment, digest, connection, ids, to_align, plan)
+        else:
+            select(sequences, segment, digest, connection, classification, to_align, plan)
+    else:
+        if not output:
+            msg = "--output is required with --mode merge"
+            raise click.UsageError(msg)
+        step = "merge_fallback_alignments" if fallback else "merge_alignments"
+        merge(plan, segment, to_align, digest, connection, output, step)
+    if connection is not None:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
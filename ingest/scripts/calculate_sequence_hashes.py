@@ -1,11 +1,24 @@
-"""For each downloaded sequences calculate md5 hash and put into JSON"""
+"""
+For each downloaded sequences calculate md5 hash and put into JSON.
+With --filter-fasta-headers, also write the sequences whose header matches the regex to a FASTA file
+in the same pass, hashes and the sequence NDJSON always contain all sequences.
+"""
 
 import hashlib
 import logging
+import re
+from collections import deque
+from collections.abc import Iterator
+from contextlib import nullcontext
+from itertools import batched
+from multiprocessing import Pool
+from multiprocessing.pool import AsyncResult
 
 import click
-import orjsonl
-from Bio import SeqIO
+import orjson
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from run_report import record_counts
+from xopen import xopen
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -15,33 +28,130 @@ logging.basicConfig(
     datefmt="%H:%M:%S",
 )
 
+# Records per task sent to the hashing processes
+CHUNK_SIZE = 1000
+CHUNKS_IN_FLIGHT_PER_PROCESS = 4
+
+
+def md5_hashes(sequences: tuple[str, ...]) -> list[str]:
+    return [
+        hashlib.md5(sequence.encode(), usedforsecurity=False).hexdigest() for sequence in sequences
+    ]
+
+
+def hashed_chunks(
+    chunks: Iterator[tuple[tuple[str, str], ...]], processes: int
+) -> Iterator[tuple[tuple[tuple[str, str], ...], list[str]]]:
+    """Hash the sequences of each chunk of (id, sequence) records, in input order"""
+    if processes <= 1:
+        for chunk in chunks:
+            yield chunk, md5_hashes(tuple(sequence for _, sequence in chunk))
+        return
+    with Pool(processes) as pool:
+        # Bounded number of chunks in flight, so the input isn't read into memory ahead of output
+        in_flight: deque[tuple[tuple[tuple[str, str], ...], AsyncResult[list[str]]]] = deque()
+        for chunk in chunks:
+            sequences = tuple(sequence for _, sequence in chunk)
+            in_flight.append((chunk, pool.apply_async(md5_hashes, (sequences,))))
+            if len(in_flight) >= processes * CHUNKS_IN_FLIGHT_PER_PROCESS:
+                done, result = in_flight.popleft()
+                yield done, result.get()
+        while in_flight:
+            done, result = in_flight.popleft()
+            yield done, result.get()
+
 
 @click.command()
 @click.option("--input", required=True, type=click.Path(exists=True))
-@click.option("--output-hashes", required=True, type=click.Path())
-@click.option("--output-sequences", required=True, type=click.Path())
+@click.option(
+    "--output-hashes",
+    required=True,
+    type=click.Path(),
+    help="Compressed if the path ends with e.g. .gz or .zst",
+)
+@click.option(
+    "--output-sequences",
+    required=True,
+    type=click.Path(),
+    help="Compressed if the path ends with e.g. .gz or .zst",
+)
+@click.option(
+    "--filter-fasta-headers",
+    default=None,
+    help="Regex, write sequences whose FASTA header matches it to --output-filtered",
+)
+@click.option("--output-filtered", default=None, type=click.Path())
+@click.option("--processes", default=1, type=int, help="Number of processes calculating hashes")
 @click.option(
     "--log-level",
     default="INFO",
     type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]),
 )
-def main(input: str, output_hashes: str, output_sequences: str, log_level: str) -> None:
+def main(
+    input: str,
+    output_hashes: str,
+    output_sequences: str,
+    filter_fasta_headers: str | None,
+    output_filtered: str | None,
+    processes: int,
+    log_level: str,
+) -> None:
     logger.setLevel(log_level)
     logging.getLogger("requests").setLevel(logging.WARNING)
     logging.getLogger("urllib3").setLevel(logging.WARNING)
 
+    if bool(filter_fasta_headers) != bool(output_filtered):
+        msg = "--filter-fasta-headers and --output-filtered must be given together"
+        raise click.UsageError(msg)
+    header_filter = re.compile(filter_fasta_headers) if filter_fasta_headers else None
+
     counter = 0
+    found = 0
+    empty_headers = 0
 
-    with open(input, encoding="utf-8") as f_in:
-        records = SeqIO.parse(f_in, "fasta")
-        for record in records:
-            sequence = str(record.seq)
-            hash = hashlib.md5(sequence.encode(), usedforsecurity=False).hexdigest()
-            orjsonl.append(output_hashes, {"id": record.id, "hash": hash})
-            orjsonl.append(output_sequences, {"id": record.id, "sequence": sequence})
-            counter += 1
+    with (
+        open(input, encoding="utf-8") as f_in,
+        xopen(output_hashes, "wb", threads=0) as hashes_out,
+        xopen(output_sequences, "wb", threads=0) as sequences_out,
+        xopen(output_filtered, "wb", threads=0) if output_filtered else nullcontext() as filtered,
+    ):
+        for chunk, hashes in hashed_chunks(batched(SimpleFastaParser(f_in), CHUNK_SIZE), processes):
+            hash_lines = []
+            sequence_lines = []
+            filtered_records = []
+            for (title, sequence), hash in zip(chunk, hashes, strict=True):
+                if not title.strip():
+                    logger.warning(f"Skipping sequence without FASTA header: {sequence[:20]}...")
+                    empty_headers += 1
+                    continue
+                counter += 1
+                # Same ids as Bio.SeqIO.parse: the header up to the first whitespace
+                id = title.split(None, 1)[0]
+                hash_lines.append(orjson.dumps({"id": id, "hash": hash}))
+                sequence_lines.append(orjson.dumps({"id": id, "sequence": sequence}))
+                if header_filter and header_filter.search(title):
+                    filtered_records.append(f">{id}\n{sequence}\n")
+            if hash_lines:
+                hashes_out.write(b"\n".join(hash_lines) + b"\n")
+                sequences_out.write(b"\n".join(sequence_lines) + b"\n")
+            if filtered:
+                filtered.write("".join(filtered_records).encode())
+            found += len(filtered_records)
 
     logger.info(f"Calculated hashes for {counter} sequences")
+    if empty_headers:
+        logger.warning(f"Skipped {empty_headers} sequences without FASTA header")
+    record_counts(
+        "calculate_sequence_hashes",
+        sequences=counter,
+        **({"empty_header": empty_headers} if empty_headers else {}),
+        **({"matching_header_filter": found} if header_filter else {}),
+    )
+    if header_filter:
+        logger.info(
+            f"Discarded {counter - found} out of {counter} sequences, as they did not contain "
+            f"the filter_fasta_headers: {filter_fasta_headers}."
+        )
 
 
 if __name__ == "__main__":
@@ -1,19 +1,33 @@
+import atexit
+import csv
+import hashlib
+import io
 import json
 import logging
 import os
+import threading
 from collections import defaultdict
+from collections.abc import Callable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from dataclasses import dataclass
-from datetime import datetime, timedelta
 from http import HTTPMethod
+from itertools import batched
 from pathlib import Path
-from time import sleep
-from typing import Any, Literal
+from time import monotonic, sleep
+from typing import Any, Literal, TextIO
 
 import click
+import ijson
 import jsonlines
-import pytz
 import requests
 import yaml
+from loculus_client import LoculusClient, iter_json_lines
+from submission_store import (
+    APPROVED_FOR_RELEASE,
+    OriginalMetadataCache,
+    SubmissionStoreWriter,
+    is_sqlite,
+)
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -23,7 +37,15 @@ logging.basicConfig(
     datefmt="%H:%M:%S",
 )
 
-_start_time: datetime | None = None
+UNAPPROVED_STATUSES = ["RECEIVED", "IN_PROCESSING", "HAS_ERRORS", "AWAITING_APPROVAL"]
+# Entries that can still become approvable, HAS_ERRORS entries can't be approved
+PENDING_STATUSES = ["RECEIVED", "IN_PROCESSING"]
+
+# Interval between checks of the status counts while waiting for preprocessing
+APPROVE_MIN_WAIT_SECONDS = 5
+APPROVE_MAX_WAIT_SECONDS = 60
+# 423 while the backend is still processing earlier submissions, retried every 30s for 30 minutes
+LOCKED_MAX_RETRIES = 60
 
 
 @dataclass
@@ -37,6 +59,8 @@ class Config:
     group_name: str
     nucleotide_sequences: list[str]
     segmented: bool
+    submit_chunk_size: int
+    submit_parallel_uploads: int
 
 
 def backend_url(config: Config) -> str:
@@ -48,30 +72,30 @@ def organism_url(config: Config) -> str:
     return f"{backend_url(config)}/{config.organism.strip('/')}"
 
 
-def get_jwt(config: Config) -> str:
-    """
-    Get a JWT token for the given username and password
-    """
-
-    keycloak_ingest_password = os.getenv("KEYCLOAK_INGEST_PASSWORD")
-    if not keycloak_ingest_password:
-        keycloak_ingest_password = config.password
-
-    data = {
-        "username": config.username,
-        "password": keycloak_ingest_password,
-        "grant_type": "password",
-        "client_id": config.keycloak_client_id,
-    }
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-
-    keycloak_token_url = config.keycloak_token_url
-
-    response = requests.post(keycloak_token_url, data=data, headers=headers, timeout=600)
-    response.raise_for_status()
-
-    jwt_keycloak = response.json()
-    return jwt_keycloak["access_token"]
+# Per Keycloak user, like the tokens they cache
+_clients: dict[tuple[str, str], LoculusClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(config: Config) -> LoculusClient:
+    """Client shared by all requests, so that connections and the Keycloak token are reused"""
+    key = (config.keycloak_token_url, config.username)
+    with _clients_lock:
+        if key not in _clients:
+            keycloak_ingest_password = os.getenv("KEYCLOAK_INGEST_PASSWORD")
+            if not keycloak_ingest_password:
+                keycloak_ingest_password = config.password
+            client = LoculusClient(
+                keycloak_token_url=config.keycloak_token_url,
+                keycloak_client_id=config.keycloak_client_id,
+                username=config.username,
+                password=keycloak_ingest_password,
+                timeout=600,
+                max_locked_retries=LOCKED_MAX_RETRIES,
+            )
+            atexit.register(client.log_metrics)
+            _clients[key] = client
+        return _clients[key]
 
 
 def make_request(  # noqa: PLR0913, PLR0917
@@ -81,46 +105,20 @@ def make_request(  # noqa: PLR0913, PLR0917
     params: dict[str, Any] | None = None,
     files: dict[str, Any] | None = None,
     json_body: dict[str, Any] | None = None,
+    stream: bool = False,
 ) -> requests.Response:
     """
     Generic request function to handle repetitive tasks like fetching JWT and setting headers.
     """
-    jwt = get_jwt(config)
-    headers = {"Authorization": f"Bearer {jwt}", "Content-Type": "application/json"}
-    timeout = 600
-    match method:
-        case HTTPMethod.GET:
-            response = requests.get(url, headers=headers, params=params, timeout=timeout)
-        case HTTPMethod.POST:
-            if files:
-                headers.pop("Content-Type")  # Remove content-type for multipart/form-data
-                response = requests.post(
-                    url, headers=headers, files=files, data=params, timeout=timeout
-                )
-            else:
-                response = requests.post(
-                    url, headers=headers, json=json_body, params=params, timeout=timeout
-                )
-        case _:
-            msg = f"Unsupported HTTP method: {method}"
-            raise ValueError(msg)
-
-    if response.status_code == 423:
-        logger.warning(f"Got 423 from {url}. Retrying after 30 seconds.")
-        sleep(30)
-        return make_request(method, url, config, params, files, json_body)
-
-    if not response.ok:
-        error_message = (
-            f"Request failed:\n"
-            f"URL: {url}\n"
-            f"Method: {method}\n"
-            f"Status Code: {getattr(response, 'status_code', 'N/A')}\n"
-            f"Response Content: {getattr(response, 'text', 'N/A')}"
-        )
-        logger.error(error_message)
-        response.raise_for_status()
-    return response
+    return get_client(config).request(
+        method,
+        url,
+        headers={"Content-Type": "application/json"},
+        params=params,
+        files=files,
+        json_body=json_body,
+        stream=stream,
+    )
 
 
 def create_group(config: Config) -> str:
@@ -171,12 +169,157 @@ def get_or_create_group(config: Config, allow_creation: bool = False) -> str:
     return create_group(config)
 
 
-def submit_or_revise(
-    metadata, sequences, config: Config, group_id, mode=Literal["submit", "revise"]
+@dataclass
+class Chunk:
+    """Metadata rows and their sequences, all segments of an entry are in the same chunk"""
+
+    index: int
+    metadata: bytes
+    sequences: bytes
+    submission_ids: list[str]
+
+    @property
+    def key(self) -> str:
+        """Identifies the chunk in the checkpoint, independent of its position"""
+        return hashlib.md5(
+            "\n".join(self.submission_ids).encode(), usedforsecurity=False
+        ).hexdigest()
+
+
+def fasta_index(sequences) -> dict[str, tuple[int, int]]:
+    """Byte range of each record of a FASTA file by id"""
+    index: dict[str, tuple[int, int]] = {}
+    current_id = None
+    start = 0
+    offset = 0
+    with open(sequences, "rb") as file:
+        for line in file:
+            if line.startswith(b">"):
+                if current_id is not None:
+                    index[current_id] = (start, offset)
+                current_id = line[1:].split(maxsplit=1)[0].decode()
+                start = offset
+            offset += len(line)
+    if current_id is not None:
+        index[current_id] = (start, offset)
+    return index
+
+
+def iter_chunks(metadata, sequences, config: Config, chunk_size: int) -> Iterator[Chunk]:
+    """Split metadata TSV and FASTA into chunks of `chunk_size` entries, 0 for a single chunk"""
+    sequence_ranges = fasta_index(sequences)
+    with (
+        open(metadata, encoding="utf-8", newline="") as metadata_file,
+        open(sequences, "rb") as sequences_file,
+    ):
+        reader = csv.reader(metadata_file, delimiter="\t")
+        header = next(reader)
+        submission_id_column = header.index("submissionId")
+        chunks = [list(reader)] if chunk_size <= 0 else batched(reader, chunk_size)
+        for index, chunk_rows in enumerate(chunks):
+            metadata_buffer = io.StringIO()
+            writer = csv.writer(metadata_buffer, delimiter="\t")
+            writer.writerow(header)
+            writer.writerows(chunk_rows)
+            submission_ids = [row[submission_id_column] for row in chunk_rows]
+            sequence_parts = []
+            for submission_id in submission_ids:
+                if config.segmented:
+                    fasta_ids = [
+                        f"{submission_id}_{segment}" for segment in config.nucleotide_sequences
+                    ]
+                else:
+                    fasta_ids = [submission_id]
+                for fasta_id in fasta_ids:
+                    if fasta_id not in sequence_ranges:
+                        continue
+                    start, end = sequence_ranges[fasta_id]
+                    sequences_file.seek(start)
+                    sequence_parts.append(sequences_file.read(end - start))
+            yield Chunk(
+                index=index,
+                metadata=metadata_buffer.getvalue().encode(),
+                sequences=b"".join(sequence_parts),
+                submission_ids=submission_ids,
+            )
+
+
+def read_checkpoint(checkpoint) -> dict[str, list[dict[str, Any]]]:
+    """Responses of chunks that were completed by an earlier attempt"""
+    if not checkpoint or not Path(checkpoint).exists():
+        return {}
+    with jsonlines.open(checkpoint) as reader:
+        return {line["chunk"]: line["response"] for line in reader}
+
+
+def upload_chunks(
+    chunks: Iterator[Chunk],
+    upload: Callable[[Chunk], list[dict[str, Any]]],
+    parallel_uploads: int,
+    checkpoint: str | None,
+) -> list[dict[str, Any]]:
+    """Upload chunks concurrently, skipping those completed according to the checkpoint.
+    Returns the concatenated responses in chunk order."""
+    completed = read_checkpoint(checkpoint)
+    responses: dict[int, list[dict[str, Any]]] = {}
+    errors: list[Exception] = []
+    in_flight: dict[Future, Chunk] = {}
+
+    def collect(done: set[Future], checkpoint_file: TextIO) -> None:
+        for future in done:
+            chunk = in_flight.pop(future)
+            try:
+                responses[chunk.index] = future.result()
+            except Exception as e:
+                logger.error(f"Upload of chunk {chunk.index} failed: {e}")
+                errors.append(e)
+                continue
+            line = {"chunk": chunk.key, "response": responses[chunk.index]}
+            checkpoint_file.write(json.dumps(line) + "\n")
+            checkpoint_file.flush()
+
+    with (
+        ThreadPoolExecutor(max_workers=parallel_uploads) as executor,
+        open(checkpoint or os.devnull, "a", encoding="utf-8") as checkpoint_file,
+    ):
+        # Chunks are only read once an upload slot is free
+        for chunk in chunks:
+            if chunk.key in completed:
+                logger.info(f"Skipping chunk {chunk.index}, completed by an earlier attempt")
+                responses[chunk.index] = completed[chunk.key]
+                continue
+            if len(in_flight) >= parallel_uploads:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done, checkpoint_file)
+            # No new uploads after a failure, the rerun continues from the checkpoint
+            if errors:
+                break
+            in_flight[executor.submit(upload, chunk)] = chunk
+        collect(wait(in_flight).done, checkpoint_file)
+
+    if errors:
+        msg = f"{len(errors)} chunk(s) failed, rerun to retry them"
+        raise RuntimeError(msg) from errors[0]
+    if checkpoint:
+        Path(checkpoint).unlink(missing_ok=True)
+    return [entry for index in sorted(responses) for entry in responses[index]]
+
+
+def submit_or_revise(  # noqa: PLR0913, PLR0917
+    metadata,
+    sequences,
+    config: Config,
+    group_id,
+    mode=Literal["submit", "revise"],
+    checkpoint: str | None = None,
 ):
     """
     Submit/revise data to Loculus.
+    Entries are uploaded in chunks of `submit_chunk_size` (0: all at once), up to
+    `submit_parallel_uploads` at a time. Completed chunks are recorded in `checkpoint` and skipped
+    when the upload is restarted.
     """
+    parallel_uploads = max(config.submit_parallel_uploads, 1)
     logging_strings: dict[str, str]
     endpoint: str
     match mode:
@@ -207,15 +350,23 @@ def submit_or_revise(
     if mode == "submit":
         params["dataUseTermsType"] = "OPEN"
 
-    with open(metadata, "rb") as metadata_file, open(sequences, "rb") as sequences_file:
+    def upload(chunk: Chunk) -> list[dict[str, Any]]:
         files = {
-            "metadataFile": metadata_file,
-            "sequenceFile": sequences_file,
+            "metadataFile": ("metadata.tsv", chunk.metadata),
+            "sequenceFile": ("sequences.fasta", chunk.sequences),
         }
         response = make_request(HTTPMethod.POST, url, config, params=params, files=files)
-    logger.debug(f"{logging_strings["noun"]} response: {response.json()}")
+        logger.info(
+            f"{logging_strings['noun']} of chunk {chunk.index} "
+            f"({len(chunk.submission_ids)} entries) completed"
+        )
+        return response.json()
 
-    return response.json()
+    chunks = iter_chunks(metadata, sequences, config, config.submit_chunk_size)
+    response = upload_chunks(chunks, upload, parallel_uploads, checkpoint)
+    logger.debug(f"{logging_strings['noun']} response: {response}")
+
+    return response
 
 
 def regroup_and_revoke(metadata, sequences, map, config: Config, group_id):
@@ -261,27 +412,193 @@ def get_sequence_status(config: Config):
         "organism": config.organism,
     }
 
-    response = make_request(HTTPMethod.GET, url, config, params=params)
+    response = make_request(HTTPMethod.GET, url, config, params=params, stream=True)
+    response.raw.decode_content = True
 
     # Turn into dict with {accession: {version: status}}
     result = defaultdict(dict)
-    entries = []
     try:
-        entries = response.json()["sequenceEntries"]
-    except requests.JSONDecodeError:
-        logger.warning(f"Error decoding JSON of /get-sequences: {response.text}")
-    for entry in entries:
-        accession = entry["accession"]
-        version = entry["version"]
-        status = entry["status"]
-        result[accession][version] = status
+        for entry in ijson.items(response.raw, "sequenceEntries.item"):
+            accession = entry["accession"]
+            version = entry["version"]
+            status = entry["status"]
+            result[accession][version] = status
+    except ijson.JSONError as err:
+        logger.warning(f"Error decoding JSON of /get-sequences: {err}")
 
     return result
 
 
-def get_submitted(config: Config):
+def get_status_counts(config: Config) -> dict[str, int]:
+    """Number of sequence entries of the user's groups in each status"""
+    url = f"{organism_url(config)}/get-sequences"
+
+    # statusCounts don't depend on the page, so request as few entries as possible
+    params = {"page": 0, "size": 1}
+
+    response = make_request(HTTPMethod.GET, url, config, params=params)
+
+    return response.json()["statusCounts"]
+
+
+def finished_in_this_run(flag: str, run_started: float) -> bool:
+    path = Path(flag)
+    return path.exists() and path.stat().st_mtime >= run_started
+
+
+def approve_until_done(
+    config: Config, timeout_minutes: int, wait_for: tuple[str, ...], run_started: float
+) -> None:
+    """
+    Approve entries as soon as preprocessing has processed them. Stops once all `wait_for` flag
+    files were written in this run (i.e. submitting is done) and no entries are left to approve,
+    or after `timeout_minutes`. Without `wait_for` it only stops after the timeout.
+    """
+    deadline = monotonic() + timeout_minutes * 60
+    wait_seconds = APPROVE_MIN_WAIT_SECONDS
+    total_approved = 0
+    while True:
+        counts = get_status_counts(config)
+        awaiting_approval = counts.get("AWAITING_APPROVAL", 0)
+        pending = sum(counts.get(status, 0) for status in PENDING_STATUSES)
+        logger.debug(f"Status counts: {counts}")
+
+        approved = 0
+        if awaiting_approval:
+            logger.info("Approving sequences")
+            approved = len(approve(config))
+            total_approved += approved
+            logger.info(f"Approved: {approved} sequences")
+        elif (
+            not pending
+            and wait_for
+            and all(finished_in_this_run(flag, run_started) for flag in wait_for)
+        ):
+            logger.info(f"No sequences left to approve, approved {total_approved} in total")
+            return
+
+        # Check again soon while preprocessing is making progress, back off while it's idle
+        if approved:
+            wait_seconds = APPROVE_MIN_WAIT_SECONDS
+        if monotonic() + wait_seconds > deadline:
+            logger.info(
+                f"Approve timeout reached with {pending} sequences in processing, "
+                f"approved {total_approved} in total"
+            )
+            return
+        sleep(wait_seconds)
+        if not approved:
+            wait_seconds = min(wait_seconds * 2, APPROVE_MAX_WAIT_SECONDS)
+
+
+def get_original_metadata(
+    config: Config, fields: list[str], statuses_filter: list[str] | None = None
+) -> Iterator[dict[str, Any]]:
+    """Request /get-original-metadata, the returned iterator streams the entries of the response"""
+    url = f"{organism_url(config)}/get-original-metadata"
+
+    params = {
+        "fields": fields,
+        "groupIdsFilter": [],
+        "statusesFilter": statuses_filter or [],
+    }
+
+    response = make_request(HTTPMethod.GET, url, config, params=params, stream=True)
+
+    return iter_json_lines(response, "/get-original-metadata")
+
+
+def incremental_entries(
+    config: Config,
+    fields: list[str],
+    unapproved_entries: Iterator[dict[str, Any]],
+    statuses: dict[str, dict[int, str]],
+    cache: OriginalMetadataCache,
+) -> Iterator[dict[str, Any]]:
+    """Original metadata of all sequence entry versions: approved versions are read from the cache
+    unless versions were approved since the last run, all others were downloaded"""
+    # Unapproved entries are passed on as they are streamed, only their versions are kept
+    downloaded: set[tuple[str, int]] = set()
+    for entry in unapproved_entries:
+        downloaded.add((entry["accession"], int(entry["version"])))
+        yield entry
+    logger.info(f"Downloaded {len(downloaded)} entries that are not approved")
+    cached = cache.versions()
+    newly_approved = 0
+    for accession, versions in statuses.items():
+        for version, status in versions.items():
+            if status == APPROVED_FOR_RELEASE:
+                newly_approved += (accession, version) not in cached
+            elif (accession, version) not in downloaded:
+                # The status changed between the two requests, e.g. it was approved just now.
+                # Entries that are downloaded twice are skipped by get_submitted.
+                logger.info(f"Status of {accession}.{version} changed, downloading all entries")
+                cache.clear()
+                yield from cache.add_approved(get_original_metadata(config, fields), statuses)
+                return
+    if not newly_approved:
+        logger.info("No versions were approved since the last run, using cached approved entries")
+        yield from (
+            entry
+            for entry in cache.entries()
+            if statuses.get(entry["accession"], {}).get(entry["version"]) == APPROVED_FOR_RELEASE
+        )
+        return
+    logger.info(f"{newly_approved} versions were approved since the last run, downloading them")
+    cache.clear()
+    approved = get_original_metadata(config, fields, [APPROVED_FOR_RELEASE])
+    yield from cache.add_approved(approved, statuses)
+
+
+def insdc_accession_keys(config: Config) -> list[str]:
+    if config.segmented:
+        return ["insdcAccessionBase" + "_" + segment for segment in config.nucleotide_sequences]
+    return ["insdcAccessionBase"]
+
+
+def insdc_accessions_of(original_metadata: dict[str, str], config: Config) -> tuple[list[str], str]:
+    """INSDC accessions of the segments and their joint accession"""
+    if not config.segmented:
+        insdc_accession = original_metadata.get("insdcAccessionBase", "")
+        return [insdc_accession], insdc_accession
+    insdc_key = insdc_accession_keys(config)
+    insdc_accessions = [original_metadata[key] for key in insdc_key if original_metadata[key]]
+    joint_accession = "/".join(
+        [
+            f"{original_metadata[key]}.{segment}"
+            for key, segment in zip(insdc_key, config.nucleotide_sequences)
+            if original_metadata[key]
+        ]
+    )
+    return insdc_accessions, joint_accession
+
+
+def get_entries_and_statuses(
+    config: Config, fields: list[str], cache: OriginalMetadataCache | None
+) -> tuple[Iterator[dict[str, Any]], dict[str, dict[int, str]]]:
+    """Original metadata entries (streamed) and statuses of all sequence entry versions"""
+    # The statuses are requested while the backend streams the original metadata
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        statuses_future = executor.submit(get_sequence_status, config)
+        entries = get_original_metadata(config, fields, UNAPPROVED_STATUSES if cache else None)
+        statuses: dict[str, dict[int, str]] = statuses_future.result()
+
+    logger.info(f"Backend has status of: {len(statuses)} sequence entries from ingest")
+
+    if cache:
+        entries = incremental_entries(config, fields, entries, statuses, cache)
+    return entries, statuses
+
+
+def get_submitted(
+    config: Config,
+    store: SubmissionStoreWriter | None = None,
+    cache_path: str | None = None,
+):
     """Get previously submitted sequences
     This way we can avoid submitting the same sequences again
+    With `store` the versions are added to the SQLite store instead of the returned dictionary
+    With `cache_path` the original metadata of approved versions is kept between runs
     Output is a dictionary with INSDC accession as key
     concrete_insdc_accession:
         loculus_accession: abcd
@@ -295,69 +612,41 @@ def get_submitted(config: Config):
     ...
     """
 
-    url = f"{organism_url(config)}/get-original-metadata"
-
-    if config.segmented:
-        insdc_key = [
-            "insdcAccessionBase" + "_" + segment for segment in config.nucleotide_sequences
-        ]
-    else:
-        insdc_key = ["insdcAccessionBase"]
-
-    fields = ["hash", *insdc_key]
-
-    params = {
-        "fields": fields,
-        "groupIdsFilter": [],
-        "statusesFilter": [],
-    }
+    fields = ["hash", *insdc_accession_keys(config)]
 
     logger.info("Getting previously submitted sequences")
 
-    response = make_request(HTTPMethod.GET, url, config, params=params)
+    cache = OriginalMetadataCache(cache_path, fields) if cache_path else None
 
-    entries: list[dict[str, Any]] = []
-    try:
-        entries = list(jsonlines.Reader(response.iter_lines()).iter())
-    except jsonlines.Error as err:
-        response_summary = response.text
-        max_error_length = 100
-        if len(response_summary) > max_error_length:
-            response_summary = response_summary[:50] + "\n[..]\n" + response_summary[-50:]
-        logger.error(f"Error decoding JSON from /get-original-metadata: {response_summary}")
-        raise ValueError from err
+    entries, statuses = get_entries_and_statuses(config, fields, cache)
 
     # Initialize the dictionary to store results
     submitted_dict: dict[str, dict[str, str | list]] = {}
+    # Versions can be downloaded twice if they are approved while they are downloaded
+    seen_versions: set[tuple[str, int]] = set()
 
-    statuses: dict[str, dict[int, str]] = get_sequence_status(config)
-
-    logger.info(f"Backend has status of: {len(statuses)} sequence entries from ingest")
-    logger.info(f"Ingest has submitted: {len(entries)} sequence entries to ingest")
-
-    logger.debug(entries)
-    logger.debug(statuses)
     for entry in entries:
         loculus_accession = entry["accession"]
         loculus_version = int(entry["version"])
+        if (loculus_accession, loculus_version) in seen_versions:
+            continue
+        seen_versions.add((loculus_accession, loculus_version))
         original_metadata: dict[str, str] = entry["originalMetadata"]
         hash_value = original_metadata.get("hash", "")
-        if config.segmented:
-            insdc_accessions = [
-                original_metadata[key] for key in insdc_key if original_metadata[key]
-            ]
-            joint_accession = "/".join(
-                [
-                    f"{original_metadata[key]}.{segment}"
-                    for key, segment in zip(insdc_key, config.nucleotide_sequences)
-                    if original_metadata[key]
-                ]
-            )
-        else:
-            insdc_accessions = [original_metadata.get("insdcAccessionBase", "")]
-            joint_accession = original_metadata.get("insdcAccessionBase", "")
+        status = statuses[loculus_accession][loculus_version]
+        insdc_accessions, joint_accession = insdc_accessions_of(original_metadata, config)
 
         for insdc_accession in insdc_accessions:
+            if store:
+                store.add_version(
+                    insdc_accession,
+                    loculus_accession,
+                    joint_accession,
+                    loculus_version,
+                    hash_value,
+                    status,
+                )
+                continue
             if insdc_accession not in submitted_dict:
                 submitted_dict[insdc_accession] = {
                     "loculus_accession": loculus_accession,
@@ -377,12 +666,17 @@ def get_submitted(config: Config):
                 {
                     "version": loculus_version,
                     "hash": hash_value,
-                    "status": statuses[loculus_accession][loculus_version],
+                    "status": status,
                     "jointAccession": joint_accession,
                 }
             )
 
-    logger.info(f"Got info on {len(submitted_dict)} previously submitted sequences/accessions")
+    if cache:
+        cache.close()
+
+    logger.info(f"Ingest has submitted: {len(seen_versions)} sequence entries to ingest")
+    number_submitted = store.count() if store else len(submitted_dict)
+    logger.info(f"Got info on {number_submitted} previously submitted sequences/accessions")
 
     return submitted_dict
 
@@ -428,13 +722,48 @@ def get_submitted(config: Config):
     required=False,
     type=int,
 )
-def submit_to_loculus(
-    metadata, sequences, mode, log_level, config_file, output, revoke_map, approve_timeout
+@click.option(
+    "--wait-for",
+    multiple=True,
+    type=click.Path(),
+    help="Flag file of a rule that submits entries, approve stops early once all of them exist",
+)
+@click.option(
+    "--run-started",
+    default=0.0,
+    type=float,
+    envvar="INGEST_RUN_STARTED",
+    help="Start of the workflow run (epoch seconds), older --wait-for flags are ignored",
+)
+@click.option(
+    "--checkpoint",
+    required=False,
+    type=click.Path(),
+    help="File recording uploaded chunks, so that a restarted submit/revise skips them",
+)
+@click.option(
+    "--original-metadata-cache",
+    required=False,
+    type=click.Path(),
+    help="SQLite file to keep original metadata of approved versions in between runs",
+)
+def submit_to_loculus(  # noqa: PLR0913, PLR0917
+    metadata,
+    sequences,
+    mode,
+    log_level,
+    config_file,
+    output,
+    revoke_map,
+    approve_timeout,
+    wait_for,
+    run_started,
+    checkpoint,
+    original_metadata_cache,
 ):
     """
     Submit data to Loculus.
     """
-    global _start_time
     logger.setLevel(log_level)
     logging.getLogger("requests").setLevel(logging.WARNING)
     logging.getLogger("urllib3").setLevel(logging.WARNING)
@@ -462,19 +791,13 @@ def submit_to_loculus(
         except ValueError as e:
             logger.error(f"Aborting {mode} due to error: {e}")
             return
-        response = submit_or_revise(metadata, sequences, config, group_id, mode=mode)
+        response = submit_or_revise(
+            metadata, sequences, config, group_id, mode=mode, checkpoint=checkpoint
+        )
         logging.info(f"Completed {mode}")
 
     if mode == "approve":
-        while True:
-            if not _start_time:
-                _start_time = datetime.now(tz=pytz.utc)
-            logger.info("Approving sequences")
-            response = approve(config)
-            logger.info(f"Approved: {len(response)} sequences")
-            sleep(30)
-            if datetime.now(tz=pytz.utc) - timedelta(minutes=approve_timeout) > _start_time:
-                break
+        approve_until_done(config, approve_timeout, wait_for, run_started)
 
     if mode == "regroup-and-revoke":
         try:
@@ -488,8 +811,15 @@ def submit_to_loculus(
 
     if mode == "get-submitted":
         logger.info("Getting submitted sequences")
-        response = get_submitted(config)
-        Path(output).write_text(json.dumps(response, indent=4, sort_keys=True), encoding="utf-8")
+        if is_sqlite(output):
+            store = SubmissionStoreWriter(output)
+            get_submitted(config, store, original_metadata_cache)
+            store.close()
+        else:
+            response = get_submitted(config, cache_path=original_metadata_cache)
+            Path(output).write_text(
+                json.dumps(response, indent=4, sort_keys=True), encoding="utf-8"
+            )
 
 
 if __name__ == "__main__":
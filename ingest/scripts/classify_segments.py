@@ -0,0 +1,148 @@
+"""
+Guess the segment of each sequence from the k-mers it shares with the reference of each segment.
+
+Aligning every sequence against the dataset of every segment only to find the one segment it
+aligns to is expensive. A sequence is assigned to a segment if a large enough share of its k-mers
+is contained in that segment's reference and clearly more than in any other reference; it is then
+only aligned against that segment. Sequences without a clear segment are aligned against all.
+"""
+
+import json
+import logging
+from pathlib import Path
+
+import click
+import numpy as np
+import orjson
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from run_report import record_counts
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+    encoding="utf-8",
+    level=logging.DEBUG,
+    format="%(asctime)s %(levelname)8s (%(filename)20s:%(lineno)4d) - %(message)s ",
+    datefmt="%H:%M:%S",
+)
+
+KMER_LENGTH = 11
+# Share of a sequence's k-mers that must be in the best matching reference
+MIN_CONTAINMENT = 0.05
+# The best matching reference must contain this many times more k-mers than the second best
+MIN_CONTAINMENT_RATIO = 4
+
+# 2-bit codes of nucleotides, anything else (N, ambiguity codes, gaps) breaks k-mers
+NUCLEOTIDE_CODES = np.full(256, 4, dtype=np.uint64)
+for code, nucleotides in enumerate([b"Aa", b"Cc", b"Gg", b"Tt"]):
+    for nucleotide in nucleotides:
+        NUCLEOTIDE_CODES[nucleotide] = code
+
+
+def kmers(sequence: str, k: int = KMER_LENGTH) -> np.ndarray:
+    """Sorted distinct k-mers of a sequence as integers, skipping those with non-ACGT characters"""
+    codes = NUCLEOTIDE_CODES[np.frombuffer(sequence.encode(), dtype=np.uint8)]
+    count = len(codes) - k + 1
+    if count <= 0:
+        return np.empty(0, dtype=np.uint64)
+    values = np.zeros(count, dtype=np.uint64)
+    invalid = np.zeros(count, dtype=bool)
+    for offset in range(k):
+        window = codes[offset : offset + count]
+        values = (values << np.uint64(2)) | (window & np.uint64(3))
+        invalid |= window > 3  # noqa: PLR2004
+    return np.unique(values[~invalid])
+
+
+def reference_sequence(dataset_dir: str) -> str:
+    """Reference of a nextclade dataset, as listed in its pathogen.json"""
+    root = Path(dataset_dir)
+    pathogen_path = root / "pathogen.json"
+    reference_file = "reference.fasta"
+    if pathogen_path.exists():
+        pathogen = json.loads(pathogen_path.read_text(encoding="utf-8"))
+        reference_file = pathogen.get("files", {}).get("reference", reference_file)
+    with open(root / reference_file, encoding="utf-8") as file:
+        return "".join(sequence for _, sequence in SimpleFastaParser(file))
+
+
+class SegmentClassifier:
+    def __init__(self, references: dict[str, str]) -> None:
+        self.segments = list(references)
+        reference_kmers = [kmers(sequence) for sequence in references.values()]
+        # All reference k-mers, with a bit per segment that contains them
+        self.kmers, inverse = np.unique(np.concatenate(reference_kmers), return_inverse=True)
+        self.segment_bits = np.zeros(len(self.kmers), dtype=np.uint64)
+        start = 0
+        for index, segment_kmers in enumerate(reference_kmers):
+            end = start + len(segment_kmers)
+            self.segment_bits[inverse[start:end]] |= np.uint64(1 << index)
+            start = end
+
+    def containment(self, sequence: str) -> np.ndarray:
+        """Share of the sequence's k-mers contained in the reference of each segment"""
+        query = kmers(sequence)
+        result = np.zeros(len(self.segments))
+        if not len(query) or not len(self.kmers):
+            return result
+        positions = np.minimum(np.searchsorted(self.kmers, query), len(self.kmers) - 1)
+        bits = self.segment_bits[positions[self.kmers[positions] == query]]
+        for index in range(len(self.segments)):
+            result[index] = np.count_nonzero(bits & np.uint64(1 << index))
+        return result / len(query)
+
+    def classify(self, sequence: str) -> str | None:
+        """Segment of the sequence, None if it isn't clear"""
+        containment = self.containment(sequence)
+        ranking = np.argsort(containment)[::-1]
+        best = containment[ranking[0]]
+        second = containment[ranking[1]] if len(ranking) > 1 else 0.0
+        if best < MIN_CONTAINMENT or best < MIN_CONTAINMENT_RATIO * second:
+            return None
+        return self.segments[ranking[0]]
+
+
+@click.command()
+@click.option("--sequences", required=True, type=click.Path(exists=True))
+@click.option(
+    "--dataset",
+    "datasets",
+    required=True,
+    multiple=True,
+    help="Nextclade dataset directory of each segment as segment=path",
+)
+@click.option("--output", required=True, type=click.Path())
+@click.option(
+    "--log-level",
+    default="INFO",
+    type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]),
+)
+def main(sequences: str, datasets: tuple[str, ...], output: str, log_level: str) -> None:
+    logger.setLevel(log_level)
+
+    references = {}
+    for dataset in datasets:
+        segment, path = dataset.split("=", 1)
+        references[segment] = reference_sequence(path)
+    classifier = SegmentClassifier(references)
+
+    counts = dict.fromkeys([*classifier.segments, None], 0)
+    with open(sequences, encoding="utf-8") as f_in, open(output, "wb") as f_out:
+        for title, sequence in SimpleFastaParser(f_in):
+            # Skipped like in calculate_sequence_hashes.py
+            if not title.strip():
+                continue
+            segment = classifier.classify(sequence)
+            counts[segment] += 1
+            id = title.split(None, 1)[0]
+            f_out.write(orjson.dumps({"id": id, "segment": segment}) + b"\n")
+
+    for segment, count in counts.items():
+        logger.info(f"{segment or 'Unclear, aligned against all segments'}: {count} sequences")
+    record_counts(
+        "classify_segments",
+        **{segment or "unclear": count for segment, count in counts.items()},
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,14 @@
 import json
 import logging
-import operator
 from collections import defaultdict
 from dataclasses import dataclass
 from hashlib import md5
 
 import click
 import yaml
+from metadata_io import iter_metadata
+from run_report import record_counts
+from submission_store import PreviousSubmissions
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -73,13 +75,8 @@ def main(
     if debug_hashes:
         config.debug_hashes = True
 
-    submitted: dict = json.load(open(old_hashes, encoding="utf-8"))
-    new_metadata = json.load(open(metadata, encoding="utf-8"))
-
-    # Sort all submitted versions by version number
-    for _, loculus in submitted.items():
-        # TODO: check sort order
-        loculus["versions"] = sorted(loculus["versions"], key=operator.itemgetter("version"))
+    # Looked up per accession, with the latest version precomputed in the SQLite store
+    submitted = PreviousSubmissions(old_hashes)
 
     submit = []  # INSDC accessions to submit
     revise = {}  # Mapping from INSDC accessions to loculus accession of sequences to revise
@@ -90,7 +87,14 @@ def main(
     revoke = {}  # Map of new grouping joint insdc accessions to map of previous state
     # i.e. loculus accessions (to be revoked) and their corresponding old joint insdc accessions
 
-    for fasta_id, record in new_metadata.items():
+    # Only the fields that are compared are read from the metadata
+    if config.segmented:
+        fields = [f"insdcAccessionBase_{segment}" for segment in config.nucleotide_sequences]
+    else:
+        fields = ["insdcAccessionBase"]
+    fields.append("hash")
+
+    for fasta_id, record in iter_metadata(metadata, fields):
         if not config.segmented:
             insdc_accession_base = record["insdcAccessionBase"]
             if not insdc_accession_base:
@@ -103,20 +107,17 @@ def main(
             if not keep:
                 sampled_out.append({fasta_id: insdc_accession_base, "hash": hash_float})
                 continue
-            if insdc_accession_base not in submitted:
+            previous = submitted.get(insdc_accession_base)
+            if previous is None:
                 submit.append(fasta_id)
-            else:
-                latest = submitted[insdc_accession_base]["versions"][-1]
-                if latest["hash"] != record["hash"]:
-                    status = latest["status"]
-                    if status == "APPROVED_FOR_RELEASE":
-                        revise[fasta_id] = submitted[insdc_accession_base]["loculus_accession"]
-                    else:
-                        blocked[status][fasta_id] = submitted[insdc_accession_base][
-                            "loculus_accession"
-                        ]
+            elif previous.latest_hash != record["hash"]:
+                status = previous.latest_status
+                if status == "APPROVED_FOR_RELEASE":
+                    revise[fasta_id] = previous.loculus_accession
                 else:
-                    noop[fasta_id] = submitted[insdc_accession_base]["loculus_accession"]
+                    blocked[status][fasta_id] = previous.loculus_accession
+            else:
+                noop[fasta_id] = previous.loculus_accession
             continue
 
         insdc_keys = [f"insdcAccessionBase_{segment}" for segment in config.nucleotide_sequences]
@@ -141,36 +142,36 @@ def main(
         if not keep:
             sampled_out.append({fasta_id: insdc_accession_base, "hash": hash_float})
             continue
-        if all(accession not in submitted for accession in insdc_accession_base_list):
+        previous_segments = [submitted.get(accession) for accession in insdc_accession_base_list]
+        if all(previous is None for previous in previous_segments):
             submit.append(fasta_id)
             continue
-        if all(accession in submitted for accession in insdc_accession_base_list) and all(
-            submitted[accession]["jointAccession"] == insdc_accession_base
-            for accession in insdc_accession_base_list
+        if all(
+            previous is not None and previous.joint_accession == insdc_accession_base
+            for previous in previous_segments
         ):
             # grouping is the same, can just look at first segment in group
-            accession = insdc_accession_base_list[0]
-            latest = submitted[accession]["versions"][-1]
-            if latest["hash"] != record["hash"]:
-                status = latest["status"]
+            previous = previous_segments[0]
+            if previous.latest_hash != record["hash"]:
+                status = previous.latest_status
                 if status == "APPROVED_FOR_RELEASE":
-                    revise[fasta_id] = submitted[accession]["loculus_accession"]
+                    revise[fasta_id] = previous.loculus_accession
                 else:
-                    blocked[status][fasta_id] = submitted[accession]["loculus_accession"]
+                    blocked[status][fasta_id] = previous.loculus_accession
             else:
-                noop[fasta_id] = submitted[accession]["loculus_accession"]
+                noop[fasta_id] = previous.loculus_accession
             continue
-        old_accessions = {}
-        for accession in insdc_accession_base_list:
-            if accession in submitted:
-                old_accessions[submitted[accession]["loculus_accession"]] = submitted[accession][
-                    "jointAccession"
-                ]
+        old_accessions = {
+            previous.loculus_accession: previous.joint_accession
+            for previous in previous_segments
+            if previous is not None
+        }
         logger.warn(
             "Grouping has changed. Ingest would like to group INSDC samples:"
             f"{insdc_accession_base}, however these were previously grouped as {old_accessions}"
         )
         revoke[fasta_id] = old_accessions
+    submitted.close()
 
     outputs = [
         (submit, to_submit, "Sequences to submit"),
@@ -188,6 +189,15 @@ def main(
         with open(path, "w", encoding="utf-8") as file:
             json.dump(value, file)
         logger.info(f"{text}: {len(value)}")
+    record_counts(
+        "compare_hashes",
+        to_submit=len(submit),
+        to_revise=len(revise),
+        unchanged=len(noop),
+        blocked=sum(len(accessions) for accessions in blocked.values()),
+        sampled_out=len(sampled_out),
+        to_revoke=len(revoke),
+    )
 
 
 if __name__ == "__main__":
@@ -22,13 +22,18 @@ import json
 import logging
 import pathlib
 from collections import defaultdict
+from collections.abc import Iterator
 from dataclasses import dataclass
-from pathlib import Path
+from itertools import batched
 from typing import Final
 
 import click
+import orjson
 import orjsonl
 import yaml
+from metadata_io import Record, iter_metadata, write_metadata
+from run_report import record_counts
+from xopen import xopen
 
 
 def sort_authors(authors: str) -> str:
@@ -64,6 +69,70 @@ class Config:
 # submissionId is actually NCBI accession
 INTRINSICALLY_SEGMENT_SPECIFIC_FIELDS: Final = {"segment", "submissionId"}
 
+# Sequences per write to the grouped sequences output
+LINES_PER_WRITE = 1000
+
+type SegmentName = str
+type Accession = str
+
+
+def group_key_digest(values: Record, shared_fields: list[str]) -> bytes:
+    """Fixed size digest of the non-empty shared field values, segments of the same assembly
+    have the same digest"""
+    # Author order sometimes varies among segments from same isolate
+    # Example: JX999734.1 (L) and JX999735.1 (M)
+    modified_values = values_with_sorted_authors(values)
+    digest = hashlib.md5(usedforsecurity=False)
+    for field in shared_fields:
+        if value := modified_values[field]:
+            digest.update(orjson.dumps([field, value]))
+    return digest.digest()
+
+
+def grouped_row(
+    group: dict[SegmentName, Accession],
+    records: dict[Accession, Record],
+    shared_fields: list[str],
+    insdc_segment_specific_fields: set[str],
+    config: Config,
+) -> tuple[str, Record]:
+    """Joint key and metadata of a group from the metadata records of its segments"""
+    # Create key by concatenating all accession numbers with their segments
+    # e.g. AF1234_S/AF1235_M/AF1236_L
+    # Sort the segments per config.nucleotide_sequences
+    row = {}
+    joint_key = "/".join(
+        [
+            f"{group[segment]}.{segment}"
+            for segment in config.nucleotide_sequences
+            if segment in group
+        ]
+    )
+
+    for field in shared_fields:
+        values = {segment: records[group[segment]][field] for segment in group}
+        deduplicated_values = sorted(set(values.values()))
+        if len(deduplicated_values) > 1:
+            if field == "authors":
+                # For authors, we accept different orders
+                logger.info(f"Author orders differ for group {joint_key}: {values}")
+            else:
+                msg = f"Assertion failed: values for group must be identical: {values}"
+                raise ValueError(msg)
+        row[field] = deduplicated_values[0]
+
+    for field in insdc_segment_specific_fields:
+        for segment in config.nucleotide_sequences:
+            row[f"{field}_{segment}"] = records[group[segment]][field] if segment in group else ""
+
+    row["submissionId"] = joint_key
+
+    row["hash"] = hashlib.md5(
+        json.dumps(row, sort_keys=True).encode(), usedforsecurity=False
+    ).hexdigest()
+
+    return joint_key, row
+
 
 @click.command()
 @click.option("--config-file", required=True, type=click.Path(exists=True))
@@ -100,16 +169,11 @@ def main(
     segments = config.nucleotide_sequences
     number_of_segments = len(segments)
 
-    with open(input_metadata, encoding="utf-8") as file:
-        segment_metadata: dict[str, dict[str, str]] = json.load(file)
-    number_of_segmented_records = len(segment_metadata.keys())
-    logger.info(f"Found {number_of_segmented_records} individual segments in metadata file")
-
     # Group segments according to isolate, collection date and isolate specific values
     # These are the fields that are expected to be identical across all segments for a given isolate
 
     # Dynamically determine the fields that are present in the metadata
-    first_row = next(iter(segment_metadata.values()))
+    first_row = next((record for _, record in iter_metadata(input_metadata)), None)
     if not first_row:
         msg = "No data found in metadata file"
         raise ValueError(msg)
@@ -127,21 +191,17 @@ def main(
     logger.debug(f"Shared metadata fields: {shared_fields}")
 
     # Build equivalence classes based on shared fields
-    # Use shared fields as the key to group the data
-    type SegmentName = str
-    type Accession = str
-    type EquivalenceClasses = dict[tuple[str, str], dict[SegmentName, list[Accession]]]
+    # Use a digest of the shared fields as the key to group the data, only the fields needed for
+    # the key are read in this pass
+    type EquivalenceClasses = dict[bytes, dict[SegmentName, list[Accession]]]
 
     equivalence_classes: EquivalenceClasses = defaultdict(lambda: defaultdict(list))
-    for accession, values in segment_metadata.items():
-        # Author order sometimes varies among segments from same isolate
-        # Example: JX999734.1 (L) and JX999735.1 (M)
-        modified_values = values_with_sorted_authors(values)
-        group_key = str(
-            tuple((field, value) for field in shared_fields if (value := modified_values[field]))
-        )
-        segment = values["segment"]
-        equivalence_classes[group_key][segment].append(accession)
+    number_of_segmented_records = 0
+    for accession, values in iter_metadata(input_metadata, [*shared_fields, "segment"]):
+        group_key = group_key_digest(values, shared_fields)
+        equivalence_classes[group_key][values["segment"]].append(accession)
+        number_of_segmented_records += 1
+    logger.info(f"Found {number_of_segmented_records} individual segments in metadata file")
 
     # TODO: Advanced checks for various sub-classes so we can warn the user if there are issues
     # For example, if there are multiple isolates with the same name and collection date
@@ -151,13 +211,13 @@ def main(
     grouped_accessions: list[dict[SegmentName, Accession]] = []
     # Simply check there are no duplicate segments for each group
 
-    for group_key, sequence_group in equivalence_classes.items():
+    for sequence_group in equivalence_classes.values():
         # Verify that all segments are unique for the group
         unique_per_segment = all(len(accessions) <= 1 for accessions in sequence_group.values())
 
         if not unique_per_segment:
             logger.warning(
-                f"Found multiple copies of a segment for grouping key: {group_key} "
+                "Found multiple copies of a segment with identical shared metadata, "
                 "uploading segments individually. "
                 f"Grouping: {dict(sequence_group)}"
             )
@@ -170,6 +230,7 @@ def main(
         grouped_accessions.append(
             {segment: accessions[0] for segment, accessions in sequence_group.items()}
         )
+    del equivalence_classes
 
     number_of_groups = len(grouped_accessions)
     group_lower_bound = number_of_segmented_records // number_of_segments
@@ -192,76 +253,64 @@ def main(
             }
         )
 
-    # Add segment specific metadata for the segments
-    metadata: dict[str, dict[str, str]] = {}
     # Map from original accession to the new concatenated accession
     fasta_id_map: dict[Accession, Accession] = {}
 
-    for group in grouped_accessions:
-        # Create key by concatenating all accession numbers with their segments
-        # e.g. AF1234_S/AF1235_M/AF1236_L
-        # Sort the segments per config.nucleotide_sequences
-        row = {}
-        joint_key = "/".join(
-            [
-                f"{group[segment]}.{segment}"
-                for segment in config.nucleotide_sequences
-                if segment in group
-            ]
-        )
-        for segment, accession in group.items():
-            fasta_id_map[accession] = f"{joint_key}_{segment}"
-
-        for field in shared_fields:
-            values = {segment: segment_metadata[group[segment]][field] for segment in group}
-            deduplicated_values = sorted(set(values.values()))
-            if len(deduplicated_values) > 1:
-                if field == "authors":
-                    # For authors, we accept different orders
-                    logger.info(f"Author orders differ for group {joint_key}: {values}")
-                else:
-                    msg = f"Assertion failed: values for group must be identical: {values}"
-                    raise ValueError(msg)
-            row[field] = deduplicated_values[0]
-
-        for field in insdc_segment_specific_fields:
-            for segment in config.nucleotide_sequences:
-                row[f"{field}_{segment}"] = (
-                    segment_metadata[group[segment]][field] if segment in group else ""
-                )
-
-        row["submissionId"] = joint_key
-
-        row["hash"] = hashlib.md5(
-            json.dumps(row, sort_keys=True).encode(), usedforsecurity=False
-        ).hexdigest()
-
-        metadata[joint_key] = row
+    def grouped_metadata() -> Iterator[tuple[str, Record]]:
+        """Stream the metadata again, records are only kept until all segments of their group
+        have been read. Fills fasta_id_map for the groups that are yielded."""
+        group_index = {
+            accession: index
+            for index, group in enumerate(grouped_accessions)
+            for accession in group.values()
+        }
+        pending: dict[int, dict[Accession, Record]] = defaultdict(dict)
+        for accession, record in iter_metadata(input_metadata):
+            index = group_index[accession]
+            group = grouped_accessions[index]
+            records = pending[index]
+            records[accession] = record
+            if len(records) < len(group):
+                continue
+            del pending[index]
+            joint_key, row = grouped_row(
+                group, records, shared_fields, insdc_segment_specific_fields, config
+            )
+            for segment, segment_accession in group.items():
+                fasta_id_map[segment_accession] = f"{joint_key}_{segment}"
+            yield joint_key, row
 
-    Path(output_metadata).write_text(
-        json.dumps(metadata, indent=4, sort_keys=True), encoding="utf-8"
-    )
-    logging.info(f"Wrote grouped metadata for {len(metadata)} sequences")
+    write_metadata(output_metadata, grouped_metadata())
+    logging.info(f"Wrote grouped metadata for {number_of_groups} sequences")
 
     count = 0
     count_ignored = 0
-    for record in orjsonl.stream(input_seq):
-        accession = record["id"]
-        raw_sequence = record["sequence"]
-        if accession not in fasta_id_map:
-            logger.warning(f"Accession {accession} not found in input sequence file, skipping")
-            count_ignored += 1
-            continue
-        orjsonl.append(
-            output_seq,
-            {
-                "id": fasta_id_map[accession],
-                "sequence": raw_sequence,
-            },
-        )
-        count += 1
+    with xopen(output_seq, "wb", threads=0) as output:
+        for chunk in batched(orjsonl.stream(input_seq), LINES_PER_WRITE):
+            lines = []
+            for record in chunk:
+                accession = record["id"]
+                if accession not in fasta_id_map:
+                    logger.warning(
+                        f"Accession {accession} not found in input sequence file, skipping"
+                    )
+                    count_ignored += 1
+                    continue
+                lines.append(
+                    orjson.dumps({"id": fasta_id_map[accession], "sequence": record["sequence"]})
+                )
+            if lines:
+                output.write(b"\n".join(lines) + b"\n")
+            count += len(lines)
     logging.info(f"Wrote {count} sequences")
     logging.info(f"Ignored {count_ignored} sequences as not found in {input_seq}")
+    record_counts(
+        "group_segments",
+        segments=number_of_segmented_records,
+        groups=number_of_groups,
+        sequences=count,
+        ignored_sequences=count_ignored,
+    )
 
 
 if __name__ == "__main__":
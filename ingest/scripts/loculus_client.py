@@ -0,0 +1,229 @@
+"""Client for the Loculus backend API, used by ingest and ena-submission
+
+Keep ingest/scripts/loculus_client.py and ena-submission/scripts/loculus_client.py identical, the
+two pipelines are built from separate Docker contexts. The ingest and ena-submission test
+workflows fail if the copies differ.
+
+- One pooled session for all requests
+- The Keycloak token is reused until shortly before it expires (`exp` claim), and requested again
+  if the backend rejects it with 401
+- Connection errors and 502/503/504 of idempotent requests are retried with exponential backoff,
+  423 (backend still processing submitted data) is retried every `locked_retry_seconds` up to
+  `max_locked_retries` times, by default it is raised like other errors
+- Number, errors and total duration of requests per endpoint are recorded for `log_metrics`
+"""
+
+import base64
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Iterator
+from dataclasses import dataclass
+from http import HTTPMethod, HTTPStatus
+from typing import Any
+from urllib.parse import urlparse
+
+import jsonlines
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Request a new token when the current one expires within this many seconds
+TOKEN_EXPIRY_MARGIN_SECONDS = 60
+
+
+@dataclass
+class EndpointMetrics:
+    requests: int = 0
+    errors: int = 0
+    seconds: float = 0.0
+
+
+def token_expiry(token: str) -> float:
+    """Expiry (epoch seconds) of a JWT, the token isn't verified, that is up to the backend"""
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return float(claims["exp"])
+    except (IndexError, KeyError, ValueError):
+        # Unknown lifetime, only use the token for a single request
+        return 0.0
+
+
+class LoculusClient:
+    def __init__(  # noqa: PLR0913, PLR0917
+        self,
+        keycloak_token_url: str,
+        keycloak_client_id: str,
+        username: str,
+        password: str,
+        timeout: float = 600,
+        locked_retry_seconds: float = 30,
+        max_locked_retries: int = 0,
+        max_retries: int = 3,
+        pool_maxsize: int = 8,
+    ) -> None:
+        self.keycloak_token_url = keycloak_token_url
+        self.keycloak_client_id = keycloak_client_id
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.locked_retry_seconds = locked_retry_seconds
+        self.max_locked_retries = max_locked_retries
+
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,
+            status=max_retries,
+            backoff_factor=1,
+            status_forcelist=[
+                HTTPStatus.BAD_GATEWAY,
+                HTTPStatus.SERVICE_UNAVAILABLE,
+                HTTPStatus.GATEWAY_TIMEOUT,
+            ],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_maxsize=pool_maxsize)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.token_lock = threading.Lock()
+        self.token: str | None = None
+        self.token_expires_at = 0.0
+
+        self.metrics_lock = threading.Lock()
+        self.metrics: dict[str, EndpointMetrics] = defaultdict(EndpointMetrics)
+
+    def get_jwt(self) -> str:
+        """Cached Keycloak token for the configured user"""
+        with self.token_lock:
+            if self.token and time.time() < self.token_expires_at - TOKEN_EXPIRY_MARGIN_SECONDS:
+                return self.token
+            data = {
+                "username": self.username,
+                "password": self.password,
+                "grant_type": "password",
+                "client_id": self.keycloak_client_id,
+            }
+            headers = {"Content-Type": "application/x-www-form-urlencoded"}
+            response = self.session.post(
+                self.keycloak_token_url, data=data, headers=headers, timeout=self.timeout
+            )
+            response.raise_for_status()
+            self.token = response.json()["access_token"]
+            self.token_expires_at = token_expiry(self.token)
+            logger.debug("Requested new Keycloak token")
+            return self.token
+
+    def invalidate_jwt(self, token: str) -> None:
+        with self.token_lock:
+            if self.token == token:
+                self.token = None
+
+    def request(  # noqa: PLR0913
+        self,
+        method: HTTPMethod,
+        url: str,
+        *,
+        headers: dict[str, str] | None = None,
+        params: dict[str, Any] | None = None,
+        files: dict[str, Any] | None = None,
+        json_body: Any = None,
+        data: Any = None,
+        stream: bool = False,
+    ) -> requests.Response:
+        """
+        Authenticated request, raises requests.HTTPError if the response isn't ok.
+        Multipart uploads (`files`) send `params` as form fields.
+        """
+        if method not in {HTTPMethod.GET, HTTPMethod.POST}:
+            msg = f"Unsupported HTTP method: {method}"
+            raise ValueError(msg)
+        request_headers = dict(headers or {})
+        if files:
+            request_headers.pop("Content-Type", None)  # Set by requests for multipart/form-data
+            data, params = params, None
+        renewed_token = False
+        locked_retries = 0
+        while True:
+            token = self.get_jwt()
+            request_headers["Authorization"] = f"Bearer {token}"
+            start = time.perf_counter()
+            response = self.session.request(
+                method,
+                url,
+                headers=request_headers,
+                params=params,
+                files=files,
+                json=json_body,
+                data=data,
+                timeout=self.timeout,
+                stream=stream,
+            )
+            self._record(method, url, time.perf_counter() - start, response.ok)
+            if response.status_code == HTTPStatus.UNAUTHORIZED and not renewed_token:
+                logger.info("Token was rejected, requesting a new one")
+                response.close()
+                self.invalidate_jwt(token)
+                renewed_token = True
+                continue
+            if (
+                response.status_code == HTTPStatus.LOCKED
+                and locked_retries < self.max_locked_retries
+            ):
+                logger.warning(
+                    f"Got 423 from {url}. Retrying after {self.locked_retry_seconds} seconds."
+                )
+                response.close()
+                locked_retries += 1
+                time.sleep(self.locked_retry_seconds)
+                continue
+            break
+
+        if not response.ok:
+            msg = (
+                f"Request failed:\n"
+                f"URL: {url}\n"
+                f"Method: {method}\n"
+                f"Status Code: {response.status_code}\n"
+                f"Response Content: {response.text}"
+            )
+            logger.error(msg)
+            raise requests.HTTPError(msg, response=response)
+        return response
+
+    def _record(self, method: HTTPMethod, url: str, seconds: float, ok: bool) -> None:
+        endpoint = f"{method} {urlparse(url).path}"
+        logger.debug(f"{endpoint} took {seconds:.3f}s")
+        with self.metrics_lock:
+            metrics = self.metrics[endpoint]
+            metrics.requests += 1
+            metrics.errors += not ok
+            metrics.seconds += seconds
+
+    def log_metrics(self) -> None:
+        with self.metrics_lock:
+            for endpoint, metrics in sorted(self.metrics.items()):
+                logger.info(
+                    f"{endpoint}: {metrics.requests} requests, {metrics.errors} errors, "
+                    f"{metrics.seconds:.1f}s total"
+                )
+
+
+def iter_json_lines(response: requests.Response, endpoint: str) -> Iterator[dict[str, Any]]:
+    """Stream the JSON objects of an NDJSON response"""
+    try:
+        yield from jsonlines.Reader(response.iter_lines()).iter()
+    except jsonlines.Error as err:
+        error_summary = str(err)
+        max_error_length = 100
+        if len(error_summary) > max_error_length:
+            error_summary = error_summary[:50] + "\n[..]\n" + error_summary[-50:]
+        logger.error(f"Error decoding JSON from {endpoint}: {error_summary}")
+        raise ValueError from err
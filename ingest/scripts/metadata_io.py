@@ -0,0 +1,74 @@
+"""Read and write the metadata handed between ingest rules (metadata_post_prepare/_group)
+
+The format is chosen by the file extension:
+- `.json`: a single pretty-printed JSON object mapping fasta id to record
+- `.ndjson`, optionally compressed e.g. `.ndjson.gz`: one `{"id": ..., "metadata": {...}}` per line
+
+Both are read as a stream, pass `fields` to only keep the fields a script needs of each record.
+"""
+
+import json
+from collections.abc import Iterable, Iterator
+from itertools import batched
+from pathlib import Path
+
+import ijson
+import orjson
+from xopen import xopen
+
+type Record = dict[str, str]
+
+# Lines per write to the (possibly compressed) NDJSON output
+LINES_PER_WRITE = 1000
+
+
+def is_ndjson(path: str) -> bool:
+    return ".ndjson" in Path(path).suffixes
+
+
+def write_metadata(path: str, items: Iterable[tuple[str, Record]]) -> None:
+    """Write (fasta id, record) items, with the keys of each record sorted"""
+    if not is_ndjson(path):
+        Path(path).write_text(json.dumps(dict(items), indent=4, sort_keys=True), encoding="utf-8")
+        return
+    with xopen(path, "wb", threads=0) as file:
+        for chunk in batched(items, LINES_PER_WRITE):
+            lines = [
+                orjson.dumps({"id": id, "metadata": record}, option=orjson.OPT_SORT_KEYS)
+                for id, record in chunk
+            ]
+            file.write(b"\n".join(lines) + b"\n")
+
+
+def iter_metadata(path: str, fields: Iterable[str] | None = None) -> Iterator[tuple[str, Record]]:
+    """Stream (fasta id, record) items, records only contain `fields` if given"""
+    projection = list(fields) if fields is not None else None
+    if is_ndjson(path):
+        with xopen(path, "rb", threads=0) as file:
+            items = ((item["id"], item["metadata"]) for item in map(orjson.loads, file))
+            yield from _project(items, projection)
+        return
+    with open(path, "rb") as file:
+        yield from _project(ijson.kvitems(file, "", use_float=True), projection)
+
+
+def load_metadata(path: str, fields: Iterable[str] | None = None) -> dict[str, Record]:
+    if fields is None and not is_ndjson(path):
+        # Everything is needed anyway, json.load is faster than streaming
+        with open(path, encoding="utf-8") as file:
+            return json.load(file)
+    return dict(iter_metadata(path, fields))
+
+
+def _project(
+    items: Iterable[tuple[str, Record]], fields: list[str] | None
+) -> Iterator[tuple[str, Record]]:
+    if fields is None:
+        yield from items
+        return
+    for id, record in items:
+        missing = [field for field in fields if field not in record]
+        if missing:
+            msg = f"Metadata of {id} is missing the field(s) {', '.join(missing)}"
+            raise ValueError(msg)
+        yield id, {field: record[field] for field in fields}
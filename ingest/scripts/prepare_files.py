@@ -2,6 +2,8 @@ import csv
 import json
 import logging
 import sys
+from collections import defaultdict
+from contextlib import ExitStack
 from dataclasses import dataclass
 from pathlib import Path
 
@@ -9,6 +11,8 @@ import click
 import orjsonl
 import requests
 import yaml
+from metadata_io import iter_metadata
+from run_report import record_counts
 
 
 @dataclass
@@ -31,6 +35,27 @@ logging.basicConfig(
 # https://stackoverflow.com/questions/15063936
 csv.field_size_limit(sys.maxsize)
 
+# Buffer size of each FASTA output
+WRITE_BUFFER = 1024 * 1024
+
+
+def stream_fan_out_to_fasta(input: str, outputs: dict[str, set[str]]) -> None:
+    """Write each sequence to every output whose ids include it, reading the input once"""
+    destinations: dict[str, list[int]] = defaultdict(list)
+    for index, keep in enumerate(outputs.values()):
+        for id in keep:
+            destinations[id].append(index)
+    with ExitStack() as stack:
+        output_files = [
+            stack.enter_context(open(output, "w", encoding="utf-8", buffering=WRITE_BUFFER))
+            for output in outputs
+        ]
+        if not destinations:
+            return
+        for record in orjsonl.stream(input):
+            for index in destinations.get(record["id"], ()):
+                output_files[index].write(f">{record['id']}\n{record['sequence']}\n")
+
 
 def ids_to_add(fasta_id, config) -> set[str]:
     if config.segmented:
@@ -101,11 +126,18 @@ def main(
         relevant_config = {key: full_config[key] for key in Config.__annotations__}
         config = Config(**relevant_config)
 
-    metadata = json.load(open(metadata_path, encoding="utf-8"))
     to_submit = json.load(open(to_submit_path, encoding="utf-8"))
     to_revise = json.load(open(to_revise_path, encoding="utf-8"))
     to_revoke = json.load(open(to_revoke_path, encoding="utf-8"))
 
+    # Only keep the records that are submitted, revised or revoked in memory
+    needed_ids = set(to_submit) | set(to_revise) | set(to_revoke)
+    metadata = {
+        fasta_id: record
+        for fasta_id, record in iter_metadata(metadata_path)
+        if fasta_id in needed_ids
+    }
+
     metadata_submit = []
     metadata_revise = []
     metadata_submit_prior_to_revoke = []  # Only for multi-segmented case, sequences are revoked
@@ -146,21 +178,19 @@ def main(
     write_to_tsv(metadata_revise, metadata_revise_path)
     write_to_tsv(metadata_submit_prior_to_revoke, metadata_submit_prior_to_revoke_path)
 
-    def stream_filter_to_fasta(input, output, keep):
-        if len(keep) == 0:
-            Path(output).touch()
-            return
-        with open(output, "w", encoding="utf-8") as output_file:
-            for record in orjsonl.stream(input):
-                if record["id"] in keep:
-                    output_file.write(f">{record['id']}\n{record['sequence']}\n")
-
-    stream_filter_to_fasta(input=sequences_path, output=sequences_submit_path, keep=submit_ids)
-    stream_filter_to_fasta(input=sequences_path, output=sequences_revise_path, keep=revise_ids)
-    stream_filter_to_fasta(
+    stream_fan_out_to_fasta(
         input=sequences_path,
-        output=sequences_submit_prior_to_revoke_path,
-        keep=submit_prior_to_revoke_ids,
+        outputs={
+            sequences_submit_path: submit_ids,
+            sequences_revise_path: revise_ids,
+            sequences_submit_prior_to_revoke_path: submit_prior_to_revoke_ids,
+        },
+    )
+    record_counts(
+        "prepare_files",
+        submit=len(metadata_submit),
+        revise=len(metadata_revise),
+        submit_prior_to_revoke=len(metadata_submit_prior_to_revoke),
     )
 
 
@@ -15,6 +15,8 @@ import click
 import orjsonl
 import pandas as pd
 import yaml
+from metadata_io import is_ndjson, write_metadata
+from run_report import record_counts
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -50,6 +52,38 @@ def split_authors(authors: str) -> str:
     return ", ".join(result)
 
 
+def json_columns(df: pd.DataFrame) -> dict[str, pd.Series]:
+    """JSON encoding of each value, as json.dumps would encode it inside a record"""
+    return {key: df[key].map(json.dumps).astype(object) for key in df.columns}
+
+
+def metadata_hashes(encoded: dict[str, pd.Series], sequence_hashes: pd.Series) -> list[str]:
+    """md5 of json.dumps(record, sort_keys=True) + sequence hash for each record.
+    The JSON strings are built a column at a time instead of record by record."""
+    metadata_dumps = pd.Series("{", index=sequence_hashes.index, dtype=object)
+    for i, key in enumerate(sorted(encoded)):
+        separator = ", " if i else ""
+        metadata_dumps += separator + json.dumps(key) + ": " + encoded[key]
+    prehashes = metadata_dumps + "}" + sequence_hashes
+    return [
+        hashlib.md5(prehash.encode(), usedforsecurity=False).hexdigest() for prehash in prehashes
+    ]
+
+
+def dump_metadata(ids: pd.Series, encoded: dict[str, pd.Series]) -> str:
+    """Same string as json.dumps({id: record, ...}, indent=4, sort_keys=True)"""
+    records = pd.Series("", index=ids.index, dtype=object)
+    for i, key in enumerate(sorted(encoded)):
+        separator = ",\n" if i else ""
+        records += separator + " " * 8 + json.dumps(key) + ": " + encoded[key]
+    # Later records replace earlier ones with the same id, like in a dict
+    records_by_id = dict(zip(ids.map(json.dumps), records, strict=True))
+    if not records_by_id:
+        return "{}"
+    entries = [f"    {id}: {{\n{records_by_id[id]}\n    }}" for id in sorted(records_by_id)]
+    return "{\n" + ",\n".join(entries) + "\n}"
+
+
 @click.command()
 @click.option("--config-file", required=True, type=click.Path(exists=True))
 @click.option("--input", required=True, type=click.Path(exists=True))
@@ -79,75 +113,69 @@ def main(
 
     logger.info(f"Reading metadata from {input}")
     df = pd.read_csv(input, sep="\t", dtype=str, keep_default_na=False)
-    metadata: list[dict[str, str]] = df.to_dict(orient="records")
 
     sequence_hashes: dict[str, str] = {
         record["id"]: record["hash"] for record in orjsonl.load(sequence_hashes)
     }
 
+    # Transform the metadata, column by column
+    compound_country = df[config.compound_country_field].str.split(":", n=1)
+    df["division"] = compound_country.str[1].fillna("").str.strip()
+    df["country"] = compound_country.str[0].str.strip()
+    fasta_ids = df[config.fasta_id_field]
+    df["submissionId"] = fasta_ids
+    accession_parts = fasta_ids.str.split(".", n=1)
+    if accession_parts.str[1].isna().any():
+        msg = f"Accessions without version: {list(fasta_ids[accession_parts.str[1].isna()])}"
+        raise ValueError(msg)
+    df["insdcAccessionBase"] = accession_parts.str[0]
+    df["insdcVersion"] = accession_parts.str[1]
+    # Many records share the same authors, split each distinct value only once
+    authors = df["ncbiSubmitterNames"]
+    df["ncbiSubmitterNames"] = authors.map({a: split_authors(a) for a in authors.unique()})
+
     if config.segmented:
         # Segments are a tsv file with the first column being the fasta id
         # and the second being the segment
-        segments_dict: dict[str, str] = {}
-        with open(segments, encoding="utf-8") as file:
-            for line in file:
-                if line.startswith("seqName"):
-                    continue
-                fasta_id, segment = line.strip().split("\t")
-                segments_dict[fasta_id] = segment
-
-    for record in metadata:
-        # Transform the metadata
-        try:
-            record["division"] = record[config.compound_country_field].split(":", 1)[1].strip()
-        except IndexError:
-            record["division"] = ""
-        record["country"] = record[config.compound_country_field].split(":", 1)[0].strip()
-        record["submissionId"] = record[config.fasta_id_field]
-        record["insdcAccessionBase"] = record[config.fasta_id_field].split(".", 1)[0]
-        record["insdcVersion"] = record[config.fasta_id_field].split(".", 1)[1]
-        record["ncbiSubmitterNames"] = split_authors(record["ncbiSubmitterNames"])
-        if config.segmented:
-            record["segment"] = segments_dict.get(record[config.fasta_id_field], "")
-
-    # Get rid of all records without segment
-    # TODO: Log the ones that are missing
-    if config.segmented:
-        metadata = [record for record in metadata if record["segment"]]
+        segments_df = pd.read_csv(segments, sep="\t", dtype=str, keep_default_na=False)
+        segments_dict = dict(zip(segments_df.iloc[:, 0], segments_df.iloc[:, 1], strict=True))
+        df["segment"] = fasta_ids.map(segments_dict).fillna("")
+        # Get rid of all records without segment
+        # TODO: Log the ones that are missing
+        df = df[df["segment"] != ""]
 
-    for record in metadata:
-        for from_key, to_key in config.rename.items():
-            val = record.pop(from_key)
-            record[to_key] = val
+    for from_key, to_key in config.rename.items():
+        df[to_key] = df.pop(from_key)
 
     keys_to_keep = set(config.rename.values()) | set(config.keep)
     if config.segmented:
         keys_to_keep.add("segment")
-    for record in metadata:
-        for key in list(record.keys()):
-            if key not in keys_to_keep:
-                record.pop(key)
+    df = df[[key for key in df.columns if key in keys_to_keep]]
 
     # Calculate overall hash of metadata + sequence
-    for record in metadata:
-        fasta_id_field = config.fasta_id_field
-        if config.fasta_id_field in config.rename:
-            fasta_id_field = config.rename[config.fasta_id_field]
-        sequence_hash = sequence_hashes.get(record[fasta_id_field], "")
-        if not sequence_hash:
-            msg = f"No hash found for {record[config.fasta_id_field]}"
-            raise ValueError(msg)
-
-        metadata_dump = json.dumps(record, sort_keys=True)
-        prehash = metadata_dump + sequence_hash
-
-        record["hash"] = hashlib.md5(prehash.encode(), usedforsecurity=False).hexdigest()
-
-    meta_dict = {rec[fasta_id_field]: rec for rec in metadata}
-
-    Path(output).write_text(json.dumps(meta_dict, indent=4, sort_keys=True), encoding="utf-8")
-
-    logging.info(f"Saved metadata for {len(metadata)} sequences")
+    fasta_id_field = config.fasta_id_field
+    if config.fasta_id_field in config.rename:
+        fasta_id_field = config.rename[config.fasta_id_field]
+    record_sequence_hashes = df[fasta_id_field].map(sequence_hashes)
+    if record_sequence_hashes.isna().any():
+        missing = df[fasta_id_field][record_sequence_hashes.isna()].iloc[0]
+        msg = f"No hash found for {missing}"
+        raise ValueError(msg)
+
+    encoded = json_columns(df)
+    hashes = pd.Series(metadata_hashes(encoded, record_sequence_hashes), index=df.index)
+    encoded["hash"] = hashes.map(json.dumps).astype(object)
+
+    if is_ndjson(output):
+        df = df.assign(hash=hashes)
+        # Later records replace earlier ones with the same id, like in the JSON object
+        records = dict(zip(df[fasta_id_field], df.to_dict("records"), strict=True))
+        write_metadata(output, sorted(records.items()))
+    else:
+        Path(output).write_text(dump_metadata(df[fasta_id_field], encoded), encoding="utf-8")
+
+    logging.info(f"Saved metadata for {len(df)} sequences")
+    record_counts("prepare_metadata", records=len(df))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,172 @@
+"""
+Report of an ingest run: duration and resources of each Snakemake rule and record counts of scripts.
+
+Rules write Snakemake benchmark files (wall time, peak RSS, bytes read/written), scripts write
+their record counts with `record_counts` to the directory in $INGEST_RUN_REPORT_DIR, which the
+Snakefile sets. At the end of the run both are collected into one JSON file and optionally pushed
+to a Prometheus pushgateway.
+"""
+
+import csv
+import json
+import logging
+import os
+import re
+import time
+from pathlib import Path
+from typing import Any
+
+import click
+import requests
+
+logger = logging.getLogger(__name__)
+
+RUN_REPORT_DIR_ENV = "INGEST_RUN_REPORT_DIR"
+PUSHGATEWAY_JOB = "loculus_ingest"
+
+
+def record_counts(step: str, **counts: int) -> None:
+    """Record counts of a script for the run report, a no-op outside of Snakemake runs"""
+    directory = os.getenv(RUN_REPORT_DIR_ENV)
+    if not directory:
+        return
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    (Path(directory) / f"{step}.json").write_text(json.dumps(counts), encoding="utf-8")
+
+
+def written_since(directory: str, pattern: str, run_started: float) -> list[Path]:
+    """Files of this run, older ones are left over from previous runs"""
+    return sorted(
+        path for path in Path(directory).glob(pattern) if path.stat().st_mtime >= run_started
+    )
+
+
+def float_or_none(value: str) -> float | None:
+    try:
+        return float(value)
+    except ValueError:
+        return None  # "NA" if Snakemake couldn't measure it
+
+
+def rule_resources(benchmarks_dir: str, run_started: float) -> dict[str, dict[str, Any]]:
+    """Columns of interest of the Snakemake benchmark file of each job"""
+    rules = {}
+    for path in written_since(benchmarks_dir, "*.tsv", run_started):
+        with open(path, encoding="utf-8", newline="") as file:
+            row = next(csv.DictReader(file, delimiter="\t"), None)
+        if row is None:
+            continue
+        rules[path.stem] = {
+            "seconds": float_or_none(row["s"]),
+            "cpu_seconds": float_or_none(row["cpu_time"]),
+            "max_rss_mb": float_or_none(row["max_rss"]),
+            "read_mb": float_or_none(row["io_in"]),
+            "written_mb": float_or_none(row["io_out"]),
+        }
+    return rules
+
+
+def script_counts(counts_dir: str, run_started: float) -> dict[str, dict[str, int]]:
+    return {
+        path.stem: json.loads(path.read_text(encoding="utf-8"))
+        for path in written_since(counts_dir, "*.json", run_started)
+    }
+
+
+def prometheus_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def prometheus_metrics(report: dict[str, Any]) -> str:
+    """Report in the Prometheus text format, as accepted by the pushgateway"""
+    lines = [
+        "# TYPE ingest_run_seconds gauge",
+        f"ingest_run_seconds {report['seconds']}",
+        "# TYPE ingest_run_success gauge",
+        f"ingest_run_success {int(report['success'])}",
+        "# TYPE ingest_run_finished_timestamp_seconds gauge",
+        f"ingest_run_finished_timestamp_seconds {report['finished']}",
+    ]
+    for field in ["seconds", "cpu_seconds", "max_rss_mb", "read_mb", "written_mb"]:
+        lines.append(f"# TYPE ingest_rule_{field} gauge")
+        lines.extend(
+            f'ingest_rule_{field}{{rule="{rule}"}} {resources[field]}'
+            for rule, resources in report["rules"].items()
+            if resources[field] is not None
+        )
+    lines.append("# TYPE ingest_records gauge")
+    for step, counts in report["records"].items():
+        lines.extend(
+            f'ingest_records{{step="{step}",count="{prometheus_name(name)}"}} {value}'
+            for name, value in counts.items()
+        )
+    return "\n".join(lines) + "\n"
+
+
+def push(pushgateway: str, organism: str, metrics: str) -> None:
+    """Replace the metrics of the organism's group, a failed push doesn't fail the run"""
+    url = f"{pushgateway.rstrip('/')}/metrics/job/{PUSHGATEWAY_JOB}/organism/{organism}"
+    try:
+        response = requests.put(url, data=metrics.encode(), timeout=30)
+        response.raise_for_status()
+    except requests.RequestException as err:
+        logger.warning(f"Could not push run report to {url}: {err}")
+        return
+    logger.info(f"Pushed run report to {url}")
+
+
+@click.command()
+@click.option("--organism", required=True)
+@click.option("--benchmarks", required=True, type=click.Path(), help="Snakemake benchmark files")
+@click.option("--counts", required=True, type=click.Path(), help="Files of record_counts")
+@click.option("--run-started", required=True, type=float, help="Epoch seconds")
+@click.option("--success/--failure", default=True)
+@click.option("--output", required=True, type=click.Path())
+@click.option("--pushgateway", default=None, help="URL of a Prometheus pushgateway")
+@click.option(
+    "--log-level",
+    default="INFO",
+    type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]),
+)
+def main(  # noqa: PLR0913, PLR0917
+    organism: str,
+    benchmarks: str,
+    counts: str,
+    run_started: float,
+    success: bool,
+    output: str,
+    pushgateway: str | None,
+    log_level: str,
+) -> None:
+    # Not configured on import, scripts importing record_counts configure logging themselves
+    logging.basicConfig(
+        encoding="utf-8",
+        level=logging.DEBUG,
+        format="%(asctime)s %(levelname)8s (%(filename)20s:%(lineno)4d) - %(message)s ",
+        datefmt="%H:%M:%S",
+    )
+    logger.setLevel(log_level)
+
+    finished = time.time()
+    report = {
+        "organism": organism,
+        "success": success,
+        "started": run_started,
+        "finished": finished,
+        "seconds": round(finished - run_started, 3),
+        "rules": rule_resources(benchmarks, run_started),
+        "records": script_counts(counts, run_started),
+    }
+    Path(output).write_text(json.dumps(report, indent=4), encoding="utf-8")
+
+    slowest = sorted(report["rules"].items(), key=lambda item: -(item[1]["seconds"] or 0))[:3]
+    logger.info(
+        f"Ingest run took {report['seconds']:.0f}s, slowest rules: "
+        + ", ".join(f"{rule} ({resources['seconds'] or 0:.0f}s)" for rule, resources in slowest)
+    )
+    if pushgateway:
+        push(pushgateway, organism, prometheus_metrics(report))
+
+
+if __name__ == "__main__":
+    main()
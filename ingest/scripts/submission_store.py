@@ -0,0 +1,193 @@
+"""Previously submitted sequences, keyed by INSDC accession (base, without version)
+
+`call_loculus.py --mode get-submitted` writes them as one JSON object, or with a `.sqlite` output
+path into an indexed SQLite store with the latest version of each accession precomputed, so
+`compare_hashes.py` can look up accessions without loading the whole history into memory.
+Original metadata of approved versions can be cached between runs in an OriginalMetadataCache.
+"""
+
+import json
+import operator
+import sqlite3
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+APPROVED_FOR_RELEASE = "APPROVED_FOR_RELEASE"
+
+SCHEMA = """
+CREATE TABLE submissions (
+    insdc_accession TEXT PRIMARY KEY,
+    loculus_accession TEXT NOT NULL,
+    -- Joint accession of the first version seen, like jointAccession in the JSON
+    joint_accession TEXT NOT NULL,
+    latest_version INTEGER NOT NULL,
+    latest_hash TEXT NOT NULL,
+    latest_status TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX submissions_joint_accession ON submissions (joint_accession);
+"""
+
+
+@dataclass(frozen=True)
+class PreviousSubmission:
+    loculus_accession: str
+    joint_accession: str
+    latest_hash: str
+    latest_status: str
+
+
+def is_sqlite(path: str) -> bool:
+    return Path(path).suffix == ".sqlite"
+
+
+class SubmissionStoreWriter:
+    def __init__(self, path: str) -> None:
+        Path(path).unlink(missing_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def add_version(  # noqa: PLR0913, PLR0917
+        self,
+        insdc_accession: str,
+        loculus_accession: str,
+        joint_accession: str,
+        version: int,
+        hash_value: str,
+        status: str,
+    ) -> None:
+        cursor = self.connection.execute(
+            "SELECT loculus_accession FROM submissions WHERE insdc_accession = ?",
+            (insdc_accession,),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            self.connection.execute(
+                "INSERT INTO submissions VALUES (?, ?, ?, ?, ?, ?)",
+                (insdc_accession, loculus_accession, joint_accession, version, hash_value, status),
+            )
+        elif row[0] != loculus_accession:
+            msg = (
+                f"INSDC accession {insdc_accession} has multiple loculus accessions: "
+                f"{loculus_accession} and {row[0]}!"
+            )
+            raise ValueError(msg)
+        else:
+            # Of equal versions the one added last wins, like sorting the JSON version lists
+            self.connection.execute(
+                "UPDATE submissions SET latest_version = ?, latest_hash = ?, latest_status = ? "
+                "WHERE insdc_accession = ? AND latest_version <= ?",
+                (version, hash_value, status, insdc_accession, version),
+            )
+
+    def count(self) -> int:
+        return self.connection.execute("SELECT count(*) FROM submissions").fetchone()[0]
+
+    def close(self) -> None:
+        self.connection.commit()
+        self.connection.close()
+
+
+class PreviousSubmissions:
+    """Read-only lookup of previous submissions from the SQLite store or the JSON file"""
+
+    def __init__(self, path: str) -> None:
+        self.connection: sqlite3.Connection | None = None
+        self.submitted: dict[str, dict[str, Any]] = {}
+        if is_sqlite(path):
+            self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            return
+        with open(path, encoding="utf-8") as file:
+            self.submitted = json.load(file)
+
+    def get(self, insdc_accession: str) -> PreviousSubmission | None:
+        if self.connection:
+            row = self.connection.execute(
+                "SELECT loculus_accession, joint_accession, latest_hash, latest_status "
+                "FROM submissions WHERE insdc_accession = ?",
+                (insdc_accession,),
+            ).fetchone()
+            return PreviousSubmission(*row) if row else None
+        if insdc_accession not in self.submitted:
+            return None
+        submission = self.submitted[insdc_accession]
+        # Last of equal versions, unlike max
+        versions = sorted(submission["versions"], key=operator.itemgetter("version"))
+        latest = versions[-1]
+        return PreviousSubmission(
+            loculus_accession=submission["loculus_accession"],
+            joint_accession=submission["jointAccession"],
+            latest_hash=latest["hash"],
+            latest_status=latest["status"],
+        )
+
+    def close(self) -> None:
+        if self.connection:
+            self.connection.close()
+
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    accession TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    original_metadata TEXT NOT NULL,
+    PRIMARY KEY (accession, version)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+
+class OriginalMetadataCache:
+    """
+    Original metadata of approved sequence entry versions, kept between ingest runs.
+    Original metadata can only be edited before a version is approved, so approved versions don't
+    have to be downloaded from the backend again.
+    """
+
+    def __init__(self, path: str, fields: list[str]) -> None:
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(CACHE_SCHEMA)
+        cached_fields = self.connection.execute(
+            "SELECT value FROM settings WHERE key = 'fields'"
+        ).fetchone()
+        if cached_fields is None or json.loads(cached_fields[0]) != fields:
+            # Cached entries don't have the requested fields, e.g. if segments were added
+            self.clear()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO settings VALUES ('fields', ?)", (json.dumps(fields),)
+            )
+
+    def versions(self) -> set[tuple[str, int]]:
+        return set(self.connection.execute("SELECT accession, version FROM entries"))
+
+    def entries(self) -> Iterator[dict[str, Any]]:
+        """Cached entries in the format of /get-original-metadata"""
+        for accession, version, original_metadata in self.connection.execute(
+            "SELECT accession, version, original_metadata FROM entries"
+        ):
+            yield {
+                "accession": accession,
+                "version": version,
+                "originalMetadata": json.loads(original_metadata),
+            }
+
+    def add_approved(
+        self, entries: Iterable[dict[str, Any]], statuses: dict[str, dict[int, str]]
+    ) -> Iterator[dict[str, Any]]:
+        """Pass through entries, caching those that are approved according to `statuses`"""
+        for entry in entries:
+            accession, version = entry["accession"], int(entry["version"])
+            if statuses.get(accession, {}).get(version) == APPROVED_FOR_RELEASE:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                    (accession, version, json.dumps(entry["originalMetadata"])),
+                )
+            yield entry
+
+    def clear(self) -> None:
+        self.connection.execute("DELETE FROM entries")
+
+    def close(self) -> None:
+        self.connection.commit()
+        self.connection.close()
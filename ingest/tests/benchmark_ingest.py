@@ -0,0 +1,332 @@
+"""
+Benchmark the ingest scripts on synthetic NCBI data of configurable size.
+
+Generates metadata (based on the CCHF test data) and random sequences, runs each script in
+isolation with the arguments of its Snakemake rule and writes wall time, peak RSS and throughput
+of each step as JSON, e.g. from the ingest directory:
+
+    python tests/benchmark_ingest.py --records 10000 --records 100000 --output benchmark.json
+
+Most records are "previously submitted" with the same hash, some with a changed hash, the rest are
+new, so compare_hashes and prepare_files see all three cases.
+"""
+
+import csv
+import json
+import os
+import platform
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Iterator
+from contextlib import nullcontext
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import click
+import numpy as np
+import yaml
+
+INGEST_DIR = Path(__file__).resolve().parent.parent
+TEST_DATA_DIR = INGEST_DIR / "tests" / "test_data_cchf"
+TEST_CONFIG = INGEST_DIR / "tests" / "config_cchf" / "config.yaml"
+sys.path.insert(0, str(INGEST_DIR / "scripts"))
+
+from metadata_io import iter_metadata  # noqa: E402
+
+# Share of groups that were submitted before, and of those the share whose hash has changed
+PREVIOUSLY_SUBMITTED = 0.9
+CHANGED = 0.05
+RECORDS_PER_BATCH = 10_000
+RSS_POLL_SECONDS = 0.02
+NUCLEOTIDES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+
+@dataclass
+class StepResult:
+    step: str
+    records: int
+    seconds: float
+    peak_rss_mb: float
+    records_per_second: float
+
+
+def write_config(results: Path, segmented: bool, metadata_format: str) -> list[str]:
+    """results/config.yaml as written by the Snakefile, returns the segments"""
+    with open(INGEST_DIR / "config" / "defaults.yaml", encoding="utf-8") as file:
+        config = yaml.safe_load(file)
+    with open(TEST_CONFIG, encoding="utf-8") as file:
+        config.update(yaml.safe_load(file))
+    if not segmented:
+        config["nucleotide_sequences"] = ["main"]
+    config["intermediate_format"] = metadata_format
+    config["slack_hook"] = None
+    config["segmented"] = len(config["nucleotide_sequences"]) > 1
+    (results / "config.yaml").write_text(yaml.dump(config), encoding="utf-8")
+    return config["nucleotide_sequences"]
+
+
+def synthetic_records(records: int, segments: list[str]) -> Iterator[tuple[int, str, str]]:
+    """(group, segment, accession) of each record, segments of a group are consecutive"""
+    for index in range(records):
+        yield index // len(segments), segments[index % len(segments)], f"BM{index:07d}.1"
+
+
+def generate_data(
+    results: Path, records: int, segments: list[str], sequence_length: int, seed: int
+) -> None:
+    """Metadata as renamed by the rename_columns rule, sequences, and segments by nextclade"""
+    with open(INGEST_DIR / "config" / "defaults.yaml", encoding="utf-8") as file:
+        column_mapping = yaml.safe_load(file)["column_mapping"]
+    with open(TEST_DATA_DIR / "metadata_post_extract.tsv", encoding="utf-8") as file:
+        header, template = list(csv.reader(file, delimiter="\t"))[:2]
+    row_template = dict(zip(header, template, strict=True))
+
+    rng = np.random.default_rng(seed)
+    countries = ["Russia: Astrakhan", "Turkey", "Iran: Tehran", "Uganda", "Pakistan: Balochistan"]
+    with (
+        open(results / "metadata_post_rename.tsv", "w", encoding="utf-8", newline="") as f_meta,
+        open(results / "sequences.fasta", "w", encoding="utf-8") as f_seq,
+        open(results / "nextclade_merged.tsv", "w", encoding="utf-8") as f_segments,
+    ):
+        writer = csv.writer(f_meta, delimiter="\t", lineterminator="\n")
+        writer.writerow([column_mapping.get(column, column) for column in header])
+        f_segments.write("seqName\tsegment\n")
+        for index, (group, segment, accession) in enumerate(synthetic_records(records, segments)):
+            if index % RECORDS_PER_BATCH == 0:
+                count = min(RECORDS_PER_BATCH, records - index)
+                codes = rng.integers(0, 4, size=(count, sequence_length), dtype=np.uint8)
+                batch = NUCLEOTIDES[codes]
+            row = row_template | {
+                "Accession": accession,
+                "Isolate Lineage": f"isolate-{group}",
+                "Isolate Collection date": str(1980 + group % 45),
+                "Geographic Location": countries[group % len(countries)],
+                "Length": str(sequence_length),
+            }
+            writer.writerow(row.values())
+            f_seq.write(f">{accession}\n{batch[index % RECORDS_PER_BATCH].tobytes().decode()}\n")
+            f_segments.write(f"{accession}\t{segment}\n")
+
+
+def write_previous_submissions(results: Path, metadata: str, segments: list[str]) -> None:
+    """Previous submissions matching the metadata, as written by call_loculus get-submitted"""
+    segmented = len(segments) > 1
+    keys = [f"insdcAccessionBase_{segment}" for segment in segments] if segmented else []
+    previous = {}
+    for index, (_, record) in enumerate(iter_metadata(str(results / metadata))):
+        fraction = (index * 0.6180339887) % 1  # Spread evenly over the records
+        if fraction >= PREVIOUSLY_SUBMITTED:
+            continue
+        hash = record["hash"] if fraction >= CHANGED else "changed"
+        if segmented:
+            bases = [(record[key], segment) for key, segment in zip(keys, segments, strict=True)]
+            joint = "/".join(f"{base}.{segment}" for base, segment in bases if base)
+            accessions = [base for base, _ in bases if base]
+        else:
+            joint = record["insdcAccessionBase"]
+            accessions = [joint]
+        for accession in accessions:
+            previous[accession] = {
+                "loculus_accession": f"LOC_{index:07d}",
+                "versions": [{"version": 1, "hash": hash, "status": "APPROVED_FOR_RELEASE"}],
+                "jointAccession": joint,
+            }
+    (results / "previous_submissions.json").write_text(json.dumps(previous), encoding="utf-8")
+
+
+def peak_rss_kb(pid: int) -> int:
+    """High water mark of the resident memory of a running process, 0 if it has exited"""
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except FileNotFoundError:
+        pass
+    return 0
+
+
+def run_step(step: str, command: list[str], records: int, cwd: Path) -> StepResult:
+    """Run a command, measuring wall time and peak RSS of the process"""
+    # Polls VmHWM, because the ru_maxrss of a child includes the memory of this (forked) process
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd)  # noqa: S603
+    peak = 0
+    while process.poll() is None:
+        peak = max(peak, peak_rss_kb(process.pid))
+        time.sleep(RSS_POLL_SECONDS)
+    seconds = time.perf_counter() - start
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, shlex.join(command))
+    return StepResult(
+        step=step,
+        records=records,
+        seconds=round(seconds, 3),
+        peak_rss_mb=round(peak / 1024, 1),
+        records_per_second=round(records / seconds, 1),
+    )
+
+
+def benchmark(
+    work_dir: Path,
+    records: int,
+    segmented: bool,
+    sequence_length: int,
+    metadata_format: str,
+    processes: int,
+) -> list[StepResult]:
+    results = work_dir / "results"
+    results.mkdir(parents=True)
+    segments = write_config(results, segmented, metadata_format)
+    generate_data(results, records, segments, sequence_length, seed=records)
+
+    python = sys.executable
+    scripts = INGEST_DIR / "scripts"
+    config = "results/config.yaml"
+    prepared = f"metadata_post_prepare.{metadata_format}"
+    metadata = f"metadata_post_group.{metadata_format}" if segmented else prepared
+    sequences = "sequences_post_group.ndjson" if segmented else "sequences.ndjson"
+    steps = {
+        "calculate_sequence_hashes": [
+            "--input", "results/sequences.fasta",
+            "--output-hashes", "results/sequence_hashes.ndjson",
+            "--output-sequences", "results/sequences.ndjson",
+            "--processes", str(processes),
+        ],
+        "prepare_metadata": [
+            "--config-file", config,
+            "--input", "results/metadata_post_rename.tsv",
+            "--sequence-hashes", "results/sequence_hashes.ndjson",
+            "--segments", "results/nextclade_merged.tsv" if segmented else config,
+            "--output", f"results/{prepared}",
+        ],
+        "group_segments": [
+            "--config-file", config,
+            "--input-metadata", f"results/{prepared}",
+            "--input-seq", "results/sequences.ndjson",
+            "--output-metadata", f"results/{metadata}",
+            "--output-seq", f"results/{sequences}",
+        ],
+        "compare_hashes": [
+            "--config-file", config,
+            "--old-hashes", "results/previous_submissions.json",
+            "--metadata", f"results/{metadata}",
+            "--to-submit", "results/to_submit.json",
+            "--to-revise", "results/to_revise.json",
+            "--to-revoke", "results/to_revoke.json",
+            "--unchanged", "results/unchanged.json",
+            "--output-blocked", "results/blocked.json",
+            "--sampled-out-file", "results/sampled_out.json",
+            "--subsample-fraction", "1.0",
+        ],
+        "prepare_files": [
+            "--config-file", config,
+            "--metadata-path", f"results/{metadata}",
+            "--sequences-path", f"results/{sequences}",
+            "--to-submit-path", "results/to_submit.json",
+            "--to-revise-path", "results/to_revise.json",
+            "--to-revoke-path", "results/to_revoke.json",
+            "--metadata-submit-path", "results/submit_metadata.tsv",
+            "--metadata-revise-path", "results/revise_metadata.tsv",
+            "--metadata-submit-prior-to-revoke-path",
+            "results/metadata_to_submit_prior_to_revoke.tsv",
+            "--sequences-submit-path", "results/submit_sequences.fasta",
+            "--sequences-revise-path", "results/revise_sequences.fasta",
+            "--sequences-submit-prior-to-revoke-path",
+            "results/sequences_to_submit_prior_to_revoke.fasta",
+        ],
+    }  # fmt: skip
+    if not segmented:
+        del steps["group_segments"]
+
+    step_results = []
+    for step, arguments in steps.items():
+        if step == "compare_hashes":
+            write_previous_submissions(results, metadata, segments)
+        command = [python, str(scripts / f"{step}.py"), *arguments, "--log-level", "WARNING"]
+        result = run_step(step, command, records, work_dir)
+        click.echo(f"{records} records, {step}: {result.seconds}s, {result.peak_rss_mb} MB")
+        step_results.append(result)
+    return step_results
+
+
+@click.command()
+@click.option(
+    "--records",
+    "record_counts",
+    multiple=True,
+    type=int,
+    default=[10_000],
+    show_default=True,
+    help="Number of sequences (segments for segmented organisms), can be given multiple times",
+)
+@click.option(
+    "--layout",
+    type=click.Choice(["segmented", "unsegmented", "both"]),
+    default="both",
+    show_default=True,
+)
+@click.option("--sequence-length", type=int, default=1500, show_default=True)
+@click.option(
+    "--metadata-format",
+    default="json",
+    show_default=True,
+    help="intermediate_format of the metadata, e.g. json or ndjson.gz",
+)
+@click.option("--processes", type=int, default=1, show_default=True)
+@click.option("--output", type=click.Path(), default="benchmark.json", show_default=True)
+@click.option(
+    "--work-dir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Keep the generated data and outputs in this new directory, default: temporary directory",
+)
+def main(  # noqa: PLR0913, PLR0917
+    record_counts: tuple[int, ...],
+    layout: str,
+    sequence_length: int,
+    metadata_format: str,
+    processes: int,
+    output: str,
+    work_dir: str | None,
+) -> None:
+    layouts = [True, False] if layout == "both" else [layout == "segmented"]
+    runs = []
+    with nullcontext(work_dir) if work_dir else tempfile.TemporaryDirectory() as directory:
+        for records in record_counts:
+            for segmented in layouts:
+                name = f"{records}_{'segmented' if segmented else 'unsegmented'}"
+                steps = benchmark(
+                    Path(directory) / name,
+                    records,
+                    segmented,
+                    sequence_length,
+                    metadata_format,
+                    processes,
+                )
+                runs.append(
+                    {
+                        "records": records,
+                        "segmented": segmented,
+                        "steps": [asdict(step) for step in steps],
+                    }
+                )
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "sequence_length": sequence_length,
+        "metadata_format": metadata_format,
+        "processes": processes,
+        "runs": runs,
+    }
+    Path(output).write_text(json.dumps(report, indent=4), encoding="utf-8")
+    click.echo(f"Wrote {output}")
+
+
+if __name__ == "__main__":
+    main()
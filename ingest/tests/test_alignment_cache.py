@@ -0,0 +1,99 @@
+import csv
+
+import orjson
+import pytest
+from alignment_cache import merge, misaligned, open_cache, select, select_fallback
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+DATASET = "digest"
+
+
+@pytest.fixture
+def sequences(tmp_path):
+    path = tmp_path / "sequences.fasta"
+    # c and a have the same sequence
+    path.write_text(">a desc\nAAAA\n>b\nCCCC\n>c\nAAAA\n>d\nGGGG\n", encoding="utf-8")
+    return str(path)
+
+
+def write_tsv(path, rows):
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file, delimiter="\t", lineterminator="\n")
+        writer.writerow(["index", "seqName", "alignmentScore"])
+        writer.writerows([index, *row] for index, row in enumerate(rows))
+    return str(path)
+
+
+def read_tsv(path):
+    with open(path, encoding="utf-8", newline="") as file:
+        return [
+            (row["seqName"], row["alignmentScore"]) for row in csv.DictReader(file, delimiter="\t")
+        ]
+
+
+def fasta_ids(path):
+    with open(path, encoding="utf-8") as file:
+        return [title for title, _ in SimpleFastaParser(file)]
+
+
+def write_classification(path, segments):
+    path.write_bytes(b"".join(orjson.dumps({"id": id, "segment": s}) + b"\n" for id, s in segments))
+    return str(path)
+
+
+def test_merge_keeps_plan_order_with_cached_and_fresh_results(tmp_path, sequences):
+    cache_dir = str(tmp_path / "cache")
+    connection = open_cache(cache_dir, "L")
+    to_align, plan = str(tmp_path / "to_align.fasta"), str(tmp_path / "plan.ndjson")
+
+    select(sequences, "L", DATASET, connection, None, to_align, plan)
+    assert fasta_ids(to_align) == ["a", "b", "d"]  # c is aligned as a
+    # d doesn't align to L
+    aligned = write_tsv(tmp_path / "aligned.tsv", [("b", "20"), ("a", "10"), ("d", "")])
+    merge(plan, "L", aligned, DATASET, connection, str(tmp_path / "merged.tsv"))
+    expected = [("a", "10"), ("b", "20"), ("c", "10"), ("d", "")]
+    assert read_tsv(tmp_path / "merged.tsv") == expected
+
+    # Second run: all results are cached, nothing is aligned
+    select(sequences, "L", DATASET, connection, None, to_align, plan)
+    assert fasta_ids(to_align) == []
+    empty = write_tsv(tmp_path / "empty.tsv", [])
+    merge(plan, "L", empty, DATASET, connection, str(tmp_path / "merged.tsv"))
+    assert read_tsv(tmp_path / "merged.tsv") == expected
+
+    # Results of another dataset version are not used
+    select(sequences, "L", "other", connection, None, to_align, plan)
+    assert fasta_ids(to_align) == ["a", "b", "d"]
+    connection.close()
+
+
+def test_sequences_of_other_segments_are_not_aligned(tmp_path, sequences):
+    classification = write_classification(
+        tmp_path / "classification.ndjson", [("a", "L"), ("b", "S"), ("c", "L"), ("d", None)]
+    )
+    to_align, plan = str(tmp_path / "to_align.fasta"), str(tmp_path / "plan.ndjson")
+    select(sequences, "S", DATASET, None, classification, to_align, plan)
+    assert fasta_ids(to_align) == ["b", "d"]
+    aligned = write_tsv(tmp_path / "aligned.tsv", [("b", "20"), ("d", "")])
+    merge(plan, "S", aligned, DATASET, None, str(tmp_path / "merged.tsv"))
+    assert read_tsv(tmp_path / "merged.tsv") == [("a", ""), ("b", "20"), ("c", ""), ("d", "")]
+
+
+def test_misaligned_sequences_are_aligned_against_other_segments(tmp_path, sequences):
+    classification = write_classification(
+        tmp_path / "classification.ndjson", [("a", "L"), ("b", "S"), ("c", "L"), ("d", "L")]
+    )
+    # d was assigned to L but doesn't align to it, b was never aligned against L
+    results = {
+        "L": write_tsv(tmp_path / "L.tsv", [("a", "10"), ("b", ""), ("c", "10"), ("d", "")]),
+        "S": write_tsv(tmp_path / "S.tsv", [("a", ""), ("b", "20"), ("c", ""), ("d", "")]),
+    }
+    assert misaligned(classification, results, "S") == {"d"}
+    assert misaligned(classification, results, "L") == set()
+
+    to_align, plan = str(tmp_path / "to_align.fasta"), str(tmp_path / "plan.ndjson")
+    select_fallback(sequences, "S", DATASET, None, {"d"}, to_align, plan)
+    assert fasta_ids(to_align) == ["d"]
+    aligned = write_tsv(tmp_path / "aligned.tsv", [("d", "30")])
+    merge(plan, "S", aligned, DATASET, None, str(tmp_path / "fallback.tsv"))
+    assert read_tsv(tmp_path / "fallback.tsv") == [("d", "30")]
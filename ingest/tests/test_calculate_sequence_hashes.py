@@ -0,0 +1,49 @@
+import calculate_sequence_hashes
+import orjson
+from calculate_sequence_hashes import main
+from click.testing import CliRunner
+
+
+def test_sequences_without_header_are_skipped(tmp_path):
+    sequences = tmp_path / "sequences.fasta"
+    sequences.write_text(">\nACGT\n>a description\nAAAA\n>b\nAAAA\n", encoding="utf-8")
+    hashes = tmp_path / "hashes.ndjson"
+    result = CliRunner().invoke(
+        main,
+        [
+            "--input",
+            str(sequences),
+            "--output-hashes",
+            str(hashes),
+            "--output-sequences",
+            str(tmp_path / "sequences.ndjson"),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    rows = [orjson.loads(line) for line in hashes.read_bytes().splitlines()]
+    assert [row["id"] for row in rows] == ["a", "b"]
+    assert rows[0]["hash"] == rows[1]["hash"]
+
+
+def test_chunk_without_headers_writes_no_empty_lines(tmp_path, monkeypatch):
+    monkeypatch.setattr(calculate_sequence_hashes, "CHUNK_SIZE", 2)
+    sequences = tmp_path / "sequences.fasta"
+    sequences.write_text(">\nACGT\n>\nAAAA\n>a\nAAAA\n", encoding="utf-8")
+    hashes = tmp_path / "hashes.ndjson"
+    sequences_ndjson = tmp_path / "sequences.ndjson"
+    result = CliRunner().invoke(
+        main,
+        [
+            "--input",
+            str(sequences),
+            "--output-hashes",
+            str(hashes),
+            "--output-sequences",
+            str(sequences_ndjson),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    # Every line of the NDJSON outputs is a record, including the first one
+    for output in [hashes, sequences_ndjson]:
+        ids = [orjson.loads(line)["id"] for line in output.read_bytes().split(b"\n")[:-1]]
+        assert ids == ["a"]
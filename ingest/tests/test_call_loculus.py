@@ -0,0 +1,204 @@
+import os
+
+import call_loculus
+import pytest
+from call_loculus import (
+    Config,
+    approve_until_done,
+    incremental_entries,
+    iter_chunks,
+    upload_chunks,
+)
+from submission_store import APPROVED_FOR_RELEASE, OriginalMetadataCache
+
+CONFIG = Config(
+    organism="cchf",
+    backend_url="http://backend",
+    keycloak_token_url="http://keycloak",
+    keycloak_client_id="backend-client",
+    username="insdc_ingest_user",
+    password="",
+    group_name="insdc_ingest_group",
+    nucleotide_sequences=["L", "M", "S"],
+    segmented=True,
+    submit_chunk_size=10,
+    submit_parallel_uploads=1,
+)
+FIELDS = ["hash"]
+
+
+def entry(accession, version):
+    return {
+        "accession": accession,
+        "version": version,
+        "originalMetadata": {"hash": f"{accession}.{version}"},
+    }
+
+
+def single_pass(entries):
+    """Like the streamed response, which can only be iterated once"""
+    yield from entries
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = OriginalMetadataCache(str(tmp_path / "cache.sqlite"), FIELDS)
+    list(cache.add_approved([entry("LOC_1", 1)], {"LOC_1": {1: APPROVED_FOR_RELEASE}}))
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    """Entries of the backend and the status filters of the requests for them"""
+    requests = []
+    backend = [entry("LOC_1", 1), entry("LOC_1", 2), entry("LOC_2", 1)]
+
+    def get_original_metadata(config, fields, statuses_filter=None):
+        requests.append(statuses_filter)
+        return single_pass(backend)
+
+    monkeypatch.setattr(call_loculus, "get_original_metadata", get_original_metadata)
+    return requests
+
+
+def keys(entries):
+    return [(entry["accession"], entry["version"]) for entry in entries]
+
+
+def test_cached_approved_entries_are_used(cache, downloads):
+    statuses = {"LOC_1": {1: APPROVED_FOR_RELEASE, 2: "HAS_ERRORS"}}
+    entries = incremental_entries(CONFIG, FIELDS, single_pass([entry("LOC_1", 2)]), statuses, cache)
+    assert keys(entries) == [("LOC_1", 2), ("LOC_1", 1)]
+    assert downloads == []
+
+
+def test_newly_approved_entries_are_downloaded(cache, downloads):
+    statuses = {
+        "LOC_1": {1: APPROVED_FOR_RELEASE, 2: "HAS_ERRORS"},
+        "LOC_2": {1: APPROVED_FOR_RELEASE},
+    }
+    entries = incremental_entries(CONFIG, FIELDS, single_pass([entry("LOC_1", 2)]), statuses, cache)
+    # Only approved entries are cached, the backend returns all of them here
+    assert keys(entries)[0] == ("LOC_1", 2)
+    assert downloads == [[APPROVED_FOR_RELEASE]]
+    assert cache.versions() == {("LOC_1", 1), ("LOC_2", 1)}
+
+
+def test_status_change_downloads_all_entries(cache, downloads):
+    # LOC_2.1 wasn't in the unapproved download, it was approved in between
+    statuses = {"LOC_1": {1: APPROVED_FOR_RELEASE}, "LOC_2": {1: "AWAITING_APPROVAL"}}
+    entries = incremental_entries(CONFIG, FIELDS, single_pass([]), statuses, cache)
+    assert keys(entries) == [("LOC_1", 1), ("LOC_1", 2), ("LOC_2", 1)]
+    assert downloads == [None]
+
+
+@pytest.fixture
+def submission_files(tmp_path):
+    metadata = tmp_path / "metadata.tsv"
+    metadata.write_text(
+        "submissionId\tcountry\n" + "".join(f"sub{i}\tUganda\n" for i in range(5)),
+        encoding="utf-8",
+    )
+    sequences = tmp_path / "sequences.fasta"
+    # sub3 has no S segment
+    sequences.write_text(
+        "".join(
+            f">sub{i}_{segment}\nACGT\n"
+            for i in range(5)
+            for segment in ["L", "M", "S"]
+            if (i, segment) != (3, "S")
+        ),
+        encoding="utf-8",
+    )
+    return str(metadata), str(sequences)
+
+
+def fasta_ids(chunk):
+    return [line[1:] for line in chunk.sequences.decode().splitlines() if line.startswith(">")]
+
+
+def test_chunks_keep_the_segments_of_an_entry_together(submission_files):
+    chunks = list(iter_chunks(*submission_files, CONFIG, chunk_size=2))
+    assert [chunk.submission_ids for chunk in chunks] == [
+        ["sub0", "sub1"],
+        ["sub2", "sub3"],
+        ["sub4"],
+    ]
+    assert fasta_ids(chunks[1]) == ["sub2_L", "sub2_M", "sub2_S", "sub3_L", "sub3_M"]
+    assert chunks[2].metadata == b"submissionId\tcountry\r\nsub4\tUganda\r\n"
+
+    (single,) = iter_chunks(*submission_files, CONFIG, chunk_size=0)
+    assert len(single.submission_ids) == 5  # noqa: PLR2004
+
+
+def test_rerun_resumes_from_checkpoint(submission_files, tmp_path):
+    checkpoint = str(tmp_path / "checkpoint.ndjson")
+    uploaded = []
+    failing = {"sub2"}
+
+    def upload(chunk):
+        uploaded.append(chunk.submission_ids)
+        if failing & set(chunk.submission_ids):
+            msg = "Backend unavailable"
+            raise RuntimeError(msg)
+        return [{"submissionId": id, "accession": f"LOC_{id}"} for id in chunk.submission_ids]
+
+    with pytest.raises(RuntimeError, match="1 chunk"):
+        upload_chunks(iter_chunks(*submission_files, CONFIG, 2), upload, 1, checkpoint)
+    assert uploaded == [["sub0", "sub1"], ["sub2", "sub3"]]
+
+    uploaded.clear()
+    failing.clear()
+    responses = upload_chunks(iter_chunks(*submission_files, CONFIG, 2), upload, 2, checkpoint)
+    assert uploaded == [["sub2", "sub3"], ["sub4"]]
+    assert [response["submissionId"] for response in responses] == [f"sub{i}" for i in range(5)]
+    assert not (tmp_path / "checkpoint.ndjson").exists()
+
+
+class FakeApproval:
+    """Status counts of consecutive polls and a clock that advances with each sleep"""
+
+    def __init__(self, monkeypatch, polls):
+        self.polls = list(polls)
+        self.now = 0.0
+        self.sleeps = []
+        monkeypatch.setattr(call_loculus, "get_status_counts", lambda config: self.poll())
+        monkeypatch.setattr(call_loculus, "approve", lambda config: ["entry"] * self.approvable)
+        monkeypatch.setattr(call_loculus, "monotonic", lambda: self.now)
+        monkeypatch.setattr(call_loculus, "sleep", self.sleep)
+
+    def poll(self):
+        counts = self.polls.pop(0) if len(self.polls) > 1 else self.polls[0]
+        self.approvable = counts.get("AWAITING_APPROVAL", 0)
+        return counts
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def flag(tmp_path, name, mtime):
+    path = tmp_path / name
+    path.touch()
+    os.utime(path, (mtime, mtime))
+    return str(path)
+
+
+def test_approve_stops_once_flags_of_this_run_exist(tmp_path, monkeypatch):
+    fake = FakeApproval(
+        monkeypatch,
+        [{"IN_PROCESSING": 2}, {"AWAITING_APPROVAL": 2}, {"IN_PROCESSING": 1}, {}],
+    )
+    wait_for = (flag(tmp_path, "submitted", 200), flag(tmp_path, "revised", 200))
+    approve_until_done(CONFIG, 30, wait_for, run_started=100)
+    # Backs off while idle, starting at APPROVE_MIN_WAIT_SECONDS, and resets after approving
+    assert fake.sleeps == [5, 5, 5]
+
+
+def test_approve_waits_for_all_flags_until_timeout(tmp_path, monkeypatch):
+    fake = FakeApproval(monkeypatch, [{}])
+    # The revoked flag is from an earlier run
+    wait_for = (flag(tmp_path, "submitted", 200), flag(tmp_path, "revoked", 50))
+    approve_until_done(CONFIG, 3, wait_for, run_started=100)
+    assert fake.sleeps == [5, 10, 20, 40, 60]
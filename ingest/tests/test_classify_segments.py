@@ -0,0 +1,25 @@
+import random
+
+import numpy as np
+from classify_segments import SegmentClassifier, kmers
+
+
+def random_sequence(length, seed):
+    return "".join(random.Random(seed).choices("ACGT", k=length))  # noqa: S311
+
+
+def test_kmers_skip_ambiguous_nucleotides():
+    assert len(kmers("ACGTACGTACGT", k=4)) == 4  # noqa: PLR2004
+    assert len(kmers("ACGTNTTGC", k=4)) == 2  # noqa: PLR2004
+    assert np.array_equal(kmers("acgt", k=4), kmers("ACGT", k=4))
+    assert len(kmers("ACG", k=4)) == 0
+
+
+def test_sequences_are_assigned_to_the_clearly_best_segment():
+    references = {"L": random_sequence(3000, 1), "S": random_sequence(1000, 2)}
+    classifier = SegmentClassifier(references)
+    assert classifier.classify(references["L"][500:1500]) == "L"
+    assert classifier.classify(references["S"][100:600]) == "S"
+    # Unrelated and chimeric sequences are aligned against all segments
+    assert classifier.classify(random_sequence(800, 3)) is None
+    assert classifier.classify(references["L"][:500] + references["S"][:500]) is None
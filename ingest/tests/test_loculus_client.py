@@ -0,0 +1,113 @@
+import base64
+import json
+import threading
+import time
+from http import HTTPMethod
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+from loculus_client import LoculusClient, iter_json_lines, token_expiry
+
+
+def make_token(number: int, expires_in: float = 3600) -> str:
+    claims = json.dumps({"exp": time.time() + expires_in}).encode()
+    return f"header.{base64.urlsafe_b64encode(claims).decode().rstrip('=')}.{number}"
+
+
+class Backend(BaseHTTPRequestHandler):
+    """Keycloak on /token, NDJSON on all other paths. /locked answers 423 `locked` times.
+    Tokens are numbered in the order they were requested."""
+
+    state: dict
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status: int, body: bytes = b"") -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.state["tokens"] += 1
+        token = make_token(self.state["tokens"], self.state["expires_in"])
+        self.reply(200, json.dumps({"access_token": token}).encode())
+
+    def do_GET(self):
+        self.state["requests"] += 1
+        token_number = int(self.headers["Authorization"].rsplit(".", 1)[1])
+        if token_number in self.state["rejected_tokens"]:
+            self.reply(401)
+        elif self.path == "/locked" and self.state["locked"]:
+            self.state["locked"] -= 1
+            self.reply(423)
+        else:
+            self.reply(200, b'{"a": 1}\n{"a": 2}\n')
+
+
+@pytest.fixture
+def backend():
+    state = {"tokens": 0, "requests": 0, "locked": 0, "rejected_tokens": set(), "expires_in": 3600}
+    handler = type("Handler", (Backend,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state["url"] = f"http://127.0.0.1:{server.server_port}"
+    yield state
+    server.shutdown()
+    server.server_close()
+
+
+def client(backend, **kwargs) -> LoculusClient:
+    return LoculusClient(f"{backend['url']}/token", "backend-client", "user", "password", **kwargs)
+
+
+def test_token_expiry():
+    assert token_expiry(make_token(1, expires_in=100)) == pytest.approx(time.time() + 100, abs=2)
+    assert not token_expiry("not-a-jwt")
+
+
+def test_token_is_reused_until_it_expires(backend):
+    loculus = client(backend)
+    for _ in range(3):
+        response = loculus.request(HTTPMethod.GET, f"{backend['url']}/entries", stream=True)
+        assert list(iter_json_lines(response, "/entries")) == [{"a": 1}, {"a": 2}]
+    assert backend["tokens"] == 1
+
+    backend["expires_in"] = 30  # Within the expiry margin
+    loculus.invalidate_jwt(loculus.token)
+    loculus.request(HTTPMethod.GET, f"{backend['url']}/entries")
+    loculus.request(HTTPMethod.GET, f"{backend['url']}/entries")
+    assert backend["tokens"] == 3  # noqa: PLR2004
+
+
+def test_rejected_token_is_renewed_once(backend):
+    loculus = client(backend)
+    loculus.request(HTTPMethod.GET, f"{backend['url']}/entries")
+    backend["rejected_tokens"] = {1}
+    assert loculus.request(HTTPMethod.GET, f"{backend['url']}/entries").ok
+    assert backend["tokens"] == 2  # noqa: PLR2004
+
+    backend["rejected_tokens"] = {2, 3}
+    with pytest.raises(requests.HTTPError, match="401"):
+        loculus.request(HTTPMethod.GET, f"{backend['url']}/entries")
+
+
+def test_locked_is_retried_a_bounded_number_of_times(backend):
+    backend["locked"] = 2
+    loculus = client(backend, locked_retry_seconds=0, max_locked_retries=2)
+    assert loculus.request(HTTPMethod.GET, f"{backend['url']}/locked").ok
+    assert backend["requests"] == 3  # noqa: PLR2004
+
+    backend["locked"] = 3
+    with pytest.raises(requests.HTTPError, match="423"):
+        loculus.request(HTTPMethod.GET, f"{backend['url']}/locked")
+
+
+def test_locked_fails_by_default(backend):
+    backend["locked"] = 1
+    with pytest.raises(requests.HTTPError, match="423"):
+        client(backend).request(HTTPMethod.GET, f"{backend['url']}/locked")
+    assert backend["requests"] == 1
@@ -0,0 +1,26 @@
+import pytest
+from metadata_io import iter_metadata, load_metadata, write_metadata
+
+RECORDS = {
+    "A1.1": {"hash": "h1", "country": "Uganda"},
+    "A2.1": {"hash": "h2", "country": ""},
+}
+
+
+@pytest.mark.parametrize("name", ["metadata.json", "metadata.ndjson", "metadata.ndjson.gz"])
+def test_roundtrip(tmp_path, name):
+    path = str(tmp_path / name)
+    write_metadata(path, RECORDS.items())
+    assert load_metadata(path) == RECORDS
+    assert list(iter_metadata(path, ["hash"])) == [
+        ("A1.1", {"hash": "h1"}),
+        ("A2.1", {"hash": "h2"}),
+    ]
+
+
+@pytest.mark.parametrize("name", ["metadata.json", "metadata.ndjson"])
+def test_missing_field_names_id_and_field(tmp_path, name):
+    path = str(tmp_path / name)
+    write_metadata(path, [("A1.1", {"hash": "h1"})])
+    with pytest.raises(ValueError, match=r"A1\.1 is missing the field\(s\) country"):
+        list(iter_metadata(path, ["hash", "country"]))
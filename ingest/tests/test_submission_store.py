@@ -0,0 +1,90 @@
+import json
+import sqlite3
+
+import pytest
+from submission_store import (
+    APPROVED_FOR_RELEASE,
+    OriginalMetadataCache,
+    PreviousSubmission,
+    PreviousSubmissions,
+    SubmissionStoreWriter,
+)
+
+# (insdc accession, loculus accession, joint accession, version, hash, status)
+VERSIONS = [
+    ("OQ1", "LOC_1", "OQ1.L/OQ2.M", 1, "h1", APPROVED_FOR_RELEASE),
+    ("OQ1", "LOC_1", "OQ1.L/OQ2.M", 3, "h3", "HAS_ERRORS"),
+    ("OQ1", "LOC_1", "OQ1.L/OQ2.M", 2, "h2", APPROVED_FOR_RELEASE),
+    ("OQ2", "LOC_1", "OQ1.L/OQ2.M", 1, "h1", APPROVED_FOR_RELEASE),
+]
+
+
+def write_json(path, versions):
+    submitted = {}
+    for insdc, loculus, joint, version, hash_value, status in versions:
+        submission = submitted.setdefault(
+            insdc, {"loculus_accession": loculus, "jointAccession": joint, "versions": []}
+        )
+        submission["versions"].append({"version": version, "hash": hash_value, "status": status})
+    path.write_text(json.dumps(submitted), encoding="utf-8")
+
+
+def write_sqlite(path, versions):
+    writer = SubmissionStoreWriter(str(path))
+    for version in versions:
+        writer.add_version(*version)
+    count = writer.count()
+    writer.close()
+    return count
+
+
+def test_sqlite_store_matches_json(tmp_path):
+    write_json(tmp_path / "submitted.json", VERSIONS)
+    assert write_sqlite(tmp_path / "submitted.sqlite", VERSIONS) == 2  # noqa: PLR2004
+
+    for name in ["submitted.json", "submitted.sqlite"]:
+        submissions = PreviousSubmissions(str(tmp_path / name))
+        assert submissions.get("OQ1") == PreviousSubmission(
+            "LOC_1", "OQ1.L/OQ2.M", "h3", "HAS_ERRORS"
+        )
+        assert submissions.get("OQ2").latest_hash == "h1"
+        assert submissions.get("OQ3") is None
+        submissions.close()
+
+
+def test_store_only_keeps_latest_versions(tmp_path):
+    path = tmp_path / "submitted.sqlite"
+    write_sqlite(path, VERSIONS)
+    connection = sqlite3.connect(path)
+    tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master")}
+    connection.close()
+    assert "versions" not in tables
+
+
+def test_insdc_accession_with_several_loculus_accessions_is_rejected(tmp_path):
+    writer = SubmissionStoreWriter(str(tmp_path / "submitted.sqlite"))
+    writer.add_version("OQ1", "LOC_1", "OQ1", 1, "h1", APPROVED_FOR_RELEASE)
+    with pytest.raises(ValueError, match="multiple loculus accessions"):
+        writer.add_version("OQ1", "LOC_2", "OQ1", 1, "h1", APPROVED_FOR_RELEASE)
+
+
+def test_original_metadata_cache_keeps_approved_versions(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    entries = [
+        {"accession": "LOC_1", "version": 1, "originalMetadata": {"hash": "h1"}},
+        {"accession": "LOC_1", "version": 2, "originalMetadata": {"hash": "h2"}},
+    ]
+    statuses = {"LOC_1": {1: APPROVED_FOR_RELEASE, 2: "HAS_ERRORS"}}
+    cache = OriginalMetadataCache(path, ["hash"])
+    assert list(cache.add_approved(entries, statuses)) == entries
+    cache.close()
+
+    cache = OriginalMetadataCache(path, ["hash"])
+    assert cache.versions() == {("LOC_1", 1)}
+    assert list(cache.entries()) == entries[:1]
+    cache.close()
+
+    # Entries cached with other fields are dropped
+    cache = OriginalMetadataCache(path, ["hash", "insdcAccessionBase"])
+    assert cache.versions() == set()
+    cache.close()
@@ -1,7 +1,10 @@
 import logging
 
 from .config import get_config
-from .prepro import run
+from .logging_config import configure_logging
+from .prepro import run, run_organisms
+from .shutdown import shutdown
+from .tracing import tracer
 
 
 def cli_entry() -> None:
@@ -9,11 +12,19 @@ def cli_entry() -> None:
 
     config = get_config()
 
-    logging.getLogger().setLevel(config.log_level)
+    configure_logging(config)
 
     logging.info(f"Using config: {config}")
 
-    run(config)
+    shutdown.install(config)
+
+    try:
+        if config.organism_config_files:
+            run_organisms(config)
+        else:
+            run(config)
+    finally:
+        tracer.close()
 
 
 if __name__ == "__main__":
@@ -4,6 +4,7 @@ import dataclasses
 import datetime as dt
 import json
 import logging
+import threading
 import time
 from collections.abc import Sequence
 from http import HTTPStatus
@@ -12,37 +13,146 @@ from pathlib import Path
 import jwt
 import pytz
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 from .config import Config
 from .datatypes import (
     ProcessedEntry,
 )
+from .shutdown import shutdown
+
+CONNECT_TIMEOUT_SECONDS = 10
+READ_TIMEOUT_SECONDS = 10
+# Read timeouts grow with the amount of data that is sent or requested
+SUBMIT_TIMEOUT_SECONDS_PER_MIB = 5
+FETCH_TIMEOUT_SECONDS_PER_ENTRY = 0.1
+# Renew the JWT this long before it expires, must be more than the 5 minutes JwtCache requires
+REFRESH_JWT_BEFORE_EXPIRY = dt.timedelta(minutes=10)
+MIN_JWT_REFRESH_INTERVAL_SECONDS = 10
+# Enough connections for the threads of a worker serving several organisms
+CONNECTION_POOL_SIZE = 16
+
+
+def create_session(retry: Retry) -> requests.Session:
+    """Session that keeps connections alive between batches"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=CONNECTION_POOL_SIZE, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Requesting a token can be repeated safely, retry on connection errors and server errors
+keycloak_session = create_session(
+    Retry(
+        total=5,
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=None,
+        raise_on_status=False,
+    )
+)
+# Fetching leases entries and submitting isn't idempotent: only retry if the request wasn't sent
+backend_session = create_session(
+    Retry(
+        total=3,
+        connect=3,
+        read=0,
+        status=0,
+        other=0,
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+    )
+)
 
 
 class JwtCache:
-    def __init__(self) -> None:
+    """Token of one set of Keycloak credentials, renewed in the background while it is in use"""
+
+    def __init__(self, config: Config) -> None:
+        self.config = config
+        self.lock = threading.Lock()
         self.token: str = ""
-        self.expiration: dt.datetime = dt.datetime.min
+        self.expiration: dt.datetime = dt.datetime.min.replace(tzinfo=pytz.UTC)
+        self.refresher: threading.Thread | None = None
+        self.used = False
 
     def get_token(self) -> str | None:
         # Only use token if it's got more than 5 minutes left
-        if self.token and self.expiration > dt.datetime.now(tz=pytz.UTC) + dt.timedelta(minutes=5):
-            return self.token
+        with self.lock:
+            if self.token and self.expiration > dt.datetime.now(tz=pytz.UTC) + dt.timedelta(
+                minutes=5
+            ):
+                self.used = True
+                return self.token
         return None
 
     def set_token(self, token: str, expiration: dt.datetime):
-        self.token = token
-        self.expiration = expiration
-
-
-jwt_cache = JwtCache()
+        with self.lock:
+            self.token = token
+            self.expiration = expiration
+
+    def start_refresher(self) -> None:
+        """Renew the token in the background before it expires, so batches don't wait for it"""
+        with self.lock:
+            self.used = True
+            if self.refresher:
+                return
+            self.refresher = threading.Thread(
+                target=self._refresh, name="jwt-refresher", daemon=True
+            )
+        self.refresher.start()
+
+    def _refresh(self) -> None:
+        while True:
+            with self.lock:
+                remaining = self.expiration - dt.datetime.now(tz=pytz.UTC)
+            # Tokens that are valid for less than REFRESH_JWT_BEFORE_EXPIRY: refresh halfway
+            delay = max(remaining - REFRESH_JWT_BEFORE_EXPIRY, remaining / 2).total_seconds()
+            time.sleep(max(delay, MIN_JWT_REFRESH_INTERVAL_SECONDS))
+            with self.lock:
+                # e.g. the credentials changed on a config reload
+                if not self.used:
+                    self.refresher = None
+                    return
+                self.used = False
+            try:
+                request_jwt(self.config)
+            except Exception as e:
+                logging.warning("Refreshing JWT failed, retrying: %s", e)
+
+
+# Organisms served by one worker may use different Keycloak instances or users
+jwt_caches: dict[tuple[str, str, str, str], JwtCache] = {}
+jwt_caches_lock = threading.Lock()
+
+
+def jwt_cache_for(config: Config) -> JwtCache:
+    key = (
+        config.keycloak_host,
+        config.keycloak_token_path,
+        config.keycloak_user,
+        config.keycloak_password,
+    )
+    with jwt_caches_lock:
+        if key not in jwt_caches:
+            jwt_caches[key] = JwtCache(config)
+        return jwt_caches[key]
 
 
 def get_jwt(config: Config) -> str:
-    if cached_token := jwt_cache.get_token():
+    cache = jwt_cache_for(config)
+    if cached_token := cache.get_token():
         logging.debug("Using cached JWT")
         return cached_token
+    token = request_jwt(config)
+    cache.start_refresher()
+    return token
+
 
+def request_jwt(config: Config) -> str:
     url = config.keycloak_host.rstrip("/") + "/" + config.keycloak_token_path.lstrip("/")
     data = {
         "client_id": "backend-client",
@@ -51,15 +161,16 @@ def get_jwt(config: Config) -> str:
         "grant_type": "password",
     }
 
-    logging.debug(f"Requesting JWT from {url}")
+    logging.debug("Requesting JWT from %s", url)
 
-    with requests.post(url, data=data, timeout=10) as response:
+    timeout = (CONNECT_TIMEOUT_SECONDS, READ_TIMEOUT_SECONDS)
+    with keycloak_session.post(url, data=data, timeout=timeout) as response:
         if response.ok:
             logging.debug("JWT fetched successfully.")
             token = response.json()["access_token"]
             decoded = jwt.decode(token, options={"verify_signature": False})
             expiration = dt.datetime.fromtimestamp(decoded.get("exp", 0), tz=pytz.UTC)
-            jwt_cache.set_token(token, expiration)
+            jwt_cache_for(config).set_token(token, expiration)
             return token
         error_msg = f"Fetching JWT failed with status code {response.status_code}: {response.text}"
         logging.error(error_msg)
@@ -68,14 +179,15 @@ def get_jwt(config: Config) -> str:
 
 def fetch_unprocessed_sequences(n: int, config: Config) -> str:
     url = config.backend_host.rstrip("/") + "/extract-unprocessed-data"
-    logging.debug(f"Fetching {n} unprocessed sequences from {url}")
+    logging.debug("Fetching %s unprocessed sequences from %s", n, url)
     params = {"numberOfSequenceEntries": n, "pipelineVersion": config.pipeline_version}
     headers = {"Authorization": "Bearer " + get_jwt(config)}
-    response = requests.post(url, data=params, headers=headers, timeout=10)
+    timeout = (CONNECT_TIMEOUT_SECONDS, READ_TIMEOUT_SECONDS + n * FETCH_TIMEOUT_SECONDS_PER_ENTRY)
+    response = backend_session.post(url, data=params, headers=headers, timeout=timeout)
     if not response.ok:
         if response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY:
             logging.debug(f"{response.text}.\nSleeping for a while.")
-            time.sleep(60 * 1)
+            shutdown.sleep(60 * 1)
             return ""
         msg = f"Fetching unprocessed data failed. Status code: {
             response.status_code}"
@@ -102,7 +214,15 @@ def submit_processed_sequences(
         "Authorization": "Bearer " + get_jwt(config),
     }
     params = {"pipelineVersion": config.pipeline_version}
-    response = requests.post(url, data=ndjson_string, headers=headers, params=params, timeout=10)
+    payload = ndjson_string.encode("utf-8")
+    read_timeout = READ_TIMEOUT_SECONDS + SUBMIT_TIMEOUT_SECONDS_PER_MIB * len(payload) / 2**20
+    response = backend_session.post(
+        url,
+        data=payload,
+        headers=headers,
+        params=params,
+        timeout=(CONNECT_TIMEOUT_SECONDS, read_timeout),
+    )
     if not response.ok:
         Path("failed_submission.json").write_text(ndjson_string, encoding="utf-8")
         msg = (
@@ -27,21 +27,38 @@ class Config:
     nextclade_dataset_tag: str | None = None
     nextclade_dataset_server: str = "https://data.clades.nextstrain.org/v3"
     config_file: str | None = None
-    log_level: str = "DEBUG"
+    reload_config_file: bool = False  # Reload config between batches when config_file changes
+    log_level: str = "INFO"
+    log_format: str = "text"  # "text" or "json" (one JSON object per line)
+    log_sample_rate: int = 1  # Only log every n-th DEBUG/INFO record of each log call
     genes: list[str] = dataclasses.field(default_factory=list)
     nucleotideSequences: list[str] = dataclasses.field(default_factory=lambda: ["main"])
     keep_tmp_dir: bool = False
+    work_dir: str | None = None  # Parent of temporary nextclade result dirs, e.g. /dev/shm
+    minimal_nextclade_output: bool = False  # Only write nextclade outputs that are parsed
+    nextclade_streaming: bool = False  # Stream in/outputs of nextclade through pipes, see prepro
+    nextclade_timeout_seconds: float = 3600  # Kill streaming nextclade runs that take longer
     reference_length: int = 197209
     batch_size: int = 5
+    memory_budget_mb: int = 0  # Split batches estimated to need more memory, 0 disables
+    ingest_batch_size: int = 0  # Batch insdc_ingest_user entries separately, 0 disables, see lanes
+    ingest_max_wait_seconds: float = 30  # Process incomplete ingest batches after this time
+    user_lane_cpu_share: float = 0.5  # Share of processing time for user submissions under load
+    shutdown_deadline_seconds: float = 25  # Exit after SIGTERM even if fetched batches aren't done
     processing_spec: dict[str, dict[str, Any]] = dataclasses.field(default_factory=dict)
     pipeline_version: int = 1
+    trace_file: str | None = None  # Append tracing spans as JSON lines to this file
+    trace_otlp_endpoint: str | None = None  # e.g. http://otel-collector:4318/v1/traces
+    # Serve several organisms (or pipeline versions) from one worker: comma-separated config files
+    organism_config_files: str | None = None
+    organism_workers: int = 0  # Concurrent batches across all organisms, 0: one per organism
 
 
 def load_config_from_yaml(config_file: str, config: Config) -> Config:
     config = copy.deepcopy(config)
     with open(config_file, encoding="utf-8") as file:
         yaml_config = yaml.safe_load(file)
-        logging.debug(f"Loaded config from {config_file}: {yaml_config}")
+        logging.debug("Loaded config from %s: %s", config_file, yaml_config)
     for key, value in yaml_config.items():
         if value is not None and hasattr(config, key):
             setattr(config, key, value)
@@ -68,15 +85,81 @@ def generate_argparse_from_dataclass(config_cls: type[Config]) -> argparse.Argum
         if field_type not in CLI_TYPES:
             continue
         if field_type is bool:  # Special case for boolean flags
-            parser.add_argument(f"--{field_name}", action="store_true")
+            # Default to None so that unset flags don't override values from the config file
+            parser.add_argument(f"--{field_name}", action="store_true", default=None)
             parser.add_argument(
-                f"--no-{field_name}", dest=field_name.replace("-", "_"), action="store_false"
+                f"--no-{field_name}",
+                dest=field_name.replace("-", "_"),
+                action="store_false",
+                default=None,
             )
         else:
             parser.add_argument(f"--{field_name}", type=field_type)
     return parser
 
 
+def config_file_mtime(config: Config) -> float | None:
+    if not config.config_file:
+        return None
+    try:
+        return os.stat(config.config_file).st_mtime
+    except OSError:
+        return None
+
+
+# Keys identifying the organism of an organism config, not overridden by CLI args or ENV variables
+ORGANISM_KEYS = {"organism", "backend_host", "config_file", "organism_config_files"}
+
+
+def get_organism_configs(config: Config, overrides: dict[str, Any] | None = None) -> list[Config]:
+    """
+    Configs of the organisms in `organism_config_files`, each loaded on top of `config`.
+    `overrides` (by default those of the CLI args and ENV variables, see `get_overrides`) take
+    precedence over the organism config files, except for the `ORGANISM_KEYS`.
+    If an organism config doesn't set backend_host, the organism in the path of the
+    backend_host of `config` is replaced, e.g. http://backend/ebola-zaire -> http://backend/cchf
+    """
+    if overrides is None:
+        overrides = get_overrides()
+    # Comma-separated on the command line, YAML config files can also use a list
+    files: str | list[str] = config.organism_config_files or []
+    if isinstance(files, str):
+        files = [file.strip() for file in files.split(",") if file.strip()]
+    backend_base = config.backend_host.rstrip("/").removesuffix(f"/{config.organism}")
+    organism_configs = []
+    for file in files:
+        organism_config = load_config_from_yaml(file, config)
+        for key, value in overrides.items():
+            if key not in ORGANISM_KEYS:
+                setattr(organism_config, key, value)
+        organism_config.config_file = file
+        organism_config.organism_config_files = None
+        if organism_config.backend_host == config.backend_host:
+            organism_config.backend_host = f"{backend_base}/{organism_config.organism}"
+        organism_configs.append(organism_config)
+    return organism_configs
+
+
+def get_overrides(args: argparse.Namespace | None = None) -> dict[str, Any]:
+    """Config values set by ENV variables and CLI args (parsed from sys.argv by default)"""
+    if args is None:
+        args = generate_argparse_from_dataclass(Config).parse_args()
+    overrides: dict[str, Any] = {}
+
+    # Use environment variables if available
+    for field in dataclasses.fields(Config):
+        env_var = f"PREPROCESSING_{field.name.upper()}"
+        if env_var in os.environ:
+            overrides[field.name] = os.environ[env_var]
+
+    # Overwrite config with CLI args
+    for key, value in args.__dict__.items():
+        if value is not None:
+            overrides[key] = value
+
+    return overrides
+
+
 def get_config() -> Config:
     # Config precedence: CLI args > ENV variables > config file > default
 
@@ -96,15 +179,8 @@ def get_config() -> Config:
     if not config.backend_host:  # Check if backend_host wasn't set during initialization
         config.backend_host = f"http://127.0.0.1:8079/{config.organism}"
 
-    # Use environment variables if available
-    for key in config.__dict__:
-        env_var = f"PREPROCESSING_{key.upper()}"
-        if env_var in os.environ:
-            setattr(config, key, os.environ[env_var])
-
-    # Overwrite config with CLI args
-    for key, value in args.__dict__.items():
-        if value is not None:
-            setattr(config, key, value)
+    # ENV variables and CLI args take precedence over the config file
+    for key, value in get_overrides(args).items():
+        setattr(config, key, value)
 
     return config
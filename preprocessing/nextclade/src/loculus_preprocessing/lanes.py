@@ -0,0 +1,112 @@
+"""Schedule fetched entries into a latency lane for user submissions and a throughput lane for bulk
+INSDC ingest, so that users don't wait for their submissions behind large ingest batches.
+
+User submissions are processed immediately in batches of `batch_size`. Ingest entries are buffered
+until `ingest_batch_size` entries are available, no more entries are waiting in the backend or the
+oldest buffered entry has waited `ingest_max_wait_seconds` (entries are leased by the backend and
+must be submitted before they go stale). When both lanes have work, processing time is shared
+according to `user_lane_cpu_share`: the lane with the lowest processing time divided by its share
+is served next.
+"""
+
+import logging
+from collections.abc import Sequence
+from dataclasses import dataclass, field
+
+from .config import Config
+from .datatypes import UnprocessedEntry
+
+logger = logging.getLogger(__name__)
+
+INGEST_SUBMITTER = "insdc_ingest_user"
+
+
+@dataclass
+class Lane:
+    name: str
+    batch_size: int
+    cpu_share: float
+    max_wait_seconds: float
+    pending: list[UnprocessedEntry] = field(default_factory=list)
+    oldest_pending_at: float = 0.0
+    # Processing seconds divided by cpu_share
+    virtual_time: float = 0.0
+
+    def ready(self, now: float, drain: bool) -> bool:
+        if not self.pending:
+            return False
+        return (
+            drain
+            or len(self.pending) >= self.batch_size
+            or now - self.oldest_pending_at >= self.max_wait_seconds
+        )
+
+
+class LaneScheduler:
+    def __init__(self, config: Config) -> None:
+        self.check_config(config)
+        self.user = Lane(
+            name="user",
+            batch_size=config.batch_size,
+            cpu_share=config.user_lane_cpu_share,
+            max_wait_seconds=0,
+        )
+        self.ingest = Lane(
+            name="ingest",
+            batch_size=config.ingest_batch_size,
+            cpu_share=1 - config.user_lane_cpu_share,
+            max_wait_seconds=config.ingest_max_wait_seconds,
+        )
+        self.lanes = [self.user, self.ingest]
+
+    @staticmethod
+    def check_config(config: Config) -> None:
+        if not 0 < config.user_lane_cpu_share < 1:
+            msg = f"user_lane_cpu_share must be between 0 and 1, got {config.user_lane_cpu_share}"
+            raise ValueError(msg)
+
+    def reconfigure(self, config: Config) -> None:
+        """Apply batch sizes, shares and waits of a reloaded config, keeping the pending entries"""
+        self.check_config(config)
+        self.user.batch_size = config.batch_size
+        self.user.cpu_share = config.user_lane_cpu_share
+        self.ingest.batch_size = config.ingest_batch_size
+        self.ingest.cpu_share = 1 - config.user_lane_cpu_share
+        self.ingest.max_wait_seconds = config.ingest_max_wait_seconds
+
+    def wants_more(self) -> bool:
+        """Only fetch once user submissions are processed and while ingest batches aren't full,
+        so that no more entries are leased than can be processed before they go stale"""
+        return not self.user.pending and len(self.ingest.pending) < self.ingest.batch_size
+
+    def has_pending(self) -> bool:
+        return any(lane.pending for lane in self.lanes)
+
+    def add(self, entries: Sequence[UnprocessedEntry], now: float) -> None:
+        for entry in entries:
+            lane = self.ingest if entry.data.submitter == INGEST_SUBMITTER else self.user
+            if not lane.pending:
+                lane.oldest_pending_at = now
+                # A lane that was idle doesn't get to make up for the time it didn't use
+                busy = [other.virtual_time for other in self.lanes if other.pending]
+                lane.virtual_time = max(lane.virtual_time, min(busy, default=0.0))
+            lane.pending.append(entry)
+
+    def next_batch(self, now: float, drain: bool) -> tuple[Lane, list[UnprocessedEntry]] | None:
+        """The next batch to process, `drain` also releases partially filled batches"""
+        ready = [lane for lane in self.lanes if lane.ready(now, drain)]
+        if not ready:
+            return None
+        lane = min(ready, key=lambda lane: lane.virtual_time)
+        batch, lane.pending = lane.pending[: lane.batch_size], lane.pending[lane.batch_size :]
+        logger.debug(
+            "Processing %s entries from %s lane, %s pending",
+            len(batch),
+            lane.name,
+            len(lane.pending),
+        )
+        return lane, batch
+
+    @staticmethod
+    def record(lane: Lane, seconds: float) -> None:
+        lane.virtual_time += seconds / lane.cpu_share
@@ -0,0 +1,78 @@
+"""Logging setup: plain text or JSON lines, with optional sampling of repetitive records.
+
+Log calls on hot paths (once per entry or per processing function call) use lazy %-formatting,
+so that records below the log level or dropped by sampling are never formatted.
+"""
+
+import json
+import logging
+import threading
+from collections import Counter
+
+from .config import Config
+
+LOG_FORMATS = ("text", "json")
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Only let through every `rate`-th DEBUG or INFO record of each log call site, e.g. the
+    per-entry debug logs. Warnings and errors are never sampled.
+    """
+
+    def __init__(self, rate: int) -> None:
+        super().__init__()
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.counts: Counter[tuple[str, int]] = Counter()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate <= 1 or record.levelno >= logging.WARNING:
+            return True
+        key = (record.pathname, record.lineno)
+        with self.lock:
+            count = self.counts[key]
+            self.counts[key] = count + 1
+        if count % self.rate:
+            return False
+        record.sample_rate = self.rate
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if hasattr(record, "sample_rate"):
+            entry["sample_rate"] = record.sample_rate
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def check_logging_config(config: Config) -> None:
+    if config.log_format not in LOG_FORMATS:
+        msg = f"Unknown log_format {config.log_format}, expected one of {LOG_FORMATS}"
+        raise ValueError(msg)
+    if not isinstance(config.log_sample_rate, int) or config.log_sample_rate < 1:
+        msg = f"log_sample_rate must be a positive integer, got {config.log_sample_rate}"
+        raise ValueError(msg)
+    if config.log_level not in logging.getLevelNamesMapping():
+        msg = f"Unknown log_level {config.log_level}"
+        raise ValueError(msg)
+
+
+def configure_logging(config: Config) -> None:
+    """(Re)configure the root logger according to `log_level`, `log_format` and `log_sample_rate`"""
+    check_logging_config(config)
+    handler = logging.StreamHandler()
+    if config.log_format == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    handler.addFilter(SamplingFilter(config.log_sample_rate))
+    logging.basicConfig(level=config.log_level, handlers=[handler], force=True)
@@ -0,0 +1,129 @@
+"""Estimate the memory needed to process a batch and split batches that would exceed the budget.
+Also measures the peak resident set size of each (sub-)batch and of the nextclade runs in it.
+"""
+
+import logging
+import os
+import resource
+import subprocess  # noqa: S404
+import threading
+import time
+from collections.abc import Sequence
+from pathlib import Path
+
+from .config import Config
+from .datatypes import UnprocessedEntry
+
+logger = logging.getLogger(__name__)
+
+MIB = 1024 * 1024
+
+# Number of copies of each sequence that are alive at the same time while processing a batch:
+# Unaligned: fetched payload, parsed entry, nextclade input, processed entry, submission payload
+UNALIGNED_COPIES = 5
+# Aligned: parsed nextclade output, masked sequence, processed entry, submission payload
+ALIGNED_COPIES = 4
+# Overhead per sequence object (dict entries, insertions, nextclade json results)
+PER_SEQUENCE_OVERHEAD = 16 * 1024
+CHILD_POLL_SECONDS = 0.05
+
+# Peak RSS of the child processes waited for by each (batch processing) thread since reset
+_children = threading.local()
+
+
+def estimate_entry_bytes(entry: UnprocessedEntry, config: Config) -> int:
+    """Rough estimate of the working set of a single entry during processing.
+    Aligned nucleotide sequences are bounded by the reference length,
+    amino acid sequences of all genes by a third of it."""
+    unaligned_length = sum(
+        len(sequence) for sequence in entry.data.unalignedNucleotideSequences.values() if sequence
+    )
+    estimate = UNALIGNED_COPIES * unaligned_length
+    if config.nextclade_dataset_name:
+        estimate += ALIGNED_COPIES * (config.reference_length + config.reference_length // 3)
+        estimate += PER_SEQUENCE_OVERHEAD * (len(config.nucleotideSequences) + len(config.genes))
+    return estimate
+
+
+def split_by_memory_budget(
+    unprocessed: Sequence[UnprocessedEntry], config: Config
+) -> list[Sequence[UnprocessedEntry]]:
+    """Split a batch into sub-batches that are processed sequentially so that the estimated
+    working set of each sub-batch stays below `memory_budget_mb`. A single entry that exceeds
+    the budget on its own is still processed, in a sub-batch of its own."""
+    if not config.memory_budget_mb or not unprocessed:
+        return [unprocessed]
+    budget = config.memory_budget_mb * MIB
+    sub_batches: list[Sequence[UnprocessedEntry]] = []
+    current: list[UnprocessedEntry] = []
+    current_bytes = 0
+    for entry in unprocessed:
+        entry_bytes = estimate_entry_bytes(entry, config)
+        if current and current_bytes + entry_bytes > budget:
+            sub_batches.append(current)
+            current, current_bytes = [], 0
+        current.append(entry)
+        current_bytes += entry_bytes
+    sub_batches.append(current)
+    if len(sub_batches) > 1:
+        logger.info(
+            "Estimated working set of batch of %s entries exceeds memory budget of %s MiB, "
+            "splitting into %s sub-batches",
+            len(unprocessed),
+            config.memory_budget_mb,
+            len(sub_batches),
+        )
+    return sub_batches
+
+
+def reset_peak_rss(*, process: bool = True) -> None:
+    """Reset the peak RSS ("high water mark") of this process to its current RSS (Linux only)
+    and forget the child processes this thread waited for so far. The process-wide reset affects
+    all threads, pass `process=False` to only forget the child processes of this thread."""
+    _children.peak_rss_mib = 0.0
+    if not process:
+        return
+    try:
+        Path("/proc/self/clear_refs").write_text("5", encoding="utf-8")
+    except OSError:
+        logger.debug("Cannot reset peak RSS, reporting peak since process start")
+
+
+def peak_rss_mib() -> float:
+    """Peak RSS of this process since the last `reset_peak_rss()`"""
+    try:
+        for line in Path("/proc/self/status").read_text(encoding="utf-8").splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux and covers the whole lifetime of the process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def wait_child(process: subprocess.Popen, timeout: float | None = None) -> int:
+    """Wait for a child process like `Popen.wait` and record its own peak RSS (`ru_maxrss` of
+    `wait4`) for `peak_rss_children_mib`. Raises subprocess.TimeoutExpired after `timeout`."""
+    if process.returncode is not None:
+        return process.returncode
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        try:
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        except ChildProcessError:  # Already reaped, e.g. by Popen.poll() in another thread
+            return process.wait()
+        if pid:
+            break
+        if deadline is not None and time.monotonic() > deadline:
+            raise subprocess.TimeoutExpired(process.args, timeout or 0)
+        time.sleep(CHILD_POLL_SECONDS)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in KiB on Linux
+    _children.peak_rss_mib = max(peak_rss_children_mib(), usage.ru_maxrss / 1024)
+    return process.returncode
+
+
+def peak_rss_children_mib() -> float:
+    """Largest peak RSS of the child processes (i.e. nextclade) this thread waited for with
+    `wait_child` since the last `reset_peak_rss()`"""
+    return getattr(_children, "peak_rss_mib", 0.0)
@@ -4,20 +4,25 @@ import json
 import logging
 import os
 import re
+import shutil
 import subprocess  # noqa: S404
 import sys
+import threading
 import time
 from collections import defaultdict
 from collections.abc import Sequence
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
 from pathlib import Path
-from tempfile import TemporaryDirectory
+from tempfile import TemporaryDirectory, mkdtemp
 from typing import Any, Literal, TypeVar
+from urllib.parse import unquote
 
 import dpath
 from Bio import SeqIO
 
 from .backend import fetch_unprocessed_sequences, submit_processed_sequences
-from .config import Config
+from .config import Config, config_file_mtime, get_config, get_organism_configs
 from .datatypes import (
     AccessionVersion,
     AminoAcidInsertion,
@@ -39,8 +44,24 @@ from .datatypes import (
     UnprocessedData,
     UnprocessedEntry,
 )
-from .processing_functions import ProcessingFunctions, format_frameshift, format_stop_codon
+from .lanes import LaneScheduler
+from .logging_config import check_logging_config, configure_logging
+from .memory_budget import (
+    peak_rss_children_mib,
+    peak_rss_mib,
+    reset_peak_rss,
+    split_by_memory_budget,
+    wait_child,
+)
+from .processing_functions import (
+    ProcessingFunctions,
+    clear_options_cache,
+    format_frameshift,
+    format_stop_codon,
+)
 from .sequence_checks import errors_if_non_iupac
+from .shutdown import shutdown
+from .tracing import tracer
 
 # https://stackoverflow.com/questions/15063936
 csv.field_size_limit(sys.maxsize)
@@ -48,6 +69,14 @@ csv.field_size_limit(sys.maxsize)
 
 GenericSequence = TypeVar("GenericSequence", AminoAcidSequence, NucleotideSequence)
 
+# Weight of the backlog of an organism relative to how long it has been waiting for a worker
+BACKLOG_WEIGHT = 3
+ORGANISM_ERROR_BACKOFF_SECONDS = 10
+# Reader threads of a streaming nextclade run that exited should finish within this time
+NEXTCLADE_READER_JOIN_TIMEOUT_SECONDS = 60
+# GFF3 attributes nextclade takes the name of a CDS from, in order of precedence
+GFF_CDS_NAME_ATTRIBUTES = ["Name", "name", "Alias", "alias", "gene", "gene_name", "locus_tag", "ID"]
+
 
 # Functions related to reading and writing files
 
@@ -108,19 +137,23 @@ def parse_nextclade_tsv(
                 else:
                     logging.debug(
                         "Note: Nextclade found AA insertion in gene missing from config in gene "
-                        f"{gene}: {val}"
+                        "%s: %s",
+                        gene,
+                        val,
                     )
     return amino_acid_insertions, nucleotide_insertions
 
 
 def parse_nextclade_json(
     result_dir,
-    nextclade_metadata: defaultdict[AccessionVersion, defaultdict[SegmentName, dict[str, Any]]],
+    nextclade_metadata: defaultdict[
+        AccessionVersion, defaultdict[SegmentName, dict[str, Any] | None]
+    ],
     segment: SegmentName,
     unaligned_nucleotide_sequences: dict[
         AccessionVersion, dict[SegmentName, NucleotideSequence | None]
     ],
-) -> defaultdict[AccessionVersion, defaultdict[SegmentName, dict[str, Any]]]:
+) -> defaultdict[AccessionVersion, defaultdict[SegmentName, dict[str, Any] | None]]:
     """
     Update nextclade_metadata object with the results of the nextclade analysis.
     If the segment existed in the input (unaligned_nucleotide_sequences) but did not align
@@ -137,6 +170,357 @@ def parse_nextclade_json(
     return nextclade_metadata
 
 
+def nextclade_command(
+    input_file: str, result_dir_seg: str, dataset_dir_seg: str, config: Config
+) -> list[str]:
+    """
+    Build the `nextclade run` command for one segment. With `minimal_nextclade_output` only the
+    outputs that are parsed afterwards are requested instead of `--output-all`, which saves
+    nextclade from serializing the tree, CSV, NDJSON, GFF etc. for every batch.
+    """
+    if config.minimal_nextclade_output:
+        outputs = [
+            f"--output-fasta={result_dir_seg}/nextclade.aligned.fasta",
+            f"--output-json={result_dir_seg}/nextclade.json",
+            f"--output-tsv={result_dir_seg}/nextclade.tsv",
+        ]
+    else:
+        outputs = [f"--output-all={result_dir_seg}"]
+    return [
+        "nextclade3",
+        "run",
+        *outputs,
+        f"--input-dataset={dataset_dir_seg}",
+        f"--output-translations={result_dir_seg}/nextclade.cds_translation.{{cds}}.fasta",
+        "--jobs=1",
+        "--",
+        f"{input_file}",
+    ]
+
+
+def dataset_cds_names(dataset_dir_seg: str) -> set[str] | None:
+    """
+    Names of the CDSs in the genome annotation of a nextclade dataset, as nextclade names their
+    translation files. None if the dataset has no genome annotation, then nothing is translated.
+    """
+    dataset = Path(dataset_dir_seg)
+    annotation_file = "genome_annotation.gff3"
+    if (dataset / "pathogen.json").exists():
+        pathogen = json.loads((dataset / "pathogen.json").read_text(encoding="utf-8"))
+        annotation_file = pathogen.get("files", {}).get("genomeAnnotation", annotation_file)
+    if not (dataset / annotation_file).exists():
+        return None
+    names: set[str] = set()
+    with (dataset / annotation_file).open(encoding="utf-8") as gff:
+        for line in gff:
+            columns = line.rstrip("\n").split("\t")
+            if line.startswith("#") or len(columns) < 9 or columns[2] != "CDS":  # noqa: PLR2004
+                continue
+            attributes = dict(
+                attribute.strip().split("=", 1)
+                for attribute in columns[8].split(";")
+                if "=" in attribute
+            )
+            name = next(
+                (attributes[key] for key in GFF_CDS_NAME_ATTRIBUTES if key in attributes), None
+            )
+            if name:
+                names.add(unquote(name))
+    return names
+
+
+class StreamingNextcladeRun:
+    """
+    Run nextclade for one segment without batch-sized files on disk: the input FASTA is streamed
+    to nextclade's stdin and the aligned sequences, translations, NDJSON and TSV outputs are
+    named pipes (FIFOs) that are parsed by reader threads while nextclade is still aligning.
+    Translations of CDSs of the dataset that aren't in `config.genes` are discarded.
+
+    Results are collected in per-run containers and merged by the caller after `wait()`, so runs
+    for different segments can execute concurrently. If a reader fails, nextclade is killed so
+    that it doesn't block on a pipe nobody reads; `abort()` stops a run that is still going.
+    """
+
+    def __init__(
+        self,
+        segment: SegmentName,
+        sequences: dict[AccessionVersion, NucleotideSequence | None],
+        result_dir_seg: str,
+        dataset_dir_seg: str,
+        config: Config,
+    ) -> None:
+        self.segment = segment
+        self.sequences = sequences
+        self.config = config
+        self.result_dir_seg = result_dir_seg
+        self.aligned_nucleotide_sequences: defaultdict[
+            AccessionVersion, dict[SegmentName, NucleotideSequence | None]
+        ] = defaultdict(dict)
+        self.aligned_aminoacid_sequences: defaultdict[
+            AccessionVersion, dict[GeneName, AminoAcidSequence | None]
+        ] = defaultdict(dict)
+        self.nextclade_results: dict[AccessionVersion, dict[str, Any]] = {}
+        self.nucleotide_insertions: defaultdict[
+            AccessionVersion, defaultdict[SegmentName, list[NucleotideInsertion]]
+        ] = defaultdict(lambda: defaultdict(list))
+        self.amino_acid_insertions: defaultdict[
+            AccessionVersion, defaultdict[GeneName, list[AminoAcidInsertion]]
+        ] = defaultdict(lambda: defaultdict(list))
+        self.reader_errors: list[Exception] = []
+
+        dataset_cds = dataset_cds_names(dataset_dir_seg) or set()
+        # Genes of other segments' datasets are never written by this nextclade run
+        genes = [gene for gene in config.genes if gene in dataset_cds]
+        self.missing_genes = set(config.genes) - dataset_cds
+
+        os.makedirs(result_dir_seg, exist_ok=True)
+        self.aligned_path = result_dir_seg + "/nextclade.aligned.fasta"
+        self.ndjson_path = result_dir_seg + "/nextclade.ndjson"
+        self.tsv_path = result_dir_seg + "/nextclade.tsv"
+        translation_template = result_dir_seg + "/nextclade.cds_translation.{cds}.fasta"
+        self.translation_paths = {gene: translation_template.format(cds=gene) for gene in genes}
+        self.fifo_paths = [
+            self.aligned_path,
+            self.ndjson_path,
+            self.tsv_path,
+            *self.translation_paths.values(),
+        ]
+        for path in self.fifo_paths:
+            os.mkfifo(path)
+        for cds in dataset_cds - set(genes):
+            os.symlink(os.devnull, translation_template.format(cds=cds))
+
+        command = [
+            "nextclade3",
+            "run",
+            f"--output-fasta={self.aligned_path}",
+            f"--output-ndjson={self.ndjson_path}",
+            f"--output-tsv={self.tsv_path}",
+            f"--input-dataset={dataset_dir_seg}",
+            f"--output-translations={translation_template}",
+            "--jobs=1",
+        ]  # Without input files nextclade reads the sequences from stdin
+        logging.debug("Running nextclade: %s", command)
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)  # noqa: S603
+
+        self.threads = [
+            threading.Thread(target=self._write_input),
+            threading.Thread(target=self._read, args=(self._read_aligned,)),
+            threading.Thread(target=self._read, args=(self._read_ndjson,)),
+            threading.Thread(target=self._read, args=(self._read_tsv,)),
+        ] + [
+            threading.Thread(target=self._read, args=(self._read_translation, gene))
+            for gene in genes
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def _write_input(self) -> None:
+        stdin = self.process.stdin
+        assert stdin is not None  # noqa: S101
+        try:
+            for id, sequence in self.sequences.items():
+                stdin.write(f">{id}\n{sequence}\n".encode())
+            stdin.close()
+        except BrokenPipeError:
+            logging.error("nextclade exited before reading all input sequences")
+
+    def _read(self, reader, *args) -> None:
+        try:
+            reader(*args)
+        except Exception as e:
+            logging.exception("Failed to parse streamed nextclade output, stopping nextclade")
+            self.reader_errors.append(e)
+            # Nothing drains this pipe anymore, nextclade would block writing to it
+            self.process.kill()
+
+    def _read_aligned(self) -> None:
+        load_aligned_nuc_sequences(
+            self.result_dir_seg, self.segment, self.aligned_nucleotide_sequences
+        )
+
+    def _read_translation(self, gene: GeneName) -> None:
+        load_aligned_aa_sequences(
+            self.translation_paths[gene], gene, self.aligned_aminoacid_sequences
+        )
+
+    def _read_ndjson(self) -> None:
+        with open(self.ndjson_path, encoding="utf-8") as ndjson:
+            for line in ndjson:
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                # Sequences that failed to align are reported without alignment results
+                if "alignmentScore" not in result:
+                    continue
+                self.nextclade_results[result["seqName"]] = result
+
+    def _read_tsv(self) -> None:
+        parse_nextclade_tsv(
+            self.amino_acid_insertions,
+            self.nucleotide_insertions,
+            self.result_dir_seg,
+            self.config,
+            self.segment,
+        )
+
+    @staticmethod
+    def _release_unopened_pipe(path: str) -> None:
+        """
+        Readers of outputs that nextclade didn't open before it exited (e.g. it failed) block in
+        open() forever. Opening and closing the write end signals EOF to them.
+        """
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError:  # ENXIO: no reader waiting
+            return
+        os.close(fd)
+
+    def _join_threads(self) -> None:
+        """Join the threads once nextclade exited, each pipe nextclade wrote to was opened"""
+        deadline = time.monotonic() + NEXTCLADE_READER_JOIN_TIMEOUT_SECONDS
+        for thread in self.threads:
+            # A reader may only reach open() after the previous release, so release repeatedly
+            while thread.is_alive() and time.monotonic() < deadline:
+                for path in self.fifo_paths:
+                    self._release_unopened_pipe(path)
+                thread.join(timeout=0.1)
+            if thread.is_alive():
+                logging.error("Streaming nextclade thread for %s did not finish", self.segment)
+
+    def abort(self) -> None:
+        """Kill nextclade if it is still running and stop the threads of the run"""
+        if self.process.poll() is None:
+            self.process.kill()
+            wait_child(self.process)
+        self._join_threads()
+
+    def wait(self) -> None:
+        try:
+            exit_code = wait_child(self.process, timeout=self.config.nextclade_timeout_seconds)
+        except subprocess.TimeoutExpired:
+            logging.error(
+                "nextclade for %s didn't finish within %ss, killing it",
+                self.segment,
+                self.config.nextclade_timeout_seconds,
+            )
+            self.abort()
+            raise
+        self._join_threads()
+        if exit_code != 0:
+            msg = f"nextclade failed with exit code {exit_code}"
+            raise Exception(msg)
+        if self.reader_errors:
+            msg = f"Parsing streamed nextclade results failed: {self.reader_errors}"
+            raise RuntimeError(msg)
+        for gene in sorted(self.missing_genes):
+            # TODO: Add warning to each sequence
+            logging.info(
+                f"Gene {gene} not found in the genome annotation of the {self.segment} dataset"
+            )
+
+    def merge_into(
+        self,
+        aligned_nucleotide_sequences: dict[
+            AccessionVersion, dict[SegmentName, NucleotideSequence | None]
+        ],
+        aligned_aminoacid_sequences: dict[
+            AccessionVersion, dict[GeneName, AminoAcidSequence | None]
+        ],
+        nextclade_metadata: defaultdict[
+            AccessionVersion, defaultdict[SegmentName, dict[str, Any] | None]
+        ],
+        nucleotide_insertions: defaultdict[
+            AccessionVersion, defaultdict[SegmentName, list[NucleotideInsertion]]
+        ],
+        amino_acid_insertions: defaultdict[
+            AccessionVersion, defaultdict[GeneName, list[AminoAcidInsertion]]
+        ],
+    ) -> None:
+        """Add the results of the finished run to the results of the batch"""
+        for id, sequences in self.aligned_nucleotide_sequences.items():
+            aligned_nucleotide_sequences[id].update(sequences)
+        for id, gene_sequences in self.aligned_aminoacid_sequences.items():
+            aligned_aminoacid_sequences[id].update(gene_sequences)
+        for id in self.sequences:
+            # None if the sequence didn't align, like in parse_nextclade_json
+            nextclade_metadata[id][self.segment] = self.nextclade_results.get(id)
+        for id, segment_insertions in self.nucleotide_insertions.items():
+            nucleotide_insertions[id].update(segment_insertions)
+        for id, gene_insertions in self.amino_acid_insertions.items():
+            for gene, insertions in gene_insertions.items():
+                amino_acid_insertions[id][gene].extend(insertions)
+
+
+def wait_for_nextclade_runs(runs: list[StreamingNextcladeRun]) -> None:
+    for run in runs:
+        with tracer.span("nextclade", segment=run.segment):
+            run.wait()
+
+
+def run_nextclade_streaming(  # noqa: PLR0913, PLR0917
+    unaligned_nucleotide_sequences: dict[
+        AccessionVersion, dict[SegmentName, NucleotideSequence | None]
+    ],
+    result_dir: str,
+    dataset_dir: str,
+    config: Config,
+    aligned_nucleotide_sequences: dict[
+        AccessionVersion, dict[SegmentName, NucleotideSequence | None]
+    ],
+    aligned_aminoacid_sequences: dict[AccessionVersion, dict[GeneName, AminoAcidSequence | None]],
+    nextclade_metadata: defaultdict[
+        AccessionVersion, defaultdict[SegmentName, dict[str, Any] | None]
+    ],
+    nucleotide_insertions: defaultdict[
+        AccessionVersion, defaultdict[SegmentName, list[NucleotideInsertion]]
+    ],
+    amino_acid_insertions: defaultdict[
+        AccessionVersion, defaultdict[GeneName, list[AminoAcidInsertion]]
+    ],
+) -> None:
+    """
+    Align all segments concurrently with StreamingNextcladeRun and add the results to the given
+    containers. If one run fails, the others are killed before the result directory is removed.
+    With a `memory_budget_mb`, which is estimated for a single nextclade run, segments are aligned
+    one after another instead.
+    """
+    runs: list[StreamingNextcladeRun] = []
+    waited = 0
+    try:
+        for segment in config.nucleotideSequences:
+            segment_sequences = {
+                id: seg_dict[segment]
+                for id, seg_dict in unaligned_nucleotide_sequences.items()
+                if segment in seg_dict and seg_dict[segment] is not None
+            }
+            if not segment_sequences:
+                continue
+            result_dir_seg = result_dir if segment == "main" else result_dir + "/" + segment
+            dataset_dir_seg = dataset_dir if segment == "main" else dataset_dir + "/" + segment
+            runs.append(
+                StreamingNextcladeRun(
+                    segment, segment_sequences, result_dir_seg, dataset_dir_seg, config
+                )
+            )
+            if config.memory_budget_mb:
+                wait_for_nextclade_runs(runs[waited:])
+                waited = len(runs)
+        wait_for_nextclade_runs(runs[waited:])
+    finally:
+        # No-op for runs that finished
+        for run in runs:
+            run.abort()
+    for run in runs:
+        run.merge_into(
+            aligned_nucleotide_sequences,
+            aligned_aminoacid_sequences,
+            nextclade_metadata,
+            nucleotide_insertions,
+            amino_acid_insertions,
+        )
+
+
 def enrich_with_nextclade(
     unprocessed: Sequence[UnprocessedEntry], dataset_dir: str, config: Config
 ) -> dict[AccessionVersion, UnprocessedAfterNextclade]:
@@ -225,82 +609,83 @@ def enrich_with_nextclade(
                 )
             )
 
-    nextclade_metadata: defaultdict[AccessionVersion, defaultdict[SegmentName, dict[str, Any]]] = (
-        defaultdict(lambda: defaultdict(dict))
-    )
+    nextclade_metadata: defaultdict[
+        AccessionVersion, defaultdict[SegmentName, dict[str, Any] | None]
+    ] = defaultdict(lambda: defaultdict(dict))
     nucleotide_insertions: defaultdict[
         AccessionVersion, defaultdict[SegmentName, list[NucleotideInsertion]]
     ] = defaultdict(lambda: defaultdict(list))
     amino_acid_insertions: defaultdict[
         AccessionVersion, defaultdict[GeneName, list[AminoAcidInsertion]]
     ] = defaultdict(lambda: defaultdict(list))
-    with TemporaryDirectory(delete=not config.keep_tmp_dir) as result_dir:  # noqa: PLR1702
-        for segment in config.nucleotideSequences:
-            result_dir_seg = result_dir if segment == "main" else result_dir + "/" + segment
-            dataset_dir_seg = dataset_dir if segment == "main" else dataset_dir + "/" + segment
-            input_file = result_dir_seg + "/input.fasta"
-            os.makedirs(os.path.dirname(input_file), exist_ok=True)
-            is_empty: bool = True
-            with open(input_file, "w", encoding="utf-8") as f:
-                for id, seg_dict in unaligned_nucleotide_sequences.items():
-                    if segment in seg_dict and seg_dict[segment] is not None:
-                        f.write(f">{id}\n")
-                        f.write(f"{seg_dict[segment]}\n")
-                        is_empty = False
-            if is_empty:
-                continue
+    with TemporaryDirectory(  # noqa: PLR1702
+        delete=not config.keep_tmp_dir, dir=config.work_dir
+    ) as result_dir:
+        if config.nextclade_streaming:
+            run_nextclade_streaming(
+                unaligned_nucleotide_sequences,
+                result_dir,
+                dataset_dir,
+                config,
+                aligned_nucleotide_sequences,
+                aligned_aminoacid_sequences,
+                nextclade_metadata,
+                nucleotide_insertions,
+                amino_acid_insertions,
+            )
+        else:
+            for segment in config.nucleotideSequences:
+                result_dir_seg = result_dir if segment == "main" else result_dir + "/" + segment
+                dataset_dir_seg = dataset_dir if segment == "main" else dataset_dir + "/" + segment
+                input_file = result_dir_seg + "/input.fasta"
+                os.makedirs(os.path.dirname(input_file), exist_ok=True)
+                is_empty: bool = True
+                with open(input_file, "w", encoding="utf-8") as f:
+                    for id, seg_dict in unaligned_nucleotide_sequences.items():
+                        if segment in seg_dict and seg_dict[segment] is not None:
+                            f.write(f">{id}\n")
+                            f.write(f"{seg_dict[segment]}\n")
+                            is_empty = False
+                if is_empty:
+                    continue
 
-            command = [
-                "nextclade3",
-                "run",
-                f"--output-all={result_dir_seg}",
-                f"--input-dataset={dataset_dir_seg}",
-                f"--output-translations={
-                    result_dir_seg}/nextclade.cds_translation.{{cds}}.fasta",
-                "--jobs=1",
-                "--",
-                f"{input_file}",
-            ]
-            logging.debug(f"Running nextclade: {command}")
+                command = nextclade_command(input_file, result_dir_seg, dataset_dir_seg, config)
+                logging.debug("Running nextclade: %s", command)
 
-            # TODO: Capture stderr and log at DEBUG level
-            exit_code = subprocess.run(command, check=False).returncode  # noqa: S603
-            if exit_code != 0:
-                msg = f"nextclade failed with exit code {exit_code}"
-                raise Exception(msg)
+                # TODO: Capture stderr and log at DEBUG level
+                with tracer.span("nextclade", segment=segment):
+                    exit_code = wait_child(subprocess.Popen(command))  # noqa: S603
+                if exit_code != 0:
+                    msg = f"nextclade failed with exit code {exit_code}"
+                    raise Exception(msg)
 
-            logging.debug("Nextclade results available in %s", result_dir)
+                logging.debug("Nextclade results available in %s", result_dir)
 
-            # Add aligned sequences to aligned_nucleotide_sequences
-            # Modifies aligned_nucleotide_sequences in place
-            aligned_nucleotide_sequences = load_aligned_nuc_sequences(
-                result_dir_seg, segment, aligned_nucleotide_sequences
-            )
+                # Add aligned sequences to aligned_nucleotide_sequences
+                # Modifies aligned_nucleotide_sequences in place
+                aligned_nucleotide_sequences = load_aligned_nuc_sequences(
+                    result_dir_seg, segment, aligned_nucleotide_sequences
+                )
 
-            for gene in config.genes:
-                translation_path = result_dir_seg + f"/nextclade.cds_translation.{gene}.fasta"
-                try:
-                    with open(translation_path, encoding="utf-8") as aligned_translations:
-                        aligned_translation = SeqIO.parse(aligned_translations, "fasta")
-                        for aligned_sequence in aligned_translation:
-                            sequence_id = aligned_sequence.id
-                            masked_sequence = mask_terminal_gaps(
-                                str(aligned_sequence.seq), mask_char="X"
-                            )
-                            aligned_aminoacid_sequences[sequence_id][gene] = masked_sequence
-                except FileNotFoundError:
-                    # TODO: Add warning to each sequence
-                    logging.info(
-                        f"Gene {gene} not found in Nextclade results expected at: {
-                            translation_path}"
-                    )
+                for gene in config.genes:
+                    translation_path = result_dir_seg + f"/nextclade.cds_translation.{gene}.fasta"
+                    try:
+                        aligned_aminoacid_sequences = load_aligned_aa_sequences(
+                            translation_path, gene, aligned_aminoacid_sequences
+                        )
+                    except FileNotFoundError:
+                        # TODO: Add warning to each sequence
+                        logging.info(
+                            f"Gene {gene} not found in Nextclade results expected at: {
+                                translation_path}"
+                        )
 
-            nextclade_metadata = parse_nextclade_json(
-                result_dir_seg, nextclade_metadata, segment, unaligned_nucleotide_sequences
-            )
-            amino_acid_insertions, nucleotide_insertions = parse_nextclade_tsv(
-                amino_acid_insertions, nucleotide_insertions, result_dir_seg, config, segment
-            )
+                nextclade_metadata = parse_nextclade_json(
+                    result_dir_seg, nextclade_metadata, segment, unaligned_nucleotide_sequences
+                )
+                amino_acid_insertions, nucleotide_insertions = parse_nextclade_tsv(
+                    amino_acid_insertions, nucleotide_insertions, result_dir_seg, config, segment
+                )
 
     return {
         id: UnprocessedAfterNextclade(
@@ -370,6 +755,24 @@ def load_aligned_nuc_sequences(
     return aligned_nucleotide_sequences
 
 
+def load_aligned_aa_sequences(
+    translation_path: str,
+    gene: GeneName,
+    aligned_aminoacid_sequences: dict[AccessionVersion, dict[GeneName, AminoAcidSequence | None]],
+) -> dict[AccessionVersion, dict[GeneName, AminoAcidSequence | None]]:
+    """
+    Load the nextclade translation of `gene` into the aligned_aminoacid_sequences dict, mapping
+    each accession to a geneName: AminoAcidSequence dictionary.
+    """
+    with open(translation_path, encoding="utf-8") as aligned_translations:
+        aligned_translation = SeqIO.parse(aligned_translations, "fasta")
+        for aligned_sequence in aligned_translation:
+            sequence_id = aligned_sequence.id
+            masked_sequence = mask_terminal_gaps(str(aligned_sequence.seq), mask_char="X")
+            aligned_aminoacid_sequences[sequence_id][gene] = masked_sequence
+    return aligned_aminoacid_sequences
+
+
 def accession_from_str(id_str: AccessionVersion) -> str:
     return id_str.split(".")[0]
 
@@ -496,14 +899,19 @@ def get_metadata(
         args = spec_copy.args
 
     try:
-        processing_result = ProcessingFunctions.call_function(
-            spec.function,
-            args,
-            input_data,
-            output_field,
-        )
+        with tracer.span("processing_function", field=output_field, function=spec.function):
+            processing_result = ProcessingFunctions.call_function(
+                spec.function,
+                args,
+                input_data,
+                output_field,
+            )
     except Exception as e:
-        msg = f"Processing for spec: {spec} with input data: {input_data} failed with {e}"
+        # Not the whole spec: its args can contain long lists of options
+        msg = (
+            f"Processing with {spec.function} for {output_field} with input data: {input_data} "
+            f"failed with {e}"
+        )
         raise RuntimeError(msg) from e
 
     errors.extend(processing_result.errors)
@@ -653,7 +1061,7 @@ def process_single(
                     message=(f"Metadata field {output_field} is required."),
                 )
             )
-    logging.debug(f"Processed {id}: {output_metadata}")
+    logging.debug("Processed %s: %s", id, output_metadata)
 
     if isinstance(unprocessed, UnprocessedData):
         return processed_entry_no_alignment(
@@ -683,11 +1091,13 @@ def process_all(
     if config.nextclade_dataset_name:
         nextclade_results = enrich_with_nextclade(unprocessed, dataset_dir, config)
         for id, result in nextclade_results.items():
-            processed_single = process_single(id, result, config)
+            with tracer.span("process_entry", accessionVersion=id):
+                processed_single = process_single(id, result, config)
             processed_results.append(processed_single)
     else:
         for entry in unprocessed:
-            processed_single = process_single(entry.accessionVersion, entry.data, config)
+            with tracer.span("process_entry", accessionVersion=entry.accessionVersion):
+                processed_single = process_single(entry.accessionVersion, entry.data, config)
             processed_results.append(processed_single)
 
     return processed_results
@@ -720,26 +1130,271 @@ def download_nextclade_dataset(dataset_dir: str, config: Config) -> None:
         logging.info("Nextclade dataset downloaded successfully")
 
 
+def process_and_submit(
+    unprocessed: Sequence[UnprocessedEntry], dataset_dir: str, config: Config
+) -> int:
+    """Process and submit a fetched batch, returns the number of submitted entries"""
+    total_submitted = 0
+    # With concurrent organism workers the peak RSS of this process isn't that of a single batch
+    concurrent = config.organism_workers > 1
+    for sub_batch in split_by_memory_budget(unprocessed, config):
+        reset_peak_rss(process=not concurrent)
+        # Process the sequences, get result as dictionary
+        processed = process_all(sub_batch, dataset_dir, config)
+        # Submit the result
+        try:
+            with tracer.span("submit", entries=len(processed)):
+                submit_processed_sequences(processed, dataset_dir, config)
+        except RuntimeError as e:
+            logging.exception("Submitting processed data failed. Traceback : %s", e)
+            continue
+        total_submitted += len(processed)
+        if concurrent:
+            logging.info(
+                "Processed %s sequences, peak RSS of nextclade %.0f MiB",
+                len(processed),
+                peak_rss_children_mib(),
+            )
+        else:
+            logging.info(
+                "Processed %s sequences, peak RSS %.0f MiB (nextclade %.0f MiB)",
+                len(processed),
+                peak_rss_mib(),
+                peak_rss_children_mib(),
+            )
+    return total_submitted
+
+
+def nextclade_dataset_changed(old: Config, new: Config) -> bool:
+    return (
+        old.nextclade_dataset_name,
+        old.nextclade_dataset_tag,
+        old.nextclade_dataset_server,
+        old.nucleotideSequences,
+    ) != (
+        new.nextclade_dataset_name,
+        new.nextclade_dataset_tag,
+        new.nextclade_dataset_server,
+        new.nucleotideSequences,
+    )
+
+
+def replace_nextclade_dataset(dataset_dir: str, config: Config) -> None:
+    """
+    Download the dataset of `config` next to `dataset_dir` and only swap it in once the download
+    succeeded, so that a failed download leaves the previous dataset in place.
+    """
+    new_dir = mkdtemp(prefix="dataset-", dir=os.path.dirname(os.path.abspath(dataset_dir)))
+    try:
+        if config.nextclade_dataset_name:
+            download_nextclade_dataset(new_dir, config)
+    except Exception:
+        shutil.rmtree(new_dir)
+        raise
+    old_dir = new_dir + "-old"
+    os.replace(dataset_dir, old_dir)
+    os.replace(new_dir, dataset_dir)
+    shutil.rmtree(old_dir)
+
+
+def reload_config(config: Config, dataset_dir: str, lanes: LaneScheduler | None = None) -> Config:
+    """
+    Reload the config after config_file changed. Cached processing state is dropped and nextclade
+    datasets are only downloaded again if the dataset itself changed.
+    If the new config cannot be loaded, is invalid or its dataset cannot be downloaded the previous
+    config is kept: nothing of the new config is applied before all of it has been checked. The
+    lanes and the shutdown deadline are reconfigured, but enabling or disabling the ingest lane
+    requires a restart.
+    """
+    logging.info("Config file %s changed, reloading config", config.config_file)
+    try:
+        new_config = get_config()
+        check_logging_config(new_config)
+        if lanes:
+            LaneScheduler.check_config(new_config)
+    except Exception:
+        logging.exception("Reloading config failed, continuing with previous config")
+        return config
+    if bool(new_config.ingest_batch_size) != bool(config.ingest_batch_size):
+        logging.warning("Enabling or disabling the ingest lane requires a restart, ignoring")
+        new_config.ingest_batch_size = config.ingest_batch_size
+    if nextclade_dataset_changed(config, new_config):
+        logging.info("Nextclade dataset changed, downloading new dataset")
+        try:
+            replace_nextclade_dataset(dataset_dir, new_config)
+        except Exception:
+            logging.exception("Downloading new dataset failed, continuing with previous config")
+            return config
+    configure_logging(new_config)
+    clear_options_cache()
+    if (new_config.trace_file, new_config.trace_otlp_endpoint) != (
+        config.trace_file,
+        config.trace_otlp_endpoint,
+    ):
+        tracer.flush()
+        tracer.configure(new_config)
+    if lanes:
+        lanes.reconfigure(new_config)
+    shutdown.configure(new_config)
+    logging.info(f"Using config: {new_config}")
+    return new_config
+
+
+def run_batch(batch_id: int, dataset_dir: str, config: Config) -> int:
+    """Fetch, process and submit one batch, returns the number of fetched entries"""
+    with tracer.span("batch", batch_id=batch_id, organism=config.organism) as batch_span:
+        logging.debug("Fetching unprocessed sequences")
+        with tracer.span("fetch"):
+            unprocessed = parse_ndjson(fetch_unprocessed_sequences(config.batch_size, config))
+        if len(unprocessed) == 0:
+            tracer.discard(batch_span)
+        else:
+            process_and_submit(unprocessed, dataset_dir, config)
+    tracer.flush()
+    return len(unprocessed)
+
+
+def run_lane_batch(batch_id: int, lanes: LaneScheduler, dataset_dir: str, config: Config) -> bool:
+    """
+    Fetch into the lanes if they have room and process the next due batch of either lane.
+    Returns whether there was anything to do.
+    """
+    # After a shutdown request, buffered entries are processed without fetching more
+    drain = shutdown.requested
+    fetched = 0
+    if lanes.wants_more() and not shutdown.requested:
+        with tracer.span("fetch", batch_id=batch_id, organism=config.organism) as fetch_span:
+            unprocessed = parse_ndjson(fetch_unprocessed_sequences(config.batch_size, config))
+        if not unprocessed:
+            tracer.discard(fetch_span)
+        fetched = len(unprocessed)
+        lanes.add(unprocessed, time.monotonic())
+        # Nothing left in the backend, don't wait for ingest batches to fill up
+        drain = fetched < config.batch_size
+    next_batch = lanes.next_batch(time.monotonic(), drain)
+    if next_batch is None:
+        tracer.flush()
+        return fetched > 0
+    lane, batch = next_batch
+    start = time.monotonic()
+    with tracer.span("batch", batch_id=batch_id, organism=config.organism, lane=lane.name):
+        process_and_submit(batch, dataset_dir, config)
+    lanes.record(lane, time.monotonic() - start)
+    tracer.flush()
+    return True
+
+
 def run(config: Config) -> None:
+    tracer.configure(config)
     with TemporaryDirectory(delete=not config.keep_tmp_dir) as dataset_dir:
         if config.nextclade_dataset_name:
             download_nextclade_dataset(dataset_dir, config)
-        total_processed = 0
-        while True:
-            logging.debug("Fetching unprocessed sequences")
-            unprocessed = parse_ndjson(fetch_unprocessed_sequences(config.batch_size, config))
-            if len(unprocessed) == 0:
+        batch_id = 0
+        config_mtime = config_file_mtime(config)
+        lanes = LaneScheduler(config) if config.ingest_batch_size else None
+        while not shutdown.requested or (lanes and lanes.has_pending()):
+            if config.reload_config_file and config_file_mtime(config) != config_mtime:
+                config_mtime = config_file_mtime(config)
+                config = reload_config(config, dataset_dir, lanes)
+            batch_id += 1
+            if lanes:
+                found_work = run_lane_batch(batch_id, lanes, dataset_dir, config)
+            else:
+                found_work = run_batch(batch_id, dataset_dir, config) > 0
+            if not found_work:
                 # sleep 1 sec and try again
                 logging.debug("No unprocessed sequences found. Sleeping for 1 second.")
-                time.sleep(1)
-                continue
-            # Process the sequences, get result as dictionary
-            processed = process_all(unprocessed, dataset_dir, config)
-            # Submit the result
-            try:
-                submit_processed_sequences(processed, dataset_dir, config)
-            except RuntimeError as e:
-                logging.exception("Submitting processed data failed. Traceback : %s", e)
-                continue
-            total_processed += len(processed)
-            logging.info("Processed %s sequences", len(processed))
+                shutdown.sleep(1)
+        logging.info("Finished processing fetched batches, exiting")
+
+
+@dataclass
+class OrganismWorker:
+    config: Config
+    dataset_dir: str
+    batch_id: int = 0
+    # Fraction of the last fetched batch that was full, i.e. an estimate of the backlog
+    backlog: float = 0.0
+    ready_at: float = 0.0
+    in_flight: Future[int] | None = None
+
+    def finish_batch(self, now: float) -> None:
+        if self.in_flight is None:
+            return
+        try:
+            fetched = self.in_flight.result()
+            self.backlog = fetched / self.config.batch_size
+            self.ready_at = now if fetched else now + 1
+        except Exception:
+            logging.exception(f"Processing batch for {self.config.organism} failed")
+            self.backlog = 0
+            self.ready_at = now + ORGANISM_ERROR_BACKOFF_SECONDS
+        self.in_flight = None
+
+    def priority(self, now: float) -> float:
+        """Organisms that waited longer and have a larger backlog are served first"""
+        return (now - self.ready_at) * (1 + BACKLOG_WEIGHT * self.backlog)
+
+
+def check_organism_configs(configs: list[Config]) -> None:
+    for config in configs:
+        if config.reload_config_file or config.ingest_batch_size:
+            msg = (
+                "reload_config_file and ingest_batch_size are not supported with "
+                f"organism_config_files (set in config of {config.organism})"
+            )
+            raise ValueError(msg)
+
+
+def run_organisms(config: Config) -> None:
+    """
+    Serve all organisms in `organism_config_files` from a single process. Batches are fetched
+    from the organisms in turn and processed in a shared pool of `organism_workers` threads,
+    with at most one batch in flight per organism. Organisms with a backlog are polled again
+    immediately and preferred when all workers are busy, idle organisms are polled once a second.
+    The ingest lane and reloading config files are not supported in this mode.
+    """
+    organism_configs = get_organism_configs(config)
+    check_organism_configs([config, *organism_configs])
+    max_workers = config.organism_workers or len(organism_configs)
+    for organism_config in organism_configs:
+        # Batches of the organisms are processed concurrently if there is more than one worker
+        organism_config.organism_workers = max_workers
+        logging.info(f"Using config for {organism_config.organism}: {organism_config}")
+    tracer.configure(config)
+    with (
+        TemporaryDirectory(delete=not config.keep_tmp_dir) as work_dir,
+        ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="organism") as pool,
+    ):
+        workers = []
+        for index, organism_config in enumerate(organism_configs):
+            dataset_dir = os.path.join(
+                work_dir, f"{index}-{organism_config.organism}-v{organism_config.pipeline_version}"
+            )
+            os.makedirs(dataset_dir)
+            if organism_config.nextclade_dataset_name:
+                download_nextclade_dataset(dataset_dir, organism_config)
+            workers.append(OrganismWorker(organism_config, dataset_dir))
+
+        while not shutdown.requested or any(worker.in_flight for worker in workers):
+            now = time.monotonic()
+            for worker in workers:
+                if worker.in_flight and worker.in_flight.done():
+                    worker.finish_batch(now)
+
+            in_flight = [worker.in_flight for worker in workers if worker.in_flight]
+            ready = [w for w in workers if not w.in_flight and w.ready_at <= now]
+            if shutdown.requested:
+                ready = []
+            ready.sort(key=lambda worker: worker.priority(now), reverse=True)
+            for worker in ready[: max_workers - len(in_flight)]:
+                worker.batch_id += 1
+                worker.in_flight = pool.submit(
+                    run_batch, worker.batch_id, worker.dataset_dir, worker.config
+                )
+                in_flight.append(worker.in_flight)
+
+            waiting = [worker.ready_at for worker in workers if not worker.in_flight]
+            timeout = max(min(waiting, default=now + 1) - now, 0.01)
+            wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+        logging.info("Finished processing fetched batches, exiting")
@@ -22,18 +22,25 @@ from .datatypes import (
 
 logger = logging.getLogger(__name__)
 
-options_cache = {}
+# Keyed by the id of the options list of the config, so that workers serving several organisms
+# don't share options of equally named fields. The list is kept alive so its id is not reused.
+options_cache: dict[int, tuple[list[str], dict[str, str]]] = {}
 
 
-def compute_options_cache(output_field: str, options_list: list[str]) -> dict[str, str]:
+def compute_options_cache(options_list: list[str]) -> dict[str, str]:
     """Create a dictionary mapping option to standardized option. Add dict to the options_cache."""
     options: dict[str, str] = {}
     for option in options_list:
         options[standardize_option(option)] = option
-    options_cache[output_field] = options
+    options_cache[id(options_list)] = (options_list, options)
     return options
 
 
+def clear_options_cache() -> None:
+    """Drop cached options, e.g. after the options lists in the config changed"""
+    options_cache.clear()
+
+
 def standardize_option(option):
     return " ".join(option.lower().split())
 
@@ -52,11 +59,14 @@ class ProcessingFunctions:
             try:
                 result = func(input_data, output_field, args=args)
             except Exception as e:
-                message = (
-                    f"Error calling function {function_name} for output field {output_field} "
-                    f"with input {input_data} and args {args}: {e}"
+                logger.exception(
+                    "Error calling function %s for output field %s with input %s and args %s: %s",
+                    function_name,
+                    output_field,
+                    input_data,
+                    args,
+                    e,
                 )
-                logger.exception(message)
             if isinstance(result, ProcessingResult):
                 return result
             # Handle unexpected case where a called function does not return a ProcessingResult
@@ -151,15 +161,14 @@ class ProcessingFunctions:
         args:
             required: bool, if true, return error if date is missing (optional)
         """
-        logger.debug(f"input_data: {input_data}")
+        logger.debug("input_data: %s", input_data)
         date_str = input_data["date"] or ""
         release_date_str = input_data.get("release_date", "") or ""
         try:
             release_date = dateutil.parse(release_date_str)
         except Exception:
             release_date = None
-        logger.debug(f"release_date: {release_date}")
-        logger.debug(f"date_str: {date_str}")
+        logger.debug("release_date: %s, date_str: %s", release_date, date_str)
 
         formats_to_messages = {
             "%Y-%m-%d": None,
@@ -197,7 +206,7 @@ class ProcessingFunctions:
                     case "%Y":
                         datum = f"{parsed_date.strftime('%Y')}-01-01"
 
-                logger.debug(f"parsed_date: {parsed_date}")
+                logger.debug("parsed_date: %s", parsed_date)
 
                 if message:
                     warnings.append(
@@ -212,7 +221,7 @@ class ProcessingFunctions:
                     )
 
                 if parsed_date > datetime.now(tz=pytz.utc):
-                    logger.debug(f"parsed_date: {parsed_date} > {datetime.now(tz=pytz.utc)}")
+                    logger.debug("parsed_date: %s is in the future", parsed_date)
                     errors.append(
                         ProcessingAnnotation(
                             source=[
@@ -225,7 +234,7 @@ class ProcessingFunctions:
                     )
 
                 if release_date and parsed_date > release_date:
-                    logger.debug(f"parsed_date: {parsed_date} > release_date: {release_date}")
+                    logger.debug("parsed_date: %s > release_date: %s", parsed_date, release_date)
                     errors.append(
                         ProcessingAnnotation(
                             source=[
@@ -318,8 +327,11 @@ class ProcessingFunctions:
         # Check accessionVersion only exists once in the list:
         if number_fields != len(order):
             logging.error(
-                f"Concatenate: Expected {len(order)} fields, got {number_fields}. "
-                f"This is probably a configuration error. (accession_version: {accession_version})"
+                "Concatenate: Expected %s fields, got %s. "
+                "This is probably a configuration error. (accession_version: %s)",
+                len(order),
+                number_fields,
+                accession_version,
             )
             errors.append(
                 ProcessingAnnotation(
@@ -358,7 +370,7 @@ class ProcessingFunctions:
                 )
             else:
                 formatted_input_data.append(accession_version)
-        logging.debug(f"formatted input data:{formatted_input_data}")
+        logging.debug("formatted input data: %s", formatted_input_data)
 
         try:
             result = "/".join(formatted_input_data)
@@ -368,7 +380,9 @@ class ProcessingFunctions:
 
             return ProcessingResult(datum=result, warnings=warnings, errors=errors)
         except ValueError as e:
-            logging.error(f"Concatenate failed with {e} (accession_version: {accession_version})")
+            logging.error(
+                "Concatenate failed with %s (accession_version: %s)", e, accession_version
+            )
             errors.append(
                 ProcessingAnnotation(
                     source=[
@@ -461,10 +475,10 @@ class ProcessingFunctions:
 
         output_datum: ProcessedMetadataValue
         standardized_input_datum = standardize_option(input_datum)
-        if output_field in options_cache:
-            options = options_cache[output_field]
+        if id(args["options"]) in options_cache:
+            options = options_cache[id(args["options"])][1]
         else:
-            options = compute_options_cache(output_field, args["options"])
+            options = compute_options_cache(args["options"])
         if standardized_input_datum in options:
             output_datum = options[standardized_input_datum]
         # Allow ingested data to include fields not in options
@@ -0,0 +1,65 @@
+"""Graceful shutdown on SIGTERM, e.g. when Kubernetes scales down or rolls the deployment.
+
+No new batches are fetched after SIGTERM, but batches that were already fetched are processed and
+submitted, so that the backend doesn't have to wait for their leases to go stale before another
+worker fetches and aligns them again. If draining takes longer than `shutdown_deadline_seconds`
+the process exits anyway.
+"""
+
+import logging
+import os
+import signal
+import threading
+from types import FrameType
+
+from .config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class Shutdown:
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.deadline_seconds = 0.0
+
+    @property
+    def requested(self) -> bool:
+        return self.event.is_set()
+
+    def install(self, config: Config) -> None:
+        """Handle SIGTERM, must be called from the main thread"""
+        self.configure(config)
+        signal.signal(signal.SIGTERM, self._handle_signal)
+
+    def configure(self, config: Config) -> None:
+        """Use the deadline of a (reloaded) config for shutdown requests that follow"""
+        self.deadline_seconds = config.shutdown_deadline_seconds
+
+    def _handle_signal(self, signum: int, frame: FrameType | None) -> None:
+        if self.requested:
+            return
+        logger.info(
+            "Received %s, finishing fetched batches before exiting (deadline %ss)",
+            signal.Signals(signum).name,
+            self.deadline_seconds,
+        )
+        self.event.set()
+        if self.deadline_seconds > 0:
+            watchdog = threading.Timer(self.deadline_seconds, self._exit_after_deadline)
+            watchdog.daemon = True
+            watchdog.start()
+
+    def _exit_after_deadline(self) -> None:
+        logger.error(
+            "Fetched batches not finished within %ss after shutdown request, exiting",
+            self.deadline_seconds,
+        )
+        logging.shutdown()
+        os._exit(1)
+
+    def sleep(self, seconds: float) -> None:
+        """Sleep that is interrupted by a shutdown request"""
+        self.event.wait(seconds)
+
+
+shutdown = Shutdown()
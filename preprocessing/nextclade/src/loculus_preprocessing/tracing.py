@@ -0,0 +1,246 @@
+"""Optional tracing of the preprocessing pipeline.
+
+Spans are recorded for each pipeline stage (fetch, nextclade, processing of an entry, each
+processing function call, submission) with attributes such as batch id, accessionVersion, segment
+and field name. This allows finding the individual inputs that dominate batch latency.
+
+Spans are exported to a JSON-lines file (`trace_file`) and/or an OTLP collector via OTLP/HTTP
+with JSON encoding (`trace_otlp_endpoint`, e.g. http://otel-collector:4318/v1/traces).
+If neither is configured, spans are no-ops.
+"""
+
+import contextvars
+import json
+import logging
+import secrets
+import threading
+import time
+from collections.abc import Generator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Protocol
+
+import requests
+
+from .config import Config
+
+logger = logging.getLogger(__name__)
+
+# Attributes that child spans inherit from their parent, so every span can be attributed
+INHERITED_ATTRIBUTES = ("batch_id", "accessionVersion", "segment")
+OTLP_BATCH_SIZE = 512
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_span_id: str | None
+    start_time_ns: int
+    end_time_ns: int = 0
+    attributes: dict[str, Any] = field(default_factory=dict)
+    error: str | None = None
+    discarded: bool = False
+    # Finished spans of the trace (shared by all its spans), exported when the root span finishes
+    trace_spans: list["Span"] = field(default_factory=list, repr=False)
+
+
+class SpanExporter(Protocol):
+    def export(self, span: Span) -> None: ...
+
+    def flush(self) -> None: ...
+
+    def close(self) -> None: ...
+
+
+class JsonLinesExporter:
+    def __init__(self, path: str) -> None:
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8")  # noqa: SIM115
+
+    def export(self, span: Span) -> None:
+        record = {
+            "name": span.name,
+            "trace_id": span.trace_id,
+            "span_id": span.span_id,
+            "parent_span_id": span.parent_span_id,
+            "start_time_ns": span.start_time_ns,
+            "end_time_ns": span.end_time_ns,
+            "duration_ms": (span.end_time_ns - span.start_time_ns) / 1e6,
+            "attributes": span.attributes,
+            "error": span.error,
+        }
+        line = json.dumps(record, default=str)
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(line + "\n")
+
+    def flush(self) -> None:
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+
+    def close(self) -> None:
+        with self.lock:
+            self.file.close()
+
+
+class OtlpHttpExporter:
+    """Minimal OTLP/HTTP exporter using the JSON encoding of ExportTraceServiceRequest"""
+
+    def __init__(self, endpoint: str, service_name: str) -> None:
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.lock = threading.Lock()
+        self.buffer: list[Span] = []
+
+    @staticmethod
+    def _attribute(key: str, value: Any) -> dict[str, Any]:
+        otlp_value: dict[str, Any]
+        match value:
+            case bool():
+                otlp_value = {"boolValue": value}
+            case int():
+                otlp_value = {"intValue": str(value)}
+            case float():
+                otlp_value = {"doubleValue": value}
+            case _:
+                otlp_value = {"stringValue": str(value)}
+        return {"key": key, "value": otlp_value}
+
+    def _otlp_span(self, span: Span) -> dict[str, Any]:
+        otlp_span = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(span.start_time_ns),
+            "endTimeUnixNano": str(span.end_time_ns),
+            "attributes": [self._attribute(k, v) for k, v in span.attributes.items()],
+            "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+        }
+        if span.parent_span_id:
+            otlp_span["parentSpanId"] = span.parent_span_id
+        return otlp_span
+
+    def export(self, span: Span) -> None:
+        with self.lock:
+            self.buffer.append(span)
+            full = len(self.buffer) >= OTLP_BATCH_SIZE
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            spans, self.buffer = self.buffer, []
+        if not spans:
+            return
+        payload = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [self._attribute("service.name", self.service_name)]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "loculus_preprocessing"},
+                            "spans": [self._otlp_span(span) for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        try:
+            response = requests.post(self.endpoint, json=payload, timeout=10)
+            if not response.ok:
+                logger.warning(
+                    "Exporting %s spans failed with status code %s: %s",
+                    len(spans),
+                    response.status_code,
+                    response.text,
+                )
+        except requests.RequestException as e:
+            # Tracing must never break processing
+            logger.warning("Exporting %s spans failed: %s", len(spans), e)
+
+    def close(self) -> None:
+        self.flush()
+
+
+_current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self.exporters: list[SpanExporter] = []
+
+    def configure(self, config: Config) -> None:
+        self.close()
+        if config.trace_file:
+            self.exporters.append(JsonLinesExporter(config.trace_file))
+        if config.trace_otlp_endpoint:
+            self.exporters.append(
+                OtlpHttpExporter(
+                    config.trace_otlp_endpoint, f"loculus-preprocessing-{config.organism}"
+                )
+            )
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Generator[Span | None]:
+        if not self.exporters:
+            yield None
+            return
+        parent = _current_span.get()
+        if parent:
+            inherited = {
+                key: parent.attributes[key]
+                for key in INHERITED_ATTRIBUTES
+                if key in parent.attributes
+            }
+            attributes = inherited | attributes
+        span = Span(
+            name=name,
+            trace_id=parent.trace_id if parent else secrets.token_hex(16),
+            span_id=secrets.token_hex(8),
+            parent_span_id=parent.span_id if parent else None,
+            start_time_ns=time.time_ns(),
+            attributes=attributes,
+            trace_spans=parent.trace_spans if parent else [],
+        )
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end_time_ns = time.time_ns()
+            if parent:
+                span.trace_spans.append(span)
+            elif not span.discarded:
+                for exporter in self.exporters:
+                    for trace_span in [*span.trace_spans, span]:
+                        exporter.export(trace_span)
+
+    @staticmethod
+    def discard(span: Span | None) -> None:
+        """Do not export the trace of this root span, e.g. for polls that fetched nothing"""
+        if span:
+            span.discarded = True
+
+    def flush(self) -> None:
+        for exporter in self.exporters:
+            exporter.flush()
+
+    def close(self) -> None:
+        """Flush and close the exporters, e.g. before reconfiguring or at shutdown"""
+        for exporter in self.exporters:
+            exporter.close()
+        self.exporters = []
+
+
+tracer = Tracer()
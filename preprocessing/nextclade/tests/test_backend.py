@@ -0,0 +1,75 @@
+import time
+import unittest
+from unittest import mock
+
+import jwt
+
+from loculus_preprocessing import backend
+from loculus_preprocessing.config import Config
+
+
+def make_token(user: str, expires_in: float) -> str:
+    payload = {"sub": user, "exp": int(time.time() + expires_in)}
+    return jwt.encode(payload, "test-secret-that-is-long-enough-for-hs256", algorithm="HS256")
+
+
+class FakeResponse:
+    ok = True
+    status_code = 200
+    text = ""
+
+    def __init__(self, token: str) -> None:
+        self.token = token
+
+    def json(self):
+        return {"access_token": self.token}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class JwtCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.requests_by_user: list[str] = []
+
+        def post(url, data, timeout):
+            self.requests_by_user.append(data["username"])
+            return FakeResponse(make_token(data["username"], expires_in=3600))
+
+        patchers = [
+            mock.patch.object(backend.keycloak_session, "post", post),
+            mock.patch.object(backend, "jwt_caches", {}),
+            # Refresher threads only renew tokens shortly before they expire
+            mock.patch.object(backend.JwtCache, "start_refresher", lambda self: None),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_token_is_cached(self) -> None:
+        config = Config(keycloak_user="ingest")
+        self.assertEqual(backend.get_jwt(config), backend.get_jwt(config))
+        self.assertEqual(self.requests_by_user, ["ingest"])
+
+    def test_tokens_are_cached_per_credentials(self) -> None:
+        ebola = Config(organism="ebola", keycloak_user="pipeline_a")
+        cchf = Config(organism="cchf", keycloak_user="pipeline_b")
+        ebola_token = backend.get_jwt(ebola)
+        cchf_token = backend.get_jwt(cchf)
+        self.assertNotEqual(ebola_token, cchf_token)
+        self.assertEqual(backend.get_jwt(ebola), ebola_token)
+        self.assertEqual(self.requests_by_user, ["pipeline_a", "pipeline_b"])
+        # Organisms sharing credentials share the token
+        mpox = Config(organism="mpox", keycloak_user="pipeline_a")
+        self.assertEqual(backend.get_jwt(mpox), ebola_token)
+
+    def test_expiring_token_is_requested_again(self) -> None:
+        config = Config()
+        backend.jwt_cache_for(config).set_token(
+            "old", backend.dt.datetime.now(tz=backend.pytz.UTC) + backend.dt.timedelta(minutes=1)
+        )
+        self.assertNotEqual(backend.get_jwt(config), "old")
+        self.assertEqual(len(self.requests_by_user), 1)
@@ -0,0 +1,58 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from loculus_preprocessing.config import Config, get_organism_configs
+from loculus_preprocessing.prepro import check_organism_configs
+
+
+class OrganismConfigsTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.ebola = Path(tmp_dir.name) / "ebola.yaml"
+        self.ebola.write_text("organism: ebola\nbatch_size: 3\nlog_level: INFO\n", encoding="utf-8")
+        self.cchf = Path(tmp_dir.name) / "cchf.yaml"
+        self.cchf.write_text("organism: cchf\nbackend_host: http://other/cchf\n", encoding="utf-8")
+        self.base = Config(
+            organism="mpox",
+            backend_host="http://backend/mpox",
+            organism_config_files=f"{self.ebola}, {self.cchf}",
+        )
+
+    def test_organism_configs_replace_organism_in_backend_host(self) -> None:
+        configs = get_organism_configs(self.base, overrides={})
+
+        self.assertEqual([config.organism for config in configs], ["ebola", "cchf"])
+        self.assertEqual(configs[0].backend_host, "http://backend/ebola")
+        self.assertEqual(configs[0].batch_size, 3)
+        self.assertEqual(configs[1].backend_host, "http://other/cchf")
+        self.assertEqual(configs[0].config_file, str(self.ebola))
+        self.assertTrue(all(config.organism_config_files is None for config in configs))
+
+    def test_cli_args_and_env_variables_take_precedence(self) -> None:
+        overrides = {
+            "batch_size": 10,
+            "log_level": "DEBUG",
+            "organism": "mpox",
+            "backend_host": "http://backend/mpox",
+            "config_file": "base.yaml",
+        }
+        configs = get_organism_configs(self.base, overrides)
+
+        self.assertEqual([config.batch_size for config in configs], [10, 10])
+        self.assertEqual([config.log_level for config in configs], ["DEBUG", "DEBUG"])
+        # Settings identifying the organism come from the organism configs
+        self.assertEqual([config.organism for config in configs], ["ebola", "cchf"])
+        self.assertEqual(configs[0].backend_host, "http://backend/ebola")
+        self.assertEqual(configs[1].config_file, str(self.cchf))
+
+    def test_lanes_and_reloading_are_rejected(self) -> None:
+        configs = get_organism_configs(self.base, overrides={})
+        check_organism_configs([self.base, *configs])
+        configs[1].ingest_batch_size = 100
+        with self.assertRaisesRegex(ValueError, "cchf"):
+            check_organism_configs([self.base, *configs])
+        self.base.reload_config_file = True
+        with self.assertRaisesRegex(ValueError, "reload_config_file"):
+            check_organism_configs([self.base])
@@ -0,0 +1,61 @@
+import unittest
+
+from loculus_preprocessing.config import Config
+from loculus_preprocessing.datatypes import UnprocessedData, UnprocessedEntry
+from loculus_preprocessing.lanes import INGEST_SUBMITTER, LaneScheduler
+
+
+def entries(submitter: str, count: int, start: int = 0) -> list[UnprocessedEntry]:
+    return [
+        UnprocessedEntry(
+            accessionVersion=f"LOC_{i}.1",
+            data=UnprocessedData(submitter=submitter, metadata={}, unalignedNucleotideSequences={}),
+        )
+        for i in range(start, start + count)
+    ]
+
+
+def config(**kwargs) -> Config:
+    return Config(
+        **{"batch_size": 2, "ingest_batch_size": 4, "ingest_max_wait_seconds": 10, **kwargs}
+    )
+
+
+class LaneSchedulerTest(unittest.TestCase):
+    def test_user_submissions_are_processed_before_full_ingest_batches(self) -> None:
+        lanes = LaneScheduler(config())
+        lanes.add(entries(INGEST_SUBMITTER, 3), now=0)
+        self.assertIsNone(lanes.next_batch(now=1, drain=False))
+        self.assertTrue(lanes.wants_more())
+
+        lanes.add(entries("user", 1, start=3), now=1)
+        lane, batch = lanes.next_batch(now=1, drain=False)
+        self.assertEqual(lane.name, "user")
+        self.assertEqual([entry.accessionVersion for entry in batch], ["LOC_3.1"])
+
+    def test_ingest_batch_is_released_when_full_waited_or_drained(self) -> None:
+        lanes = LaneScheduler(config())
+        lanes.add(entries(INGEST_SUBMITTER, 5), now=0)
+        lane, batch = lanes.next_batch(now=1, drain=False)
+        self.assertEqual((lane.name, len(batch)), ("ingest", 4))
+        self.assertIsNone(lanes.next_batch(now=1, drain=False))
+        self.assertEqual(len(lanes.next_batch(now=1, drain=True)[1]), 1)
+
+        lanes.add(entries(INGEST_SUBMITTER, 1), now=2)
+        self.assertIsNone(lanes.next_batch(now=11, drain=False))
+        self.assertIsNotNone(lanes.next_batch(now=12, drain=False))
+
+    def test_reconfigure_keeps_pending_entries(self) -> None:
+        lanes = LaneScheduler(config())
+        lanes.add(entries(INGEST_SUBMITTER, 3), now=0)
+        lanes.reconfigure(config(ingest_batch_size=3, user_lane_cpu_share=0.5))
+        self.assertEqual(lanes.ingest.cpu_share, 0.5)
+        self.assertEqual(len(lanes.next_batch(now=0, drain=False)[1]), 3)
+
+    def test_invalid_cpu_share_is_rejected(self) -> None:
+        with self.assertRaisesRegex(ValueError, "user_lane_cpu_share"):
+            LaneScheduler(config(user_lane_cpu_share=1))
+        lanes = LaneScheduler(config())
+        with self.assertRaisesRegex(ValueError, "user_lane_cpu_share"):
+            lanes.reconfigure(config(user_lane_cpu_share=0))
+        self.assertEqual(lanes.user.cpu_share, Config.user_lane_cpu_share)
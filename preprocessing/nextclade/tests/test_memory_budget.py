@@ -0,0 +1,76 @@
+import subprocess  # noqa: S404
+import sys
+import unittest
+
+from loculus_preprocessing.config import Config
+from loculus_preprocessing.datatypes import UnprocessedData, UnprocessedEntry
+from loculus_preprocessing.memory_budget import (
+    MIB,
+    estimate_entry_bytes,
+    peak_rss_children_mib,
+    reset_peak_rss,
+    split_by_memory_budget,
+    wait_child,
+)
+
+
+def entry(id: str, length: int) -> UnprocessedEntry:
+    return UnprocessedEntry(
+        accessionVersion=f"{id}.1",
+        data=UnprocessedData(
+            submitter="user",
+            metadata={},
+            unalignedNucleotideSequences={"main": "A" * length},
+        ),
+    )
+
+
+class SplitByMemoryBudgetTest(unittest.TestCase):
+    def test_estimate_entry_bytes_grows_with_sequence_length(self) -> None:
+        config = Config(nextclade_dataset_name="dataset", reference_length=1000)
+        self.assertGreater(
+            estimate_entry_bytes(entry("a", 2000), config),
+            estimate_entry_bytes(entry("a", 1000), config),
+        )
+
+    def test_disabled(self) -> None:
+        batch = [entry(str(i), 1000) for i in range(10)]
+        self.assertEqual(split_by_memory_budget(batch, Config(memory_budget_mb=0)), [batch])
+
+    def test_keeps_order_and_sizes(self) -> None:
+        config = Config(memory_budget_mb=1)
+        # Each entry is estimated at about 0.4 MiB, so two fit into a sub-batch
+        batch = [entry(str(i), 80_000) for i in range(5)]
+        self.assertLess(estimate_entry_bytes(batch[0], config), MIB / 2)
+        sub_batches = split_by_memory_budget(batch, config)
+        self.assertEqual([len(sub_batch) for sub_batch in sub_batches], [2, 2, 1])
+        self.assertEqual([e for sub_batch in sub_batches for e in sub_batch], batch)
+
+    def test_oversized_entry_gets_own_batch(self) -> None:
+        config = Config(memory_budget_mb=1)
+        batch = [entry("small", 1000), entry("large", 1_000_000), entry("small2", 1000)]
+        sub_batches = split_by_memory_budget(batch, config)
+        self.assertEqual([len(sub_batch) for sub_batch in sub_batches], [1, 1, 1])
+
+
+class WaitChildTest(unittest.TestCase):
+    def test_records_peak_rss_of_each_child(self) -> None:
+        reset_peak_rss()
+        allocate = "x = bytearray({size}); x[::4096] = b'1' * len(x[::4096])"
+        large = subprocess.Popen([sys.executable, "-c", allocate.format(size=200 * MIB)])  # noqa: S603
+        self.assertEqual(wait_child(large), 0)
+        self.assertGreater(peak_rss_children_mib(), 150)
+
+        # A later batch only reports its own children, not the lifetime peak
+        reset_peak_rss()
+        small = subprocess.Popen([sys.executable, "-c", "import sys; sys.exit(2)"])
+        self.assertEqual(wait_child(small), 2)
+        self.assertEqual(small.returncode, 2)
+        self.assertLess(peak_rss_children_mib(), 100)
+
+    def test_timeout(self) -> None:
+        process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(10)"])
+        with self.assertRaises(subprocess.TimeoutExpired):
+            wait_child(process, timeout=0.2)
+        process.kill()
+        self.assertNotEqual(wait_child(process), 0)
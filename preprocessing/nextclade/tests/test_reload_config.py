@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from loculus_preprocessing import prepro
+from loculus_preprocessing.config import Config
+from loculus_preprocessing.lanes import LaneScheduler
+from loculus_preprocessing.shutdown import shutdown
+
+
+def fake_download(version: str | None):
+    def download(dataset_dir: str, config: Config) -> None:
+        if version is None:
+            msg = "Dataset download failed"
+            raise RuntimeError(msg)
+        reference_file = Path(dataset_dir) / "reference.fasta"
+        reference_file.write_text(f">{version}\nACGT\n", encoding="utf-8")
+
+    return download
+
+
+def reference(dataset_dir: str) -> str:
+    with open(os.path.join(dataset_dir, "reference.fasta"), encoding="utf-8") as file:
+        return file.readline().strip()
+
+
+class ReloadConfigTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.dataset_dir = os.path.join(tmp_dir.name, "dataset")
+        os.mkdir(self.dataset_dir)
+        (Path(self.dataset_dir) / "reference.fasta").write_text(">old\nACGT\n", encoding="utf-8")
+
+    def reload(self, old: Config, new: Config, download=None, lanes=None) -> Config:
+        with (
+            mock.patch.object(prepro, "get_config", return_value=new),
+            mock.patch.object(
+                prepro, "download_nextclade_dataset", download or fake_download(None)
+            ),
+        ):
+            return prepro.reload_config(old, self.dataset_dir, lanes)
+
+    def test_new_dataset_is_swapped_in(self) -> None:
+        old = Config(nextclade_dataset_name="old")
+        new = Config(nextclade_dataset_name="new", shutdown_deadline_seconds=7)
+
+        self.assertIs(self.reload(old, new, fake_download("new")), new)
+        self.assertEqual(reference(self.dataset_dir), ">new")
+        self.assertEqual(os.listdir(os.path.dirname(self.dataset_dir)), ["dataset"])
+        self.assertEqual(shutdown.deadline_seconds, 7)
+
+    def test_failed_download_keeps_previous_dataset_and_config(self) -> None:
+        old = Config(nextclade_dataset_name="old")
+
+        self.assertIs(self.reload(old, Config(nextclade_dataset_name="new")), old)
+        self.assertEqual(reference(self.dataset_dir), ">old")
+        self.assertEqual(os.listdir(os.path.dirname(self.dataset_dir)), ["dataset"])
+
+    def test_invalid_logging_config_is_rejected_before_anything_is_applied(self) -> None:
+        old = Config(nextclade_dataset_name="old")
+        lanes = LaneScheduler(Config(ingest_batch_size=10))
+        download = mock.Mock(side_effect=fake_download("new"))
+        for invalid in [{"log_format": "xml"}, {"log_sample_rate": 0}, {"log_level": "LOUD"}]:
+            new = Config(nextclade_dataset_name="new", ingest_batch_size=20, **invalid)
+            with (
+                self.subTest(**invalid),
+                mock.patch.object(prepro, "configure_logging") as configure_logging,
+            ):
+                self.assertIs(self.reload(old, new, download, lanes), old)
+                configure_logging.assert_not_called()
+        download.assert_not_called()
+        self.assertEqual(reference(self.dataset_dir), ">old")
+        self.assertEqual(lanes.ingest.batch_size, 10)
+
+    def test_lanes_are_reconfigured(self) -> None:
+        old = Config(ingest_batch_size=10)
+        lanes = LaneScheduler(old)
+        self.reload(old, Config(ingest_batch_size=20), lanes=lanes)
+        self.assertEqual(lanes.ingest.batch_size, 20)
+
+        # Invalid lane configs are rejected as a whole
+        self.assertIs(self.reload(old, Config(user_lane_cpu_share=2), lanes=lanes), old)
+
+        # The ingest lane can't be disabled without a restart
+        reloaded = self.reload(old, Config(ingest_batch_size=0), lanes=lanes)
+        self.assertEqual(reloaded.ingest_batch_size, 10)
@@ -0,0 +1,185 @@
+import json
+import os
+import stat
+import sys
+import tempfile
+import textwrap
+import time
+import unittest
+from collections import defaultdict
+from operator import itemgetter
+from pathlib import Path
+from unittest import mock
+
+from loculus_preprocessing.config import Config
+from loculus_preprocessing.prepro import (
+    StreamingNextcladeRun,
+    dataset_cds_names,
+    run_nextclade_streaming,
+)
+
+# Stand-in for `nextclade3 run` that writes the outputs the streaming run reads.
+# MODE=bad_ndjson writes unparsable NDJSON followed by more than a pipe buffer of output,
+# MODE=fail exits without opening any output. Start and end of each run are appended to LOG.
+FAKE_NEXTCLADE = """
+import os, sys, time
+args = dict(arg.removeprefix("--").split("=", 1) for arg in sys.argv[2:] if "=" in arg)
+mode = os.environ.get("FAKE_NEXTCLADE_MODE", "ok")
+log = open(os.environ["FAKE_NEXTCLADE_LOG"], "a")
+log.write(f"start {time.monotonic()}\\n")
+log.flush()
+if mode == "fail":
+    sys.exit(3)
+records = [chunk.split("\\n", 1) for chunk in sys.stdin.read().split(">") if chunk]
+records = [(name.strip(), sequence.replace("\\n", "")) for name, sequence in records]
+with open(args["output-fasta"], "w") as f:
+    for name, sequence in records:
+        f.write(f">{name}\\n{sequence}\\n")
+with open(args["output-ndjson"], "w") as f:
+    if mode == "bad_ndjson":
+        f.write("{not json\\n")
+        f.write(("{}\\n" * 1024) * 100)
+    for name, _ in records:
+        f.write(f'{{"seqName": "{name}", "alignmentScore": 10}}\\n')
+with open(args["output-tsv"], "w") as f:
+    f.write("seqName\\tinsertions\\taaInsertions\\n")
+    for name, _ in records:
+        f.write(f"{name}\\t10:A\\tgeneA:1:M\\n")
+for cds in ["geneA", "unconfigured"]:
+    with open(args["output-translations"].replace("{cds}", cds), "w") as f:
+        for name, _ in records:
+            f.write(f">{name}\\nMK\\n")
+time.sleep(0.2)
+log.write(f"end {time.monotonic()}\\n")
+"""
+
+
+GFF3 = (
+    "##gff-version 3\n"
+    "seq\t.\tgene\t1\t9\t.\t+\t.\tName=geneA\n"
+    "seq\t.\tCDS\t1\t9\t.\t+\t0\tName=geneA\n"
+    "seq\t.\tCDS\t10\t18\t.\t+\t0\tID=cds-1;gene=unconfigured\n"
+)
+
+
+def write_dataset(dataset: Path) -> None:
+    dataset.mkdir(parents=True)
+    (dataset / "pathogen.json").write_text(
+        json.dumps({"files": {"genomeAnnotation": "annotation.gff3"}}), encoding="utf-8"
+    )
+    (dataset / "annotation.gff3").write_text(GFF3, encoding="utf-8")
+
+
+class StreamingNextcladeTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_path = Path(tmp_dir.name)
+        bin_dir = self.tmp_path / "bin"
+        bin_dir.mkdir()
+        script = bin_dir / "nextclade3"
+        script.write_text(
+            f"#!{sys.executable}\n" + textwrap.dedent(FAKE_NEXTCLADE), encoding="utf-8"
+        )
+        script.chmod(script.stat().st_mode | stat.S_IEXEC)
+        self.log = self.tmp_path / "nextclade.log"
+        environment = {
+            "PATH": f"{bin_dir}{os.pathsep}{os.environ['PATH']}",
+            "FAKE_NEXTCLADE_LOG": str(self.log),
+        }
+        patcher = mock.patch.dict(os.environ, environment)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dataset = self.tmp_path / "dataset"
+        write_dataset(self.dataset)
+
+    def streaming_run(self) -> StreamingNextcladeRun:
+        config = Config(genes=["geneA", "geneB"], nextclade_timeout_seconds=30)
+        sequences = {"a.1": "ACGTACGT", "b.1": "TTTTACGT"}
+        return StreamingNextcladeRun(
+            "main", sequences, str(self.tmp_path / "out"), str(self.dataset), config
+        )
+
+    def run_segments(self, config: Config) -> list[tuple[str, float]]:
+        """Align two segments, returns the start and end events of the nextclade runs"""
+        for segment in config.nucleotideSequences:
+            write_dataset(self.tmp_path / "segments" / segment)
+        unaligned = {"a.1": {"L": "ACGT", "S": "TTTT"}}
+        nextclade_metadata = defaultdict(lambda: defaultdict(dict))
+        run_nextclade_streaming(
+            unaligned,
+            str(self.tmp_path / "out"),
+            str(self.tmp_path / "segments"),
+            config,
+            {"a.1": {}},
+            {"a.1": {}},
+            nextclade_metadata,
+            defaultdict(lambda: defaultdict(list)),
+            defaultdict(lambda: defaultdict(list)),
+        )
+        self.assertEqual(set(nextclade_metadata["a.1"]), {"L", "S"})
+        events = [line.split() for line in self.log.read_text(encoding="utf-8").splitlines()]
+        return sorted(((event, float(at)) for event, at in events), key=itemgetter(1))
+
+    def test_dataset_cds_names(self) -> None:
+        self.assertEqual(dataset_cds_names(str(self.dataset)), {"geneA", "unconfigured"})
+        self.assertIsNone(dataset_cds_names(str(self.tmp_path)))
+
+    def test_streaming_run_collects_results(self) -> None:
+        run = self.streaming_run()
+        run.wait()
+
+        self.assertEqual(
+            run.aligned_nucleotide_sequences,
+            {"a.1": {"main": "ACGTACGT"}, "b.1": {"main": "TTTTACGT"}},
+        )
+        self.assertEqual(
+            run.aligned_aminoacid_sequences, {"a.1": {"geneA": "MK"}, "b.1": {"geneA": "MK"}}
+        )
+        self.assertEqual(run.nextclade_results["a.1"]["alignmentScore"], 10)
+        self.assertEqual(run.nucleotide_insertions["a.1"]["main"], ["10:A"])
+        self.assertEqual(run.amino_acid_insertions["a.1"]["geneA"], ["1:M"])
+        self.assertEqual(run.missing_genes, {"geneB"})
+        # Translations of CDSs that aren't configured are discarded, not written to the work dir
+        unconfigured = self.tmp_path / "out" / "nextclade.cds_translation.unconfigured.fasta"
+        self.assertTrue(unconfigured.is_symlink())
+        self.assertEqual(os.readlink(unconfigured), os.devnull)
+
+        nextclade_metadata = defaultdict(lambda: defaultdict(dict))
+        aligned_aminoacid_sequences = {"a.1": {"geneB": None}, "b.1": {"geneB": None}}
+        run.merge_into(
+            {"a.1": {}, "b.1": {}},
+            aligned_aminoacid_sequences,
+            nextclade_metadata,
+            defaultdict(lambda: defaultdict(list)),
+            defaultdict(lambda: defaultdict(list)),
+        )
+        self.assertEqual(aligned_aminoacid_sequences["a.1"], {"geneA": "MK", "geneB": None})
+        self.assertEqual(nextclade_metadata["b.1"]["main"]["seqName"], "b.1")
+
+    def test_parse_error_stops_nextclade(self) -> None:
+        run = None
+        with mock.patch.dict(os.environ, {"FAKE_NEXTCLADE_MODE": "bad_ndjson"}):
+            run = self.streaming_run()
+            start = time.monotonic()
+            with self.assertRaisesRegex(Exception, r"nextclade failed|Parsing streamed nextclade"):
+                run.wait()
+        self.assertLess(time.monotonic() - start, 20)
+        self.assertFalse(any(thread.is_alive() for thread in run.threads))
+
+    def test_nextclade_exiting_early_releases_readers(self) -> None:
+        with mock.patch.dict(os.environ, {"FAKE_NEXTCLADE_MODE": "fail"}):
+            run = self.streaming_run()
+            with self.assertRaisesRegex(Exception, "exit code 3"):
+                run.wait()
+        self.assertFalse(any(thread.is_alive() for thread in run.threads))
+
+    def test_segments_are_aligned_concurrently(self) -> None:
+        config = Config(nucleotideSequences=["L", "S"], genes=["geneA"])
+        events = self.run_segments(config)
+        self.assertEqual([event for event, _ in events], ["start", "start", "end", "end"])
+
+    def test_segments_are_aligned_sequentially_with_memory_budget(self) -> None:
+        config = Config(nucleotideSequences=["L", "S"], genes=["geneA"], memory_budget_mb=100)
+        events = self.run_segments(config)
+        self.assertEqual([event for event, _ in events], ["start", "end", "start", "end"])
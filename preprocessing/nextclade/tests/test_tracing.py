@@ -0,0 +1,63 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from loculus_preprocessing.config import Config
+from loculus_preprocessing.tracing import OtlpHttpExporter, Tracer
+
+
+class TracerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_path = Path(tmp_dir.name)
+
+    def test_spans_are_exported_with_inherited_attributes(self) -> None:
+        trace_file = self.tmp_path / "trace.jsonl"
+        tracer = Tracer()
+        tracer.configure(Config(trace_file=str(trace_file)))
+        with tracer.span("batch", batch_id=1), tracer.span("nextclade", segment="L"):
+            pass
+        tracer.close()
+
+        lines = trace_file.read_text(encoding="utf-8").splitlines()
+        spans = [json.loads(line) for line in lines]
+        self.assertEqual([span["name"] for span in spans], ["nextclade", "batch"])
+        self.assertEqual(spans[0]["attributes"], {"batch_id": 1, "segment": "L"})
+        self.assertEqual(spans[0]["parent_span_id"], spans[1]["span_id"])
+
+    def test_reconfigure_closes_previous_exporter(self) -> None:
+        tracer = Tracer()
+        tracer.configure(Config(trace_file=str(self.tmp_path / "first.jsonl")))
+        first = tracer.exporters[0]
+        tracer.configure(Config(trace_file=str(self.tmp_path / "second.jsonl")))
+        self.assertTrue(first.file.closed)
+        with tracer.span("batch"):
+            pass
+        tracer.close()
+        self.assertFalse(tracer.exporters)
+        self.assertEqual((self.tmp_path / "first.jsonl").read_text(encoding="utf-8"), "")
+        self.assertIn("batch", (self.tmp_path / "second.jsonl").read_text(encoding="utf-8"))
+
+    def test_discarded_traces_are_not_exported(self) -> None:
+        trace_file = self.tmp_path / "trace.jsonl"
+        tracer = Tracer()
+        tracer.configure(Config(trace_file=str(trace_file)))
+        with tracer.span("fetch") as span:
+            tracer.discard(span)
+        tracer.close()
+        self.assertEqual(trace_file.read_text(encoding="utf-8"), "")
+
+
+class OtlpHttpExporterTest(unittest.TestCase):
+    def test_attributes(self) -> None:
+        self.assertEqual(
+            OtlpHttpExporter._attribute("ok", True), {"key": "ok", "value": {"boolValue": True}}
+        )
+        self.assertEqual(
+            OtlpHttpExporter._attribute("n", 3), {"key": "n", "value": {"intValue": "3"}}
+        )
+        self.assertEqual(
+            OtlpHttpExporter._attribute("s", None), {"key": "s", "value": {"stringValue": "None"}}
+        )